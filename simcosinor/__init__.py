@@ -1,3 +1,9 @@
 from . import functions
+from . import profiling
+from . import store
+from . import server
+from . import batch
+from . import online
+from . import equivalence
 from . import cynumstats
 from .version import __version__
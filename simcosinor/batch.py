@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+from __future__ import division
+import os
+import re
+import json
+import hashlib
+from multiprocessing import Pool
+
+from simcosinor.functions import CosinorExamples
+from simcosinor.server import JOB_TYPES, load_csv, run_job
+
+EXAMPLES = {'threesubs_modality1': CosinorExamples.modality1_subjects_normed,
+				'threesubs_modality2': CosinorExamples.modality2_subjects_normed,
+				'threesubs_modality3': CosinorExamples.modality3_subjects_normed,
+				'threesubs_modality4': CosinorExamples.modality4_subjects_normed}
+
+# keys of a dataset that are passed on to the jobs (see simcosinor.server.job_data)
+DATASET_KEYS = ['csv', 'time_variable', 'covariates', 'model', 'model_json']
+
+def load_manifest(manifest):
+	"""
+	Reads a batch manifest (*.yaml, *.yml or *.json). YAML manifests require PyYAML.
+
+	e.g.,
+	output: batch_results
+	workers: 4
+	seed: 42
+	datasets:
+	  - name: modality1
+	    example: threesubs_modality1    # or csv: data.csv, model: {...} or model_json: model.json
+	    time_variable: scan_time
+	    by_subject: Subject
+	    covariates: [scan_session, d]
+	    rois: [rh.R_Ig, lh.L_6r]
+	analyses:
+	  - {type: simulation, period: [24.0], n_simulations: 10000, randomise_time: true, n_sampling: 24, store: true}
+	  - {type: permutation, period: [12.0, 24.0], n_perm: 10000}
+	  - {type: periodogram, method: lomb_scargle, plot: true}
+	  - {type: sliding_window, subset_size: 24, plot: true}
+	"""
+	with open(manifest) as manifest_file:
+		if manifest.endswith(('.yaml', '.yml')):
+			try:
+				import yaml
+			except ImportError:
+				raise ImportError("Error: PyYAML is required for YAML manifests (pip install pyyaml), or use a JSON manifest")
+			settings = yaml.safe_load(manifest_file)
+		else:
+			settings = json.load(manifest_file)
+	assert 'datasets' in settings, "Error: the manifest has no datasets"
+	assert 'analyses' in settings, "Error: the manifest has no analyses"
+	return settings
+
+
+def _job_id(label, job):
+	# the hash of the settings identifies a job across runs, which allows the batch to resume
+	digest = hashlib.sha1(json.dumps(job, sort_keys = True).encode('utf-8')).hexdigest()[:8]
+	return "%s_%s" % (re.sub(r'[^A-Za-z0-9._-]+', '-', label), digest)
+
+
+def expand_manifest(settings):
+	"""
+	Expands a manifest into jobs for simcosinor.server.run_job: every analysis is run for every dataset, subject (by_subject) and ROI. Identical jobs are only run once.
+
+	Returns
+	---------
+	jobs : list
+		Job dictionaries with an 'id' that is unique to the settings of the job
+	"""
+	output = settings.get('output', 'batch_results')
+	jobs = {}
+	for dataset in settings['datasets']:
+		data_job = {key: dataset[key] for key in DATASET_KEYS if key in dataset}
+		if 'example' in dataset:
+			assert dataset['example'] in EXAMPLES, "Error: unknown example %s" % dataset['example']
+			data_job['csv'] = EXAMPLES[dataset['example']]
+		assert len(set(['csv', 'model', 'model_json']) & set(data_job)) == 1, "Error: each dataset requires one of csv, example, model or model_json"
+		if 'csv' in data_job:
+			data_job['csv'] = os.path.abspath(data_job['csv'])
+		name = dataset.get('name', os.path.splitext(os.path.basename(data_job.get('csv', data_job.get('model_json', 'model'))))[0])
+		subjects = [None]
+		if dataset.get('by_subject'):
+			assert 'csv' in data_job, "Error: by_subject requires a CSV dataset"
+			pdCSV = load_csv(data_job['csv'])
+			subjects = [[dataset['by_subject'], str(subject)] for subject in pdCSV[dataset['by_subject']].astype(str).unique()]
+		rois = dataset.get('rois', [None] if 'csv' not in data_job else ['lh.L_6r'])
+		if isinstance(rois, str):
+			rois = [rois]
+		for analysis in settings['analyses']:
+			assert analysis.get('type') in JOB_TYPES, "Error: the analysis type must be one of %s" % ", ".join(JOB_TYPES)
+			for subject in subjects:
+				for roi in rois:
+					job = dict(data_job)
+					if settings.get('seed') is not None:
+						job['seed'] = settings['seed']
+					job.update({key: analysis[key] for key in analysis if key not in ['store', 'plot']})
+					if subject is not None:
+						job['subject'] = subject
+					if roi is not None:
+						job['roi'] = roi
+					label = "_".join([name] + ([subject[1]] if subject is not None else []) + ([roi] if roi is not None else []) + [analysis['type']])
+					job_id = _job_id(label, job)
+					job['id'] = job_id
+					if analysis.get('store') and analysis['type'] == 'simulation':
+						job['store'] = os.path.join(output, 'stores', "%s.store" % job_id)
+					if analysis.get('plot') and analysis['type'] in ['periodogram', 'sliding_window']:
+						job['outname'] = os.path.join(output, 'plots', "%s.png" % job_id)
+					jobs[job_id] = job
+	return list(jobs.values())
+
+
+def _design_key(job):
+	# jobs with the same data, times and periods share the design matrices and their factorisations
+	return json.dumps([job.get(key) for key in ['csv', 'model', 'model_json', 'subject', 'time_variable', 'covariates', 'period']], sort_keys = True)
+
+
+def _result_path(output, job_id):
+	return os.path.join(output, 'results', "%s.json" % job_id)
+
+
+def _run_job_group(group):
+	output, jobs = group
+	finished = []
+	for job in jobs:
+		record = {'id': job['id'], 'job': job}
+		try:
+			record.update({'status': 'done', 'result': run_job(job)})
+		except Exception as error:
+			record.update({'status': 'error', 'error': "%s: %s" % (type(error).__name__, error)})
+		# results are written atomically so that an interrupted batch can be resumed
+		temp_path = _result_path(output, job['id']) + '.tmp'
+		with open(temp_path, 'w') as outfile:
+			json.dump(record, outfile)
+		os.replace(temp_path, _result_path(output, job['id']))
+		finished.append((job['id'], record['status']))
+	return finished
+
+
+def run_batch(manifest, n_workers = None, resume = True):
+	"""
+	Runs a batch manifest (see load_manifest). Jobs are grouped by their design (data, subject, times, covariates and periods) so that each group loads its CSV and factorises its designs once, and the groups are dispatched to a pool of worker processes. The result of every job is saved to {output}/results/{id}.json as it finishes, and finished jobs are skipped when the batch is run again (resume). A summary of all the jobs is saved to {output}/summary.json.
+
+	Parameters
+	----------
+	manifest : string or dict
+		Manifest file or settings
+	n_workers : int
+		[optional] The number of worker processes (default: workers of the manifest or 1)
+	resume : bool
+		Skip jobs that have already finished
+
+	Returns
+	---------
+	records : list
+		{id, job, status, result or error} of every job
+	"""
+	settings = load_manifest(manifest) if isinstance(manifest, str) else manifest
+	output = settings.get('output', 'batch_results')
+	if n_workers is None:
+		n_workers = int(settings.get('workers', 1))
+	jobs = expand_manifest(settings)
+	for directory in ['results'] + (['plots'] if any('outname' in job for job in jobs) else []):
+		if not os.path.exists(os.path.join(output, directory)):
+			os.makedirs(os.path.join(output, directory))
+	with open(os.path.join(output, 'jobs.json'), 'w') as outfile:
+		json.dump(jobs, outfile, indent=3)
+
+	pending = []
+	for job in jobs:
+		if resume and os.path.exists(_result_path(output, job['id'])):
+			with open(_result_path(output, job['id'])) as result_file:
+				if json.load(result_file)['status'] == 'done':
+					continue
+		pending.append(job)
+	print("Batch: %d jobs, %d finished, %d to run" % (len(jobs), len(jobs) - len(pending), len(pending)))
+
+	groups = {}
+	for job in pending:
+		groups.setdefault(_design_key(job), []).append(job)
+	groups = [(output, group) for group in groups.values()]
+	n_done = len(jobs) - len(pending)
+	if n_workers > 1 and len(groups) > 1:
+		pool = Pool(min(n_workers, len(groups)))
+		try:
+			for finished in pool.imap_unordered(_run_job_group, groups):
+				for job_id, status in finished:
+					n_done += 1
+					print("[%d/%d] %s %s" % (n_done, len(jobs), job_id, status))
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		for group in groups:
+			for job_id, status in _run_job_group(group):
+				n_done += 1
+				print("[%d/%d] %s %s" % (n_done, len(jobs), job_id, status))
+
+	records = []
+	for job in jobs:
+		with open(_result_path(output, job['id'])) as result_file:
+			records.append(json.load(result_file))
+	with open(os.path.join(output, 'summary.json'), 'w') as outfile:
+		json.dump(records, outfile, indent=3)
+	return records
@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+
+from __future__ import division
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy.stats import f, ks_2samp, norm
+
+from simcosinor import reference as baseline
+from simcosinor.cynumstats import cy_lin_lstsqr_mat_residual
+from simcosinor.functions import glm_cosinor, cached_lstsqr_residual, dummy_code_cosine, periodogram, lomb_scargle, sliding_window_cosinor, multi_roi_permutation, permute_cosinor, simulate_cosinor_batch, fit_extended_cosinor, antilogistic_cosinor, extended_cosinor_start, robust_lstsqr, robust_weights, cosinor_power, fdr_correction, vertexwise_cosinor, acrophase_to_hours, FLOAT32_TOLERANCE, EXTENDED_COSINOR_MAX_BETA
+from simcosinor.online import OnlineCosinor
+from simcosinor.store import ResultStore
+
+# Maximum errors of each engine against its reference. The references are the baseline implementations in simcosinor.reference; engines without a baseline are compared to a direct implementation with numpy or scipy. Errors are relative to the largest reference value of each output (see relative_error), and acrophases are compared on the circle (see circular_error). Permutation p-values may differ by one exceedance; the median extended cosinor fit may have at most 1e-4 more residual sum of squares than the reference optimiser with the same bounds of ALPHA and BETA. The batched simulations are random, so their distributions are compared to the simulations of the baseline run_cosinor_simulation as standard normal scores (see simulation_scores).
+TOLERANCES = {'cy_lin_lstsqr_mat_residual': 1e-8,
+					'cached_lstsqr_residual': 1e-8,
+					'glm_cosinor': 1e-8,
+					'glm_cosinor_float32': max(FLOAT32_TOLERANCE.values()),
+					'glm_cosinor_missing': 1e-8,
+					'periodogram': 1e-8,
+					'lomb_scargle': 1e-8,
+					'lomb_scargle_fft': 1e-3,
+					'sliding_window_cosinor': 1e-8,
+					'multi_roi_permutation': 1e-8,
+					'permute_cosinor': 1e-8,
+					'simulate_cosinor_batch': 4.0,
+					'fit_extended_cosinor': 1e-4,
+					'robust_lstsqr': 1e-4,
+					'OnlineCosinor': 1e-8,
+					'cosinor_power': 4.0,
+					'fdr_correction': 1e-12,
+					'vertexwise_cosinor': 1e-8}
+
+ENGINES = list(TOLERANCES.keys())
+
+# The deliberate differences of the engines from their baseline references, and how each check allows for them.
+ALLOWANCES = {'cy_lin_lstsqr_mat_residual': "The baseline least squares kernel itself is checked against numpy's SVD solver (it is the reference of cached_lstsqr_residual).",
+					'glm_cosinor': "With covariates, R2 and Fmodel test the cosinor terms against the intercept and covariates (the baseline tested the whole model against the intercept), so R2 and Fmodel are only compared without covariates. tEXOG only has the t-values of the exog columns (the baseline counted a 1D exog variable as 3 columns, and also returned the t-values of the covariates), so it is compared with the first rows of the baseline tEXOG. The acrophases are compared on the circle (circular_error): on the boundary b = 0 of the quadrant calculation, the same acrophase may be returned as 0 or -2*pi. The baseline rounds the standard errors of the MESOR and exog variables of several variables to float32 (se_of_slope), so SE_MESOR, tMESOR and tEXOG are compared up to the float32 resolution.",
+					'glm_cosinor_float32': "float32 fits (no baseline) are compared with the float64 baseline within FLOAT32_TOLERANCE: R2 as an absolute error, the acrophases weighted by the amplitude (the acrophase of a near-zero amplitude is not resolved in float32), and without the standard errors and Fmodel of near perfect fits.",
+					'glm_cosinor_missing': "The baseline does not fit missing values, so each variable is fitted by the baseline without its missing rows.",
+					'periodogram': "Covariates are new (the baseline periodogram has none), so the periodogram is compared without covariates.",
+					'lomb_scargle': "No baseline: the power of the Lomb-Scargle periodogram is the R2 of the baseline cosinor model at each of its periods (absolute error).",
+					'lomb_scargle_fft': "As lomb_scargle, with the approximate (extirpolated FFT) trigonometric sums.",
+					'sliding_window_cosinor': "The p-values are computed in log space: where the baseline -log10 p-value is infinite (the p-value underflows), the engine must be above -log10 of the smallest positive float. Compared without covariates.",
+					'multi_roi_permutation': "The engine permutes the data rather than the design, so it is given the inverse (argsort) of each permutation that the baseline permute_cosinor draws. Freedman-Lane permutations with covariates have no baseline, so the check is without covariates.",
+					'permute_cosinor': "As multi_roi_permutation: the permutation p of the data is the baseline permutation argsort(p) of the design.",
+					'simulate_cosinor_batch': "The simulations are random, so the distributions of R2 and Fmodel are compared with the baseline run_cosinor_simulation (see simulation_scores). Compared without covariates.",
+					'fit_extended_cosinor': "No baseline: compared with scipy.optimize.least_squares with the same bounds.",
+					'robust_lstsqr': "No baseline: compared with an iteratively reweighted numpy least squares loop.",
+					'OnlineCosinor': "Compared with the baseline glm_cosinor of all the samples without forgetting.",
+					'cosinor_power': "No baseline: the analytic power is compared with the rejection rate of the baseline F-test of 4000 simulated fits as a standard normal score (the noise is scaled to a noncentrality of 6, so that the power is neither 0 nor 1).",
+					'fdr_correction': "No baseline: compared with a loop over the ranks of the Benjamini-Hochberg step-up, on p-values with ties and missing tests.",
+					'vertexwise_cosinor': "Compared with glm_cosinor and multi_roi_permutation of the same array in memory with the same permutations, and the FDR corrected p-values with fdr_correction. The maps are fitted in chunks of three columns and read back from the reopened ResultStore."}
+
+# engines that are checked on the designs without covariates (see ALLOWANCES)
+NO_COVARIATE_ENGINES = ['glm_cosinor_missing', 'periodogram', 'lomb_scargle', 'lomb_scargle_fft', 'sliding_window_cosinor', 'multi_roi_permutation', 'permute_cosinor', 'simulate_cosinor_batch', 'robust_lstsqr', 'OnlineCosinor', 'cosinor_power']
+
+def random_design(rng, n_rois = 8, covariates = None, extended = False):
+	"""
+	A random design that stresses the engines: uneven time points over one to three days, one or two periods, several ROIs with a range of noise levels, amplitudes from near zero (1e-6) upwards, acrophases on the quadrant boundaries of the acrophase calculation, and optional continuous covariates.
+
+	Parameters
+	----------
+	rng : Generator
+		numpy random generator
+	n_rois : int
+		The number of ROIs
+	covariates : bool
+		[optional] Add covariates (default: random)
+	extended : bool
+		Simulate rhythms of the anti-logistic extended cosinor with a single period
+
+	Returns
+	---------
+	design : dict
+		endog (Nsubjects, Nrois), time_variable, period, dmy_covariates (or None) and the true AMPLITUDE and ACROPHASE_24 (Nperiods, Nrois)
+	"""
+	n = int(rng.integers(24, 120))
+	time_variable = np.sort(rng.uniform(0, 24 * int(rng.integers(1, 4)), n))
+	if extended:
+		period = [24.0]
+	else:
+		period = [[24.0], [24.0, 12.0], [20.0], [24.0, 8.0]][int(rng.integers(0, 4))]
+	AMPLITUDE = rng.choice([1e-6, 1e-3, 0.1, 1., 5.], size = (len(period), n_rois))
+	# acrophases on (and near) the boundaries of the quadrants
+	ACROPHASE_24 = np.array([rng.choice([0., 0.25, 0.5, 0.75, rng.uniform()], size = n_rois) * per for per in period])
+	noise_std = rng.choice([0.01, 0.5, 2.], size = n_rois)
+	MESOR = rng.uniform(-10, 10, n_rois)
+	if extended:
+		params = np.array([MESOR, AMPLITUDE[0] + 1, rng.uniform(-0.6, 0.6, n_rois), rng.uniform(1, 10, n_rois), ACROPHASE_24[0]])
+		endog = antilogistic_cosinor(time_variable, params, period[0])
+	else:
+		endog = MESOR + np.sum([AMPLITUDE[j] * np.cos(2*np.pi*(time_variable[:,np.newaxis] - ACROPHASE_24[j]) / per) for j, per in enumerate(period)], 0)
+	endog = endog + rng.standard_normal((n, n_rois)) * noise_std
+	if covariates is None:
+		covariates = rng.uniform() < 0.5
+	dmy_covariates = None
+	if covariates:
+		dmy_covariates = rng.standard_normal((n, 2))
+		dmy_covariates -= dmy_covariates.mean(0)
+		endog = endog + np.dot(dmy_covariates, rng.standard_normal((2, n_rois)))
+	return {'endog': endog, 'time_variable': time_variable, 'period': period, 'dmy_covariates': dmy_covariates, 'AMPLITUDE': AMPLITUDE, 'ACROPHASE_24': ACROPHASE_24}
+
+
+def relative_error(reference, fast):
+	"""
+	The maximum absolute difference relative to the largest absolute reference value (NaNs must match).
+	"""
+	reference = np.asarray(reference, dtype = np.float64)
+	fast = np.asarray(fast, dtype = np.float64)
+	if not np.array_equal(np.isnan(reference), np.isnan(fast)):
+		return np.inf
+	valid = ~np.isnan(reference)
+	if not valid.any():
+		return 0.
+	return np.max(np.abs(fast[valid] - reference[valid])) / max(np.max(np.abs(reference[valid])), 1e-300)
+
+
+def acrophase_error(AMPLITUDE, reference, fast, period = None):
+	"""
+	The difference of the acrophases on the circle weighted by the amplitude, relative to the largest amplitude. With period, the acrophases are in hours; otherwise in radians.
+	"""
+	scale = 2*np.pi if period is None else np.asarray(period, dtype = np.float64).reshape(-1, *([1] * (np.ndim(reference) - 1)))
+	difference = np.angle(np.exp(1j * 2*np.pi * (np.asarray(fast) - np.asarray(reference)) / scale))
+	AMPLITUDE = np.abs(np.asarray(AMPLITUDE, dtype = np.float64))
+	return np.max(AMPLITUDE * np.abs(difference)) / max(np.max(AMPLITUDE), 1e-300)
+
+
+def circular_error(reference, fast, period = None):
+	"""
+	The maximum absolute difference of the acrophases on the circle in radians (e.g., -2*pi and 0 are the same phase). With period, the acrophases are in hours.
+	"""
+	scale = 2*np.pi if period is None else np.asarray(period, dtype = np.float64).reshape(-1, *([1] * (np.ndim(reference) - 1)))
+	difference = np.angle(np.exp(1j * 2*np.pi * (np.asarray(fast, dtype = np.float64) - np.asarray(reference, dtype = np.float64)) / scale))
+	return np.max(np.abs(difference))
+
+
+def _timed(function, *args, **kwargs):
+	start = time.perf_counter()
+	result = function(*args, **kwargs)
+	return result, time.perf_counter() - start
+
+
+def reference_lstsqr(exog_vars, endog):
+	"""
+	Least squares of each variable with numpy's SVD solver.
+
+	Returns
+	---------
+	a : array
+		Coefficients (Kvariables, Nvariables)
+	SS_Residuals : array
+		Residual sum of squares (Nvariables)
+	"""
+	endog = np.asarray(endog, dtype = np.float64).reshape(len(endog), -1)
+	a = np.zeros((exog_vars.shape[1], endog.shape[1]))
+	SS_Residuals = np.zeros(endog.shape[1])
+	for j in range(endog.shape[1]):
+		a[:,j] = np.linalg.lstsq(exog_vars, endog[:,j], rcond = None)[0]
+		SS_Residuals[j] = np.sum((endog[:,j] - np.dot(exog_vars, a[:,j]))**2)
+	return (a, SS_Residuals)
+
+
+# outputs of the baseline glm_cosinor that are rounded to float32 (see ALLOWANCES)
+_FLOAT32_OUTPUTS = ['SE_MESOR', 'tMESOR', 'tEXOG']
+
+_COSINOR_OUTPUTS = ['R2', 'MESOR', 'SE_MESOR', 'AMPLITUDE', 'SE_AMPLITUDE', 'ACROPHASE', 'SE_ACROPHASE', 'Fmodel', 'tMESOR', 'tAMPLITUDE', 'tACROPHASE']
+
+def _cosinor_errors(reference_results, fast_results, covariates = False):
+	"""
+	The errors of the outputs of glm_cosinor against the baseline glm_cosinor (see ALLOWANCES).
+	"""
+	errors = {}
+	for index, name in enumerate(_COSINOR_OUTPUTS):
+		if covariates and name in ['R2', 'Fmodel']:
+			continue
+		if name == 'ACROPHASE':
+			errors[name] = circular_error(reference_results[index], fast_results[index])
+		else:
+			errors[name] = relative_error(reference_results[index], fast_results[index])
+	return _float32_resolution(errors)
+
+
+def _float32_resolution(errors):
+	# the errors of the outputs that the baseline rounds to float32 less the float32 resolution
+	for name in _FLOAT32_OUTPUTS:
+		if name in errors:
+			errors[name] = max(errors[name] - np.finfo(np.float32).eps, 0.)
+	return errors
+
+
+def _baseline_permutations(n, n_perm, seed):
+	# the permutations that the baseline permute_cosinor draws after np.random.seed(seed)
+	np.random.seed(seed)
+	return np.array([np.random.permutation(list(range(n))) for i in range(n_perm)])
+
+
+def simulation_scores(reference, fast):
+	"""
+	Compares two samples of simulated statistics as standard normal scores: the difference of the means relative to its standard error, and the two-sample Kolmogorov-Smirnov test of the distributions (the normal score of its p-value).
+
+	Returns
+	---------
+	mean_score : float
+		|z| of the difference of the means
+	ks_score : float
+		The two-sided normal score of the Kolmogorov-Smirnov p-value
+	"""
+	reference = np.asarray(reference, dtype = np.float64)
+	fast = np.asarray(fast, dtype = np.float64)
+	standard_error = np.sqrt(np.var(reference, ddof = 1) / len(reference) + np.var(fast, ddof = 1) / len(fast))
+	mean_score = np.abs(np.mean(fast) - np.mean(reference)) / max(standard_error, 1e-300)
+	ks_score = norm.isf(ks_2samp(reference, fast).pvalue / 2)
+	return (mean_score, ks_score)
+
+
+def check_engine(engine, design, rng):
+	"""
+	Runs an engine and its reference on a design.
+
+	Returns
+	---------
+	errors : dict
+		The error of each output (see relative_error)
+	reference_time : float
+		Seconds of the reference
+	fast_time : float
+		Seconds of the engine
+	"""
+	endog, time_variable, period, dmy_covariates = design['endog'], design['time_variable'], design['period'], design['dmy_covariates']
+	n, num_roi = endog.shape
+	exog_vars = dummy_code_cosine(time_variable, period, dmy_covariates)
+
+	if engine == 'cy_lin_lstsqr_mat_residual':
+		reference, reference_time = _timed(reference_lstsqr, exog_vars, endog)
+		fast, fast_time = _timed(cy_lin_lstsqr_mat_residual, exog_vars, endog)
+		errors = {'a': relative_error(reference[0], fast[0]), 'SS_Residuals': relative_error(reference[1], fast[1])}
+	elif engine == 'cached_lstsqr_residual':
+		reference, reference_time = _timed(cy_lin_lstsqr_mat_residual, exog_vars, endog)
+		fast, fast_time = _timed(cached_lstsqr_residual, exog_vars, endog)
+		errors = {'a': relative_error(reference[0], fast[0]), 'SS_Residuals': relative_error(reference[1], fast[1])}
+	elif engine == 'glm_cosinor':
+		reference, reference_time = _timed(baseline.glm_cosinor, endog, time_variable, dmy_covariates = dmy_covariates, period = period)
+		fast, fast_time = _timed(glm_cosinor, endog, time_variable, dmy_covariates = dmy_covariates, period = period)
+		errors = _cosinor_errors(reference, fast, covariates = dmy_covariates is not None)
+		# the t-values of an exog variable (a 1D variable is a single column)
+		exog = [rng.standard_normal(n)]
+		reference_tEXOG = baseline.glm_cosinor(endog, time_variable, exog = exog, dmy_covariates = dmy_covariates, period = period)[11]
+		fast_tEXOG = glm_cosinor(endog, time_variable, exog = exog, dmy_covariates = dmy_covariates, period = period)[11]
+		errors['tEXOG'] = relative_error(reference_tEXOG[:len(fast_tEXOG)], fast_tEXOG)
+		errors = _float32_resolution(errors)
+	elif engine == 'glm_cosinor_float32':
+		reference, reference_time = _timed(baseline.glm_cosinor, endog, time_variable, dmy_covariates = dmy_covariates, period = period)
+		fast, fast_time = _timed(glm_cosinor, endog, time_variable, dmy_covariates = dmy_covariates, period = period, dtype = np.float32)
+		errors = {'MESOR': relative_error(reference[1], fast[1]),
+					'AMPLITUDE': relative_error(reference[3], fast[3]),
+					'ACROPHASE': acrophase_error(reference[3], reference[5], fast[5])}
+		if dmy_covariates is None:
+			errors['R2'] = np.max(np.abs(reference[0] - fast[0]))
+	elif engine == 'glm_cosinor_missing':
+		endog = endog.copy()
+		endog[rng.uniform(size = endog.shape) < 0.1] = np.nan
+		endog[:, 0] = design['endog'][:, 0]
+		def reference_missing():
+			columns = []
+			for j in range(num_roi):
+				rows = ~np.isnan(endog[:,j])
+				columns.append(baseline.glm_cosinor(endog[rows, j:j+1], time_variable[rows], period = period))
+			return [np.concatenate([column[index] for column in columns], axis = -1) for index in range(len(_COSINOR_OUTPUTS))]
+		reference, reference_time = _timed(reference_missing)
+		fast, fast_time = _timed(glm_cosinor, endog, time_variable, period = period)
+		errors = _cosinor_errors(reference, fast)
+	elif engine == 'periodogram':
+		reference, reference_time = _timed(baseline.periodogram, endog[:,:1], time_variable, periodrange = [6, 29], step = 1.0)
+		fast, fast_time = _timed(periodogram, endog[:,:1], time_variable, periodrange = [6, 29], step = 1.0)
+		errors = {'periods': relative_error(reference[0], fast[0]), 'R2': relative_error(np.ravel(reference[1]), fast[1])}
+	elif engine in ['lomb_scargle', 'lomb_scargle_fft']:
+		fast, fast_time = _timed(lomb_scargle, endog, time_variable, periodrange = [6, 30], use_fft = engine == 'lomb_scargle_fft')
+		reference, reference_time = _timed(lambda: np.array([baseline.glm_cosinor(endog, time_variable, period = [per])[0] for per in fast[0]]))
+		errors = {'R2': np.max(np.abs(reference - fast[1]))}
+	elif engine == 'sliding_window_cosinor':
+		subset_size = int(max(3 + 2*len(period), min(24, n // 2)))
+		reference, reference_time = _timed(baseline.sliding_window_cosinor, endog[:,:1], time_variable, subset_size = subset_size, period = period)
+		fast, fast_time = _timed(sliding_window_cosinor, endog[:,:1], time_variable, subset_size = subset_size, period = period)
+		shape = np.shape(reference[3])
+		underflow = np.isinf(reference[5])
+		errors = {'steps': relative_error(reference[0], fast[0]),
+					'R2': relative_error(reference[1], fast[1]),
+					'MESOR': relative_error(reference[2], fast[2]),
+					'AMPLITUDE': relative_error(reference[3], np.reshape(fast[3], shape)),
+					'ACROPHASE_24': circular_error(np.reshape(reference[4], shape).T, np.reshape(fast[4], shape).T, period),
+					'neglog10p': relative_error(reference[5][~underflow], fast[5][~underflow]),
+					'neglog10p_underflow': float(np.sum(fast[5][underflow] <= -np.log10(np.finfo(np.float64).tiny)))}
+	elif engine == 'permute_cosinor':
+		n_perm = 200
+		seed = int(rng.integers(2**31))
+		state = np.random.get_state()
+		resids = baseline.residual_cosinor(endog, time_variable, period = period)
+		permutations = _baseline_permutations(n, n_perm, seed)
+		reference, reference_time = _timed(lambda: np.array([baseline.glm_cosinor(resids, time_variable, rand_array = np.argsort(permutation), period = period)[7] for permutation in permutations]))
+		np.random.seed(seed)
+		fast, fast_time = _timed(lambda: np.array([permute_cosinor(endog = resids, time_variable = time_variable, period = period, iterator = i) for i in range(n_perm)]))
+		np.random.set_state(state)
+		errors = {'Fnull': relative_error(reference, fast)}
+	elif engine == 'multi_roi_permutation':
+		n_perm = 200
+		seed = int(rng.integers(2**31))
+		state = np.random.get_state()
+		def reference_permutation():
+			Fmodel = baseline.glm_cosinor(endog, time_variable, period = period)[7]
+			resids = baseline.residual_cosinor(endog, time_variable, period = period)
+			np.random.seed(seed)
+			Fnull = np.array([baseline.permute_cosinor(resids, time_variable, period, i) for i in range(n_perm)])
+			p_uncorrected = (np.sum(Fnull >= Fmodel, 0) + 1) / (n_perm + 1)
+			p_fwer = (np.sum(Fnull.max(1)[:,np.newaxis] >= Fmodel, 0) + 1) / (n_perm + 1)
+			return (Fmodel, p_uncorrected, p_fwer, Fnull.max(1))
+		reference, reference_time = _timed(reference_permutation)
+		permutations = np.argsort(_baseline_permutations(n, n_perm, seed), 1)
+		np.random.set_state(state)
+		fast, fast_time = _timed(multi_roi_permutation, endog, time_variable, period = period, permutations = permutations)
+		# p-values may differ by one exceedance of F-values that are equal within rounding
+		one_exceedance = 1. / (n_perm + 1)
+		errors = {'Fmodel': relative_error(reference[0], fast[0]),
+					'max_Fnull': relative_error(reference[3], fast[4]),
+					'p_uncorrected': max(np.max(np.abs(reference[1] - fast[1])) - one_exceedance, 0),
+					'p_fwer': max(np.max(np.abs(reference[2] - fast[2])) - one_exceedance, 0)}
+	elif engine == 'simulate_cosinor_batch':
+		# the simulations of the first ROI with fixed or randomised time points are compared as distributions
+		n_simulations = 500
+		randomise_time = bool(rng.uniform() < 0.5)
+		state = np.random.get_state()
+		np.random.seed(int(rng.integers(2**31)))
+		def reference_simulations():
+			results = [baseline.run_cosinor_simulation(endog[:,0], time_variable, period = period, randomise_time = randomise_time) for i in range(n_simulations)]
+			return (np.array([r[0] for r in results]), np.array([r[1] for r in results]))
+		reference, reference_time = _timed(reference_simulations)
+		fast, fast_time = _timed(simulate_cosinor_batch, endog[:,0], time_variable, period = period, n_simulations = n_simulations, randomise_time = randomise_time)
+		np.random.set_state(state)
+		errors = {}
+		for name, reference_sample, fast_sample in [('R2', reference[0], fast[0]), ('Fmodel', reference[1], fast[1])]:
+			errors[name + '_mean'], errors[name + '_distribution'] = simulation_scores(reference_sample, fast_sample)
+	elif engine == 'fit_extended_cosinor':
+		from scipy.optimize import least_squares
+		initial = extended_cosinor_start(endog, time_variable, period[0])
+		bounds = ([-np.inf, -np.inf, -1, -EXTENDED_COSINOR_MAX_BETA, -np.inf], [np.inf, np.inf, 1, EXTENDED_COSINOR_MAX_BETA, np.inf])
+		def reference_extended():
+			SS_Residuals = np.zeros(num_roi)
+			for j in range(num_roi):
+				fit = least_squares(lambda params: antilogistic_cosinor(time_variable, params, period[0])[:,0] - endog[:,j], initial[:,j], bounds = bounds)
+				SS_Residuals[j] = np.sum(fit.fun**2)
+			return SS_Residuals
+		reference, reference_time = _timed(reference_extended)
+		fast, fast_time = _timed(fit_extended_cosinor, endog, time_variable, period[0])
+		SS_Residuals = np.sum((endog - antilogistic_cosinor(time_variable, fast[1], period[0]))**2, 0)
+		# the fits may only be worse than the reference optimiser within the tolerance. The model is not convex, so a few fits of noisy data may reach another local minimum than the reference from the same start, and the median over the ROIs is checked.
+		errors = {'SS_Residuals': max(np.median((SS_Residuals - reference) / reference), 0)}
+	elif engine == 'robust_lstsqr':
+		endog = endog.copy()
+		endog[rng.integers(0, n, 2)] += 20 * endog.std(0)
+		def reference_robust():
+			a = np.zeros((exog_vars.shape[1], num_roi))
+			for j in range(num_roi):
+				coef = np.linalg.lstsq(exog_vars, endog[:,j], rcond = None)[0]
+				for iteration in range(200):
+					resids = endog[:,j] - np.dot(exog_vars, coef)
+					scale = max(1.4826 * np.median(np.abs(resids - np.median(resids))), 1e-12 * (1 + np.abs(endog[:,j]).max()))
+					root_weights = np.sqrt(robust_weights(resids / scale, 'huber'))
+					new_coef = np.linalg.lstsq(exog_vars * root_weights[:,np.newaxis], endog[:,j] * root_weights, rcond = None)[0]
+					converged = np.max(np.abs(new_coef - coef)) <= 1e-10 * scale
+					coef = new_coef
+					if converged:
+						break
+				a[:,j] = coef
+			return a
+		reference, reference_time = _timed(reference_robust)
+		fast, fast_time = _timed(robust_lstsqr, exog_vars, endog, method = 'huber')
+		errors = {'a': relative_error(reference, fast[0])}
+	elif engine == 'OnlineCosinor':
+		reference, reference_time = _timed(baseline.glm_cosinor, endog, time_variable, period = period)
+		def online():
+			model = OnlineCosinor(n_variables = num_roi, period = period)
+			for start in range(0, n, 7):
+				model.update(time_variable[start:start+7], endog[start:start+7])
+			return model.estimates()
+		fast, fast_time = _timed(online)
+		errors = {'R2': relative_error(reference[0], fast[0]),
+					'MESOR': relative_error(reference[1], fast[1]),
+					'AMPLITUDE': relative_error(reference[3], fast[2]),
+					'ACROPHASE_24': acrophase_error(reference[3], acrophase_to_hours(reference[5], period), fast[3], period),
+					'Fmodel': relative_error(reference[7], fast[4])}
+	elif engine == 'cosinor_power':
+		n_simulations = 4000
+		AMPLITUDE = np.ones(len(period))
+		ACROPHASE24 = design['ACROPHASE_24'][:,0]
+		noise_std = float(np.sqrt(cosinor_power(time_variable, AMPLITUDE, ACROPHASE24, 1.0, period = period)[1] / 6.))
+		fast, fast_time = _timed(cosinor_power, time_variable, AMPLITUDE, ACROPHASE24, noise_std, period = period)
+		def reference_power():
+			signal = np.sum([AMPLITUDE[j] * np.cos(2*np.pi*(time_variable - ACROPHASE24[j]) / per) for j, per in enumerate(period)], 0)
+			Fmodel = baseline.glm_cosinor(signal[:,np.newaxis] + rng.standard_normal((n, n_simulations)) * noise_std, time_variable, period = period)[7]
+			return np.mean(Fmodel > f.isf(0.05, 2*len(period), n - 1 - 2*len(period)))
+		reference, reference_time = _timed(reference_power)
+		errors = {'power': np.abs(reference - fast[0]) / np.sqrt(fast[0] * (1 - fast[0]) / n_simulations)}
+	elif engine == 'fdr_correction':
+		p_values = np.round(rng.uniform(size = (n, 3))**2, 2)
+		p_values[rng.uniform(size = p_values.shape) < 0.1] = np.nan
+		def reference_fdr():
+			p_adjusted = np.full(p_values.shape, np.nan)
+			for j in range(p_values.shape[1]):
+				tested = np.flatnonzero(~np.isnan(p_values[:,j]))
+				order = tested[np.argsort(p_values[tested,j], kind = 'stable')]
+				running_min = 1.
+				for rank in range(len(order), 0, -1):
+					running_min = min(running_min, p_values[order[rank-1],j] * len(order) / rank)
+					p_adjusted[order[rank-1],j] = running_min
+			return p_adjusted
+		reference, reference_time = _timed(reference_fdr)
+		fast, fast_time = _timed(fdr_correction, p_values, q = 0.05)
+		errors = {'p_adjusted': relative_error(reference, fast[0]),
+					'rejected': float(np.sum((reference <= 0.05) != fast[1]))}
+	elif engine == 'vertexwise_cosinor':
+		n_perm = 100
+		seed = int(rng.integers(2**31))
+		state = np.random.get_state()
+		outdir = tempfile.mkdtemp()
+		try:
+			np.random.seed(seed)
+			# the memory budget of three columns (see vertexwise_cosinor)
+			memory_budget = 3 * (8*8 + 3*100*8) * n / 2.**20
+			_, fast_time = _timed(vertexwise_cosinor, endog, time_variable, os.path.join(outdir, 'maps'), period = period, dmy_covariates = dmy_covariates, memory_budget = memory_budget, n_perm = n_perm)
+			store = ResultStore(os.path.join(outdir, 'maps'))
+			fast = dict((name, np.array(store[name])) for name in store.keys())
+		finally:
+			shutil.rmtree(outdir)
+		np.random.seed(seed)
+		permutations = np.array([np.random.permutation(n) for i in range(n_perm)])
+		np.random.set_state(state)
+		def reference_maps():
+			results = glm_cosinor(endog, time_variable, dmy_covariates = dmy_covariates, period = period)
+			return (results, multi_roi_permutation(endog, time_variable, period = period, dmy_covariates = dmy_covariates, permutations = permutations))
+		(results, permuted), reference_time = _timed(reference_maps)
+		errors = {'R2': relative_error(results[0], fast['R2']),
+					'MESOR': relative_error(results[1], fast['MESOR']),
+					'AMPLITUDE': relative_error(results[3], fast['AMPLITUDE'].T),
+					'ACROPHASE_24': circular_error(acrophase_to_hours(results[5], period), fast['ACROPHASE_24'].T, period),
+					'Fmodel': relative_error(results[7], fast['Fmodel']),
+					'p_uncorrected': relative_error(permuted[1], fast['p_uncorrected']),
+					'p_fwer': relative_error(permuted[2], fast['p_fwer']),
+					'p_fdr': relative_error(fdr_correction(permuted[1])[0], fast['p_fdr']),
+					'max_Fnull': relative_error(np.sort(permuted[4]), fast['max_Fnull'])}
+	else:
+		raise ValueError("Error: unknown engine %s" % engine)
+	return (errors, reference_time, fast_time)
+
+
+def run_equivalence(n_designs = 10, seed = 0, engines = None, n_rois = 8, outname = None, strict = True):
+	"""
+	Equivalence harness of the numerical engines against the baseline implementations of simcosinor.reference on random designs (see random_design). The deliberate differences of each engine from its baseline are documented in ALLOWANCES. Each engine is checked on every design, its maximum errors are compared to TOLERANCES, and the speedup over the reference is recorded. The batched simulations are random and are checked as distributions (see simulation_scores).
+
+	Parameters
+	----------
+	n_designs : int
+		The number of random designs
+	seed : int
+		Seed of the designs
+	engines : list
+		[optional] Engines to check (default: ENGINES)
+	n_rois : int
+		The number of ROIs of each design
+	outname : string
+		[optional] Save the report (*.csv)
+	strict : bool
+		Raise an AssertionError if an engine exceeds its tolerance
+
+	Returns
+	---------
+	report : DataFrame
+		A row for each engine and output: the maximum error, the tolerance, passed, and the total seconds of the reference and the engine and their ratio (speedup)
+	"""
+	if engines is None:
+		engines = ENGINES
+	rng = np.random.default_rng(seed)
+	rows = {}
+	times = {}
+	for design_index in range(n_designs):
+		design = random_design(rng, n_rois = n_rois)
+		extended_design = random_design(rng, n_rois = n_rois, covariates = False, extended = True)
+		for engine in engines:
+			engine_design = design
+			if engine == 'fit_extended_cosinor':
+				engine_design = extended_design
+			elif engine in NO_COVARIATE_ENGINES:
+				engine_design = dict(design, dmy_covariates = None)
+				if engine in ['lomb_scargle', 'lomb_scargle_fft']:
+					engine_design['period'] = [24.0]
+			errors, reference_time, fast_time = check_engine(engine, engine_design, rng)
+			reference_total, fast_total = times.get(engine, (0., 0.))
+			times[engine] = (reference_total + reference_time, fast_total + fast_time)
+			for output in errors:
+				rows[(engine, output)] = max(rows.get((engine, output), 0.), errors[output])
+	report = pd.DataFrame([{'engine': engine,
+									'output': output,
+									'max_error': rows[(engine, output)],
+									'tolerance': TOLERANCES[engine],
+									'passed': rows[(engine, output)] <= TOLERANCES[engine],
+									'reference_seconds': times[engine][0],
+									'fast_seconds': times[engine][1],
+									'speedup': times[engine][0] / max(times[engine][1], 1e-9)} for engine, output in rows])
+	if outname is not None:
+		report.to_csv(outname, index = False)
+	if strict:
+		failed = report[~report['passed']]
+		assert len(failed) == 0, "Error: engines exceed their tolerance:\n%s" % failed.to_string(index = False)
+	return report
@@ -4,13 +4,22 @@ from __future__ import division
 import os
 import sys
 import json
+import hashlib
 import numpy as np
 import pandas as pd
-from simcosinor.cynumstats import cy_lin_lstsqr_mat_residual, cy_lin_lstsqr_mat, se_of_slope
-from scipy.stats import t, f, norm
-from matplotlib import pyplot as plt
+import scipy.sparse
+from simcosinor.cynumstats import cy_lin_lstsqr_mat_residual, cy_lin_lstsqr_mat
+from simcosinor.profiling import profile_stage
+from simcosinor.store import ResultStore
+from scipy.stats import t, f, norm, ncf
+from scipy.special import gammaln, betaln, expit
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.collections import LineCollection
 from matplotlib.ticker import StrMethodFormatter
 import matplotlib.patches as mpatches
+from multiprocessing import Pool
 
 
 class CosinorExamples:
@@ -19,7 +28,7 @@ class CosinorExamples:
 	modality3_subjects_normed = "%s/simcosinor/examples/examples_subjects_norm_modality_3.csv" % os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 	modality4_subjects_normed = "%s/simcosinor/examples/examples_subjects_norm_modality_4.csv" % os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
-def run_cosinor_simulation(endog, time_variable, period = [24.0], resids = None, randomise_time = False, resample_eveningly = False, n_sampling = None, range_sampling = None, i = 0):
+def run_cosinor_simulation(endog, time_variable, period = [24.0], resids = None, randomise_time = False, resample_eveningly = False, n_sampling = None, range_sampling = None, i = 0, dmy_covariates = None):
 
 	"""
 	Cosinor simulations. The MESOR, amplitude, and acrophase are determined from real data. Simulated data are calculated by adding random gaussian noise to the projected cosinor model. For estimationg of the noise, the residuals from cosinor model are used to determine the mean, and standard deviation. 
@@ -44,6 +53,8 @@ def run_cosinor_simulation(endog, time_variable, period = [24.0], resids = None,
 		The time range for simulating [start, stop]
 	i : int
 		Iterator for parallel processing.
+	dmy_covariates : array
+		[optional] Dummy coded covariates of no interest. The true model and the noise are estimated from the joint model. The covariates are included in the simulated fits unless the time points are randomised.
 	Returns
 	---------
 	sim_R2 : float
@@ -61,7 +72,6 @@ def run_cosinor_simulation(endog, time_variable, period = [24.0], resids = None,
 	n = len(endog)
 	k = len(period)*2 + 1
 	DF_Between = k - 1 # aka df model
-	DF_Within = n - k # aka df residuals
 
 	# Check that endog has two dimensions
 	if endog.ndim == 1:
@@ -69,11 +79,12 @@ def run_cosinor_simulation(endog, time_variable, period = [24.0], resids = None,
 
 	# calculate residuals from cosinor model if not already provided
 	if resids is None:
-		resids = residual_cosinor(endog = endog, time_var = time_variable, period = period)
+		resids = residual_cosinor(endog = endog, time_var = time_variable, period = period, dmy_covariates = dmy_covariates)
 
 	# Calculate true Mesor, Amplitude, Acrophase
 	MESOR, AMPLITUDE, ACROPHASE = glm_cosinor(endog = endog, 
 															time_var = time_variable,
+															dmy_covariates = dmy_covariates,
 															period = period,
 															calc_MESOR = True,
 															output_fit_only = True)
@@ -87,12 +98,17 @@ def run_cosinor_simulation(endog, time_variable, period = [24.0], resids = None,
 			time_variable = np.linspace(range_sampling[0],range_sampling[1],n_sampling)
 		else:
 			time_variable = np.sort(np.random.uniform(low=range_sampling[0], high=range_sampling[1], size=(n_sampling,)))
+		# the covariates are not defined for the simulated time points
+		dmy_covariates = None
 	else:
 		n_sampling = n
+	DF_Within = n_sampling - k # aka df residuals
+	if dmy_covariates is not None:
+		DF_Within -= np.asarray(dmy_covariates).reshape(n,-1).shape[1]
 
-	# the mean and std of for the noise is calculated from the residuals
-	noise_mean = resids.mean()
-	noise_std = resids.std()
+	# the mean and std of for the noise is calculated from the residuals (without missing values)
+	noise_mean = np.nanmean(resids)
+	noise_std = np.nanstd(resids)
 	noise_npts = n_sampling
 	noise = np.random.normal(noise_mean, noise_std, noise_npts).reshape(noise_npts,1)
 
@@ -101,6 +117,7 @@ def run_cosinor_simulation(endog, time_variable, period = [24.0], resids = None,
 	sim_endog = noise + predicted
 	sim_R2, sim_MESOR, _, sim_AMPLITUDE, sim_SE_AMPLITUDE, sim_ACROPHASE, sim_SE_ACROPHASE, sim_Fmodel, _, sim_tAMPLITUDE, _, _ = glm_cosinor(endog = sim_endog, 
 																time_var = time_variable,
+																dmy_covariates = dmy_covariates,
 																period = period,
 																calc_MESOR = True,
 																output_fit_only = False)
@@ -111,10 +128,356 @@ def run_cosinor_simulation(endog, time_variable, period = [24.0], resids = None,
 		acrotemp[acrotemp>per] -= per
 		ACROPHASE_24[j] = acrotemp
 
-	p_values = f.sf(sim_Fmodel, DF_Between, DF_Within)
+	p_values = 10**(-f_neglog10_pvalues(sim_Fmodel, DF_Between, DF_Within))
 	return(sim_R2.squeeze(), sim_Fmodel.squeeze(), sim_tAMPLITUDE.squeeze(), ACROPHASE_24.squeeze(), p_values.squeeze())
 
 
+def simulate_cosinor_batch(endog, time_variable, period = [24.0], n_simulations = 10000, resids = None, randomise_time = False, resample_eveningly = False, n_sampling = None, range_sampling = None, dmy_covariates = None, chunk_size = 1000, dtype = np.float64, sampling_times = None, robust = None, model = 'cosinor'):
+	"""
+	Batched cosinor simulations (see run_cosinor_simulation). All simulations are fitted at once: with fixed time points, every simulated column is solved against the same cached factorisation; with randomised time points, the normal equations of all simulations are stacked and solved together.
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array of real data.
+	time_variable : array
+		Time points.
+	period : array
+		The period(s) of the cosinor model
+	n_simulations : int
+		The number of simulations
+	resids : array
+		[optional] input precomputed residuals. Otherwise, it is calculated.
+	randomise_time : bool
+		Randomise the time points for the simulation within the sample range.
+	resample_eveningly : bool
+		The time points will be equally distributed across the sample range.
+	n_sampling : int
+		The number of time points to simulate
+	range_sampling: array
+		The time range for simulating [start, stop]
+	dmy_covariates : array
+		[optional] Dummy coded covariates of no interest (see run_cosinor_simulation).
+	chunk_size : int
+		The number of simulations with randomised time points that are solved together.
+	dtype : dtype
+		Floating point precision of the simulated data and fits (np.float32 or np.float64). With fixed time points, float32 halves the memory of the simulated data: the factorisation is calculated in float64, and the first simulations are also fitted in float64; if the float32 R2, amplitude or acrophase differ by more than FLOAT32_TOLERANCE (see float32_accuracy), all the simulations are fitted in float64. With randomised time points, the chunks are fitted in float64 and the results are stored in float32.
+	sampling_times : array
+		[optional] Simulate the model at these time points (e.g., a schedule from optimise_schedule) instead of the time points of the data. Overrides randomise_time.
+	robust : string
+		[optional] Fit the model of the real data with the robust 'huber' or 'tukey' M-estimator (see robust_lstsqr), and simulate the noise with the median and the median absolute deviation of the residuals, so that outlying scans do not distort the simulated model or inflate the noise.
+	model : string
+		'cosinor' or 'antilogistic' for the extended cosinor of rhythms with sharp or asymmetric peaks (see simulate_extended_cosinor_batch)
+	Returns
+	---------
+	sim_R2 : array
+		R-squared of the simulated models (Nsimulations)
+	sim_Fmodel : array
+		F-values of the simulated models (Nsimulations)
+	sim_tAMPLITUDE : array
+		The amplitude T-values of the simulated models (Nperiods, Nsimulations)
+	sim_ACROPHASE_24 : array
+		The acrophases of the simulated models converted to 24H from radians (Nperiods, Nsimulations)
+	sim_neglog10p : array
+		The -log10 p-values of the simulated models (Nsimulations; see f_neglog10_pvalues)
+	sim_coef : array
+		The cosinor coefficients [MESOR, beta_1, gamma_1, ...] of the simulated models (1 + 2*Nperiods, Nsimulations)
+	"""
+
+	if model == 'antilogistic':
+		return simulate_extended_cosinor_batch(endog, time_variable, period = period, n_simulations = n_simulations, resids = resids, randomise_time = randomise_time, resample_eveningly = resample_eveningly, n_sampling = n_sampling, range_sampling = range_sampling, dmy_covariates = dmy_covariates, chunk_size = chunk_size, sampling_times = sampling_times, robust = robust)
+	n = len(endog)
+	num_period = len(period)
+	k = num_period*2 + 1
+	DF_Between = k - 1 # aka df model
+
+	if endog.ndim == 1:
+		endog = endog.reshape(len(endog),1)
+	if resids is None:
+		resids = residual_cosinor(endog = endog, time_var = time_variable, period = period, dmy_covariates = dmy_covariates, robust = robust)
+	MESOR, AMPLITUDE, ACROPHASE = glm_cosinor(endog = endog, 
+															time_var = time_variable,
+															dmy_covariates = dmy_covariates,
+															period = period,
+															calc_MESOR = True,
+															output_fit_only = True,
+															robust = robust)
+	# the residuals of missing values are NaN
+	if robust is not None:
+		noise_mean = np.nanmedian(resids)
+		noise_std = 1.4826 * np.nanmedian(np.abs(resids - noise_mean))
+	else:
+		noise_mean = np.nanmean(resids)
+		noise_std = np.nanstd(resids)
+
+	if sampling_times is not None:
+		randomise_time = False
+		time_variable = np.asarray(sampling_times, dtype = np.float64)
+		n_sampling = len(time_variable)
+		dmy_covariates = None
+	elif randomise_time:
+		if n_sampling is None:
+			n_sampling = n
+		if range_sampling is None:
+			range_sampling = [0,23.99]
+		# the covariates are not defined for the simulated time points
+		dmy_covariates = None
+	else:
+		n_sampling = n
+
+	with profile_stage('simulate'):
+		if (not randomise_time) or resample_eveningly:
+			# one design for every simulation
+			if randomise_time:
+				time_variable = np.linspace(range_sampling[0],range_sampling[1],n_sampling)
+			exog_vars = dummy_code_cosine(time_variable, period, dmy_covariates)
+			dtype = precision_dtype(exog_vars, dtype)
+			predicted = project_cosionor_model(MESOR, AMPLITUDE, ACROPHASE, TIME_VAR = time_variable, PERIOD = period)
+			# the simulated data are built in place in blocks of time points (the same random numbers as a single draw), so that only one copy is in memory
+			sim_endog = np.empty((n_sampling, n_simulations), dtype = dtype)
+			block_size = max(1, 2**16 // n_simulations)
+			for row in range(0, n_sampling, block_size):
+				sim_endog[row:row + block_size] = predicted[row:row + block_size] + np.random.normal(noise_mean, noise_std, (len(sim_endog[row:row + block_size]), n_simulations))
+			if dtype == np.float32:
+				errors, within_tolerance = float32_accuracy(exog_vars, sim_endog[:,:100], period)
+				if not within_tolerance:
+					print("Warning: float32 simulations exceed the accuracy tolerance (R2 %1.1e, amplitude %1.1e, acrophase %1.1e). Using float64." % (errors['R2'], errors['AMPLITUDE'], errors['ACROPHASE']))
+					dtype = np.dtype(np.float64)
+					sim_endog = sim_endog.astype(dtype)
+			exog_vars = exog_vars.astype(dtype)
+			invXX, pinvX = cached_factorisation(exog_vars)
+			sim_coef = np.dot(pinvX, sim_endog)
+			# the residuals and deviations share one work array
+			work = np.dot(exog_vars, sim_coef)
+			np.subtract(sim_endog, work, out = work)
+			SS_Residuals = np.einsum('ns,ns->s', work, work)
+			if dmy_covariates is not None:
+				SS_Total = cached_lstsqr_residual(stack_ones(dmy_covariates), sim_endog)[1]
+			else:
+				np.subtract(sim_endog, np.mean(sim_endog,0), out = work)
+				SS_Total = np.einsum('ns,ns->s', work, work)
+			del work
+			sim_invXX = np.broadcast_to(invXX[np.newaxis,:k,:k], (n_simulations, k, k))
+			DF_Within = n_sampling - exog_vars.shape[1]
+			sim_coef = sim_coef[:k]
+		else:
+			# stacked normal equations for the randomised time points. Each chunk of designs is factorised in float64, so the chunks are fitted in float64 and only the results of all the simulations are stored in the requested precision.
+			dtype = np.dtype(dtype)
+			sim_coef = np.zeros((k, n_simulations), dtype = dtype)
+			SS_Residuals = np.zeros((n_simulations), dtype = dtype)
+			SS_Total = np.zeros((n_simulations), dtype = dtype)
+			sim_invXX = np.zeros((n_simulations, k, k), dtype = dtype)
+			for start in range(0, n_simulations, chunk_size):
+				stop = min(start + chunk_size, n_simulations)
+				n_chunk = stop - start
+				sim_time = np.sort(np.random.uniform(low=range_sampling[0], high=range_sampling[1], size=(n_chunk, n_sampling)), axis = 1)
+				exog_vars = np.empty((n_chunk, n_sampling, k))
+				exog_vars[:,:,0] = 1
+				radians = np.divide(2.0*np.pi*sim_time[:,:,np.newaxis], np.asarray(period, dtype = np.float64))
+				exog_vars[:,:,1::2] = np.cos(radians)
+				exog_vars[:,:,2::2] = np.sin(radians)
+				predicted = MESOR[0] + np.sum(AMPLITUDE[:,0]*np.cos(radians + ACROPHASE[:,0]), 2)
+				sim_endog = predicted + np.random.normal(noise_mean, noise_std, (n_chunk, n_sampling))
+				invXX = np.linalg.inv(np.einsum('snk,snl->skl', exog_vars, exog_vars))
+				coef = np.einsum('skl,sl->sk', invXX, np.einsum('snk,sn->sk', exog_vars, sim_endog))
+				sim_coef[:,start:stop] = coef.T
+				SS_Residuals[start:stop] = np.sum((sim_endog - np.einsum('snk,sk->sn', exog_vars, coef))**2,1)
+				SS_Total[start:stop] = np.sum((sim_endog - np.mean(sim_endog,1)[:,np.newaxis])**2,1)
+				sim_invXX[start:stop] = invXX
+			DF_Within = n_sampling - k
+
+		sim_R2 = 1 - (SS_Residuals/SS_Total)
+		sim_Fmodel = ((SS_Total - SS_Residuals)/DF_Between) / (SS_Residuals/DF_Within)
+		sigma = np.sqrt(SS_Residuals / DF_Within)
+		_, sim_AMPLITUDE, sim_ACROPHASE = cosinor_parameters(sim_coef, period)
+		sim_tAMPLITUDE = np.zeros((num_period, n_simulations))
+		for i in range(num_period):
+			# standard errors from error propagation (see glm_cosinor)
+			acro = np.arctan(np.abs(np.divide(-sim_coef[2+(i*2)], sim_coef[1+(i*2)])))
+			SE_AMPLITUDE = sigma * np.sqrt((sim_invXX[:,1+(i*2),1+(i*2)]*np.cos(acro)**2) - (2*sim_invXX[:,1+(i*2),2+(i*2)]*np.sin(acro)*np.cos(acro)) + (sim_invXX[:,2+(i*2),2+(i*2)]*np.sin(acro)**2))
+			sim_tAMPLITUDE[i] = np.abs(sim_AMPLITUDE[i] / SE_AMPLITUDE)
+		sim_ACROPHASE_24 = acrophase_to_hours(sim_ACROPHASE, period)
+		sim_neglog10p = f_neglog10_pvalues(sim_Fmodel, DF_Between, DF_Within)
+	return(sim_R2, sim_Fmodel, sim_tAMPLITUDE, sim_ACROPHASE_24, sim_neglog10p, sim_coef)
+
+
+def simulate_extended_cosinor_batch(endog, time_variable, period = [24.0], n_simulations = 10000, resids = None, randomise_time = False, resample_eveningly = False, n_sampling = None, range_sampling = None, dmy_covariates = None, chunk_size = 1000, sampling_times = None, robust = None):
+	"""
+	Batched simulations of the anti-logistic extended cosinor (see simulate_cosinor_batch and fit_extended_cosinor). The model fitted to the real data is simulated with noise from its residuals, and the simulations are fitted together in chunks, starting from the parameters of the real data.
+	
+	Parameters
+	----------
+	As simulate_cosinor_batch. The extended cosinor has a single period, and covariates are removed from the real data before fitting (see covariate_adjusted_endog). With robust, the noise is simulated with the median and the median absolute deviation of the residuals.
+
+	Returns
+	---------
+	sim_R2 : array
+		R-squared of the simulated models (Nsimulations)
+	sim_Fmodel : array
+		F-values of the simulated models (Nsimulations)
+	sim_tAMPLITUDE : array
+		The amplitude T-values of the simulated models (1, Nsimulations)
+	sim_ACROPHASE_24 : array
+		The acrophases of the simulated models in hours (1, Nsimulations)
+	sim_neglog10p : array
+		The -log10 p-values of the simulated models (Nsimulations)
+	sim_coef : array
+		The parameters [MESOR, AMPLITUDE, ALPHA, BETA, ACROPHASE_24] of the simulated models (5, Nsimulations)
+	"""
+	assert len(period) == 1, "Error: the extended cosinor has a single period"
+	n = len(endog)
+	endog = np.asarray(endog, dtype = np.float64).reshape(n, -1)
+	endog = covariate_adjusted_endog(endog, time_variable, period, dmy_covariates)[:,:1]
+	params = fit_extended_cosinor(endog, time_variable, period[0])[1]
+	if resids is None:
+		resids = endog - antilogistic_cosinor(time_variable, params, period[0])
+	# the residuals of missing values are NaN
+	if robust is not None:
+		noise_mean = np.nanmedian(resids)
+		noise_std = 1.4826 * np.nanmedian(np.abs(resids - noise_mean))
+	else:
+		noise_mean = np.nanmean(resids)
+		noise_std = np.nanstd(resids)
+
+	# the simulations at the time points of the data stand for covariate adjusted data, as the fit of the real data
+	n_covariates = 0
+	if (dmy_covariates is not None) and (sampling_times is None) and not randomise_time:
+		n_covariates = np.asarray(dmy_covariates).reshape(n,-1).shape[1]
+	if sampling_times is not None:
+		randomise_time = False
+		time_variable = np.asarray(sampling_times, dtype = np.float64)
+	elif randomise_time:
+		if n_sampling is None:
+			n_sampling = n
+		if range_sampling is None:
+			range_sampling = [0,23.99]
+		if resample_eveningly:
+			time_variable = np.linspace(range_sampling[0],range_sampling[1],n_sampling)
+			randomise_time = False
+	n_sampling = len(time_variable) if not randomise_time else n_sampling
+
+	sim_R2 = np.zeros(n_simulations)
+	sim_Fmodel = np.zeros(n_simulations)
+	sim_coef = np.zeros((5, n_simulations))
+	sim_SE = np.zeros((5, n_simulations))
+	not_converged = 0
+	with profile_stage('simulate'):
+		for start in range(0, n_simulations, chunk_size):
+			stop = min(start + chunk_size, n_simulations)
+			if randomise_time:
+				sim_time = np.sort(np.random.uniform(low=range_sampling[0], high=range_sampling[1], size=(n_sampling, stop - start)), axis = 0)
+			else:
+				sim_time = time_variable
+			sim_endog = antilogistic_cosinor(sim_time, params, period[0]) + np.random.normal(noise_mean, noise_std, (n_sampling, stop - start))
+			sim_R2[start:stop], sim_coef[:,start:stop], sim_SE[:,start:stop], sim_Fmodel[start:stop], n_iterations = fit_extended_cosinor(sim_endog, sim_time, period[0], initial = params, warn = False, n_covariates = n_covariates)
+			not_converged += np.sum(n_iterations >= EXTENDED_COSINOR_MAX_ITERATIONS)
+		sim_tAMPLITUDE = np.abs(sim_coef[1] / sim_SE[1])[np.newaxis]
+		sim_ACROPHASE_24 = sim_coef[4][np.newaxis]
+		sim_neglog10p = f_neglog10_pvalues(sim_Fmodel, 4, n_sampling - 5 - n_covariates)
+	if not_converged > 0:
+		print("Warning: %d of %d simulated extended cosinor fits reached the maximum number of iterations" % (not_converged, n_simulations))
+	return(sim_R2, sim_Fmodel, sim_tAMPLITUDE, sim_ACROPHASE_24, sim_neglog10p, sim_coef)
+
+
+def cosinor_parameters(a, period = [24.0]):
+	"""
+	MESOR, amplitude and acrophase from cosinor coefficients for many models at once. The acrophase is in radians within (-2*pi, 0] as in glm_cosinor.
+	
+	Parameters
+	----------
+	a : array
+		Coefficients [MESOR, beta_1, gamma_1, ...] (1 + 2*Nperiods, Nvariables)
+	period : array
+		Period(s) of the cosinor model.
+
+	Returns
+	---------
+	MESOR : array
+		MESOR (Nvariables)
+	AMPLITUDE : array
+		Amplitude (Nperiods, Nvariables)
+	ACROPHASE : array
+		Acrophase (Nperiods, Nvariables)
+	"""
+	num_period = len(period)
+	beta = a[1:(1+2*num_period):2]
+	gamma = a[2:(1+2*num_period):2]
+	AMPLITUDE = np.sqrt(beta**2 + gamma**2)
+	ACROPHASE = np.arctan2(-gamma, beta)
+	ACROPHASE[ACROPHASE > 0] -= 2*np.pi
+	return (a[0], AMPLITUDE, ACROPHASE)
+
+
+def acrophase_to_hours(ACROPHASE, period = [24.0]):
+	"""
+	Converts acrophases from radians to hours of each period (e.g., 24H)
+	
+	Parameters
+	----------
+	ACROPHASE : array
+		Acrophase in radians (Nperiods, Nvariables)
+	period : array
+		Period(s) of the cosinor model.
+
+	Returns
+	---------
+	ACROPHASE_24 : array
+		Acrophase in hours (Nperiods, Nvariables)
+	"""
+	period = np.asarray(period, dtype = np.float64).reshape(-1, *([1] * (np.ndim(ACROPHASE) - 1)))
+	ACROPHASE_24 = np.abs(ACROPHASE/(2*np.pi)) * period
+	return np.where(ACROPHASE_24 > period, ACROPHASE_24 - period, ACROPHASE_24)
+
+
+def f_neglog10_pvalues(Fvalues, dfn, dfd, max_terms = 1000):
+	"""
+	-log10 p-values of F-statistics from the F-distribution survival function for whole arrays in one call. The values are computed in log space (logsf) and, where the survival function underflows, from the series of the regularized incomplete beta function I_x(dfd/2, dfn/2) with x = dfd/(dfd + dfn*F), so that highly significant statistics do not become inf.
+	
+	Parameters
+	----------
+	Fvalues : array
+		F-statistics
+	dfn : int or array
+		Numerator degrees of freedom (broadcast with Fvalues)
+	dfd : int or array
+		Denominator degrees of freedom (broadcast with Fvalues)
+	max_terms : int
+		The maximum number of terms of the series
+
+	Returns
+	---------
+	neglog10p : array
+		-log10(p) with the shape of the broadcast inputs
+	"""
+	Fvalues, dfn, dfd = np.broadcast_arrays(np.asarray(Fvalues, dtype = np.float64), np.asarray(dfn, dtype = np.float64), np.asarray(dfd, dtype = np.float64))
+	with np.errstate(divide = 'ignore'):
+		logsf = np.array(f.logsf(Fvalues, dfn, dfd), dtype = np.float64, ndmin = 1)
+	underflow = ~np.isfinite(logsf) & np.isfinite(np.atleast_1d(Fvalues)) & (np.atleast_1d(Fvalues) > 0)
+	if np.any(underflow):
+		a = np.atleast_1d(dfd)[underflow] / 2.
+		b = np.atleast_1d(dfn)[underflow] / 2.
+		x = np.atleast_1d(dfd)[underflow] / (np.atleast_1d(dfd)[underflow] + np.atleast_1d(dfn)[underflow] * np.atleast_1d(Fvalues)[underflow])
+		# I_x(a,b) = x^a (1-x)^b / (a B(a,b)) * sum_n [(a+b)_n / (a+1)_n] x^n
+		term = np.ones_like(x)
+		series = np.ones_like(x)
+		for i in range(max_terms):
+			term *= (a + b + i) / (a + 1 + i) * x
+			series += term
+			if np.all(term < 1e-16 * series):
+				break
+		logsf[underflow] = a * np.log(x) + b * np.log1p(-x) - np.log(a) - betaln(a, b) + np.log(series)
+	return(np.maximum(-logsf.reshape(Fvalues.shape) / np.log(10), 0.))
+
+
+def format_neglog10_pvalue(neglog10p):
+	"""
+	Formats a -log10 p-value in scientific notation without underflow (e.g., 350.5 -> '3.162e-351')
+	"""
+	neglog10p = float(np.squeeze(neglog10p))
+	exponent = int(np.ceil(neglog10p))
+	return('%1.3fe-%02d' % (10**(exponent - neglog10p), exponent) if exponent > 0 else '%1.3e' % 10**(-neglog10p))
+
+
 def regression_f_ratio(endog, exog_m1, exog_m2, calc_p = False, covars = None):
 	"""
 	Compares regression models
@@ -159,19 +522,296 @@ def regression_f_ratio(endog, exog_m1, exog_m2, calc_p = False, covars = None):
 
 	F_ratio = (((SS_Residuals_m2 - SS_Residuals_m1)/(dfR - dfF))/(SS_Residuals_m1/dfF))
 	if calc_p:
-		p_values = f.sf(F_ratio, dfN, dfF)
+		p_values = 10**(-f_neglog10_pvalues(F_ratio, dfN, dfF))
 	else:
 		p_values = None
 	return(F_ratio, p_values)
 
-def dummy_code_cosine(time_variable, period = [24.0]):
-	exog_vars = np.ones((len(time_variable)))
-	for i in range(len(period)):
-		exog_vars = np.column_stack((exog_vars,np.cos(np.divide(2.0*np.pi*time_variable, period[i]))))
-		exog_vars = np.column_stack((exog_vars,np.sin(np.divide(2.0*np.pi*time_variable, period[i]))))
-	return(np.array(exog_vars))
+def dummy_code_cosine(time_variable, period = [24.0], dmy_covariates = None, dtype = np.float64):
+	"""
+	Creates the design matrix of the cosinor model [1, cos(2*pi*t/period_1), sin(2*pi*t/period_1), ...]
+	
+	Parameters
+	----------
+	time_variable : array
+		Time points (Nsubjects).
+	period : array
+		Period(s) of the cosinor model.
+	dmy_covariates : array
+		[optional] Dummy coded covariates appended after the cosinor terms.
+	dtype : dtype
+		Floating point precision of the design matrix (np.float32 or np.float64). The angles are always calculated in float64.
+
+	Returns
+	---------
+	exog_vars : array
+		Design matrix (Nsubjects, 1 + 2*Nperiods [+ Kcovariates])
+	"""
+	time_variable = np.asarray(time_variable, dtype = np.float64)
+	n = len(time_variable)
+	num_period = len(period)
+	k = 1 + 2*num_period
+	if dmy_covariates is not None:
+		dmy_covariates = np.asarray(dmy_covariates).reshape(n,-1)
+		k += dmy_covariates.shape[1]
+	exog_vars = np.empty((n, k))
+	exog_vars[:,0] = 1
+	radians = np.divide(2.0*np.pi*time_variable[:,np.newaxis], np.asarray(period, dtype = np.float64))
+	exog_vars[:,1:(1+2*num_period):2] = np.cos(radians)
+	exog_vars[:,2:(1+2*num_period):2] = np.sin(radians)
+	if dmy_covariates is not None:
+		exog_vars[:,(1+2*num_period):] = dmy_covariates
+	return(exog_vars.astype(dtype, copy = False))
+
+
+# Maximum condition number of a design matrix for float32 computations. The relative error of float32 least squares grows with the condition number (about 1e3 * 1.2e-7 ~ 1e-4 at the limit); above it, the computations fall back to float64.
+FLOAT32_MAX_CONDITION = 1e3
+# Maximum errors of float32 results relative to float64: absolute error of R2, error of the amplitude relative to the standard deviation of the data, and error of the acrophase in radians (for amplitudes > 1% of the standard deviation).
+FLOAT32_TOLERANCE = {'R2': 1e-4, 'AMPLITUDE': 1e-3, 'ACROPHASE': 1e-3}
+
+def precision_dtype(exog_vars, dtype = np.float64):
+	"""
+	Checks that a design matrix is well conditioned enough for float32 computations.
+	
+	Parameters
+	----------
+	exog_vars : array
+		Design matrix (Nsubjects, Kvariables) or stacked design matrices (Nmodels, Nsubjects, Kvariables)
+	dtype : dtype
+		Requested precision
+
+	Returns
+	---------
+	dtype : dtype
+		np.float32 if it was requested and every design is well conditioned, otherwise np.float64.
+	"""
+	dtype = np.dtype(dtype)
+	assert dtype in [np.float32, np.float64], "Error: dtype must be float32 or float64"
+	if dtype == np.float32:
+		condition = np.max(np.linalg.cond(np.asarray(exog_vars, dtype = np.float64)))
+		if not condition < FLOAT32_MAX_CONDITION:
+			print("Warning: the condition number of the design (%1.1e) is too large for float32. Using float64." % condition)
+			return np.dtype(np.float64)
+	return dtype
+
+
+def float32_accuracy(exog_vars, endog, period = [24.0]):
+	"""
+	Errors of float32 cosinor fits relative to float64 fits (see FLOAT32_TOLERANCE).
+	
+	Parameters
+	----------
+	exog_vars : array
+		Design matrix (Nsubjects, Kvariables), or a design matrix per variable (Nvariables, Nsubjects, Kvariables)
+	endog : array
+		Endogenous (dependent) variable array (Nsubjects, Nvariables)
+	period : array
+		Period(s) of the cosinor model.
+
+	Returns
+	---------
+	errors : dict
+		Maximum errors of 'R2', 'AMPLITUDE' and 'ACROPHASE'
+	within_tolerance : bool
+		All errors are within FLOAT32_TOLERANCE
+	"""
+	endog = np.asarray(endog, dtype = np.float64)
+	exog_vars = np.asarray(exog_vars, dtype = np.float64)
+	fits = {}
+	for dtype in [np.float32, np.float64]:
+		X = exog_vars.astype(dtype)
+		y = endog.astype(dtype)
+		if X.ndim == 2:
+			a = np.dot(cached_factorisation(X)[1], y)
+			resids = y - np.dot(X, a)
+		else:
+			invXX = np.linalg.inv(np.einsum('snk,snl->skl', exog_vars, exog_vars)).astype(dtype)
+			a = np.einsum('skl,sl->ks', invXX, np.einsum('snk,ns->sk', X, y))
+			resids = y - np.einsum('snk,ks->ns', X, a)
+		R2 = 1 - np.sum(resids**2, 0) / np.sum((y - y.mean(0))**2, 0)
+		fits[dtype] = (R2,) + cosinor_parameters(a.astype(np.float64), period)[1:]
+	R2_32, AMPLITUDE_32, ACROPHASE_32 = fits[np.float32]
+	R2_64, AMPLITUDE_64, ACROPHASE_64 = fits[np.float64]
+	scale = endog.std(0)
+	defined = AMPLITUDE_64 > 0.01 * scale
+	errors = {'R2': np.max(np.abs(R2_32 - R2_64)),
+				'AMPLITUDE': np.max(np.abs(AMPLITUDE_32 - AMPLITUDE_64) / scale),
+				'ACROPHASE': np.max(np.abs(_wrap_phase(ACROPHASE_32 - ACROPHASE_64))[defined], initial = 0.)}
+	within_tolerance = all(errors[key] <= FLOAT32_TOLERANCE[key] for key in FLOAT32_TOLERANCE)
+	return(errors, within_tolerance)
+
+
+# cache of least squares factorisations keyed by the content of the design matrix. Repeated fits with the same design (simulations, permutations, ROIs, subjects) only invert X'X once.
+_FACTORISATION_CACHE = {}
+_FACTORISATION_CACHE_SIZE = 256
+
+def cached_factorisation(exog_vars):
+	"""
+	Returns the cached inverse of X'X and pseudo-inverse of the design matrix X
+	
+	Parameters
+	----------
+	exog_vars : array
+		Design matrix (Nsubjects, Kvariables)
+
+	Returns
+	---------
+	invXX : array
+		inverse of X'X (Kvariables, Kvariables)
+	pinvX : array
+		(X'X)^-1 X' (Kvariables, Nsubjects)
+	The factorisation is always calculated in float64 and returned in the dtype of the design matrix.
+	"""
+	exog_vars = np.ascontiguousarray(exog_vars)
+	key = (exog_vars.shape, exog_vars.dtype.str, hashlib.sha1(exog_vars.tobytes()).hexdigest())
+	if key not in _FACTORISATION_CACHE:
+		if len(_FACTORISATION_CACHE) >= _FACTORISATION_CACHE_SIZE:
+			_FACTORISATION_CACHE.clear()
+		exog64 = exog_vars.astype(np.float64)
+		invXX = np.linalg.inv(np.dot(exog64.T, exog64))
+		pinvX = np.dot(invXX, exog64.T).astype(exog_vars.dtype)
+		invXX = invXX.astype(exog_vars.dtype)
+		invXX.flags.writeable = False
+		pinvX.flags.writeable = False
+		_FACTORISATION_CACHE[key] = (invXX, pinvX)
+	return _FACTORISATION_CACHE[key]
+
+
+def cached_lstsqr_residual(exog_vars, endog_arr):
+	"""
+	Least squares solution and residual sum of squares using the cached factorisation of the design matrix (see cy_lin_lstsqr_mat_residual).
+	
+	Parameters
+	----------
+	exog_vars : array
+		Design matrix (Nsubjects, Kvariables)
+	endog_arr : array
+		Endogenous (dependent) variable array (Nsubjects, Nvariables)
+
+	Returns
+	---------
+	a : array
+		Coefficients (Kvariables, Nvariables)
+	SS_Residuals : array
+		Residual sum of squares (Nvariables)
+	"""
+	a = np.dot(cached_factorisation(exog_vars)[1], endog_arr)
+	resids = endog_arr - np.dot(exog_vars, a)
+	return (a, np.sum(resids**2,axis=0))
+
+# tuning constants of the M-estimators (95% efficiency for normal errors)
+ROBUST_TUNING = {'huber': 1.345, 'tukey': 4.685}
+
+def robust_weights(scaled_resids, method = 'huber', tuning = None):
+	"""
+	Weights of the Huber or Tukey bisquare M-estimator for residuals divided by their scale.
+	"""
+	assert method in ROBUST_TUNING, "Error: robust method must be one of %s" % ", ".join(ROBUST_TUNING)
+	if tuning is None:
+		tuning = ROBUST_TUNING[method]
+	abs_resids = np.abs(scaled_resids)
+	if method == 'huber':
+		return tuning / np.maximum(abs_resids, tuning)
+	return np.where(abs_resids < tuning, (1 - (abs_resids / tuning)**2)**2, 0.)
+
 
-def permute_F_ratio_cosinor(endog, time_variable, period, iterator, covars = None, blocking = None, randomise = True):
+def weighted_lstsqr_residual(exog_vars, endog_arr, weights):
+	"""
+	Weighted least squares of many variables that each have their own weights. The weighted normal equations of all the variables are built with two matrix products and solved together.
+	
+	Parameters
+	----------
+	exog_vars : array
+		Design matrix (Nsubjects, Kvariables)
+	endog_arr : array
+		Endogenous (dependent) variable array (Nsubjects, Nvariables)
+	weights : array
+		Weights of each observation of each variable (Nsubjects, Nvariables)
+
+	Returns
+	---------
+	a : array
+		Coefficients (Kvariables, Nvariables)
+	SS_Residuals : array
+		Weighted residual sum of squares (Nvariables)
+	invXWX : array
+		inverse of X'WX of each variable (Nvariables, Kvariables, Kvariables)
+	"""
+	exog_vars = np.asarray(exog_vars, dtype = np.float64)
+	n, k = exog_vars.shape
+	outer_exog = (exog_vars[:,:,np.newaxis] * exog_vars[:,np.newaxis,:]).reshape(n, k*k)
+	invXWX = np.linalg.inv(np.dot(weights.T, outer_exog).reshape(-1, k, k))
+	a = np.einsum('vkl,vl->kv', invXWX, np.dot((weights * endog_arr).T, exog_vars))
+	SS_Residuals = np.sum(weights * (endog_arr - np.dot(exog_vars, a))**2, 0)
+	return (a, SS_Residuals, invXWX)
+
+
+def robust_lstsqr(exog_vars, endog_arr, method = 'huber', tuning = None, max_iterations = 50, tol = 1e-5):
+	"""
+	Robust (M-estimator) regression of many variables at once by iteratively reweighted least squares. Each variable has its own weights and scale (the median absolute deviation of its residuals), the weighted normal equations of the variables are solved together (see weighted_lstsqr_residual), and variables drop out of the iterations once their coefficients have converged. Tukey bisquare fits start from the Huber fit and keep its scale.
+	
+	Parameters
+	----------
+	exog_vars : array
+		Design matrix (Nsubjects, Kvariables)
+	endog_arr : array
+		Endogenous (dependent) variable array (Nsubjects) or (Nsubjects, Nvariables)
+	method : string
+		'huber' or 'tukey'
+	tuning : float
+		[optional] Tuning constant of the weight function (default: ROBUST_TUNING)
+	max_iterations : int
+		The maximum number of iterations
+	tol : float
+		Convergence tolerance of the change of the coefficients relative to the scale
+
+	Returns
+	---------
+	a : array
+		Coefficients (Kvariables, Nvariables)
+	weights : array
+		The final weights (Nsubjects, Nvariables)
+	scale : array
+		The robust scale of the residuals (Nvariables)
+	n_iterations : array
+		The number of iterations of each variable (Nvariables)
+	"""
+	exog_vars = np.asarray(exog_vars, dtype = np.float64)
+	endog_arr = np.asarray(endog_arr, dtype = np.float64)
+	flat = endog_arr.ndim == 1
+	endog_arr = endog_arr.reshape(len(endog_arr), -1)
+	num_var = endog_arr.shape[1]
+	if method == 'tukey':
+		# the bisquare weights are not convex, so the fit starts from the Huber fit and keeps its scale
+		a, _, scale = robust_lstsqr(exog_vars, endog_arr, method = 'huber', max_iterations = max_iterations, tol = tol)[:3]
+	else:
+		a = np.dot(cached_factorisation(exog_vars)[1], endog_arr)
+		scale = np.zeros(num_var)
+	weights = np.ones_like(endog_arr)
+	n_iterations = np.zeros(num_var, dtype = int)
+	active = np.arange(num_var)
+	with profile_stage('robust'):
+		for iteration in range(max_iterations):
+			resids = endog_arr[:,active] - np.dot(exog_vars, a[:,active])
+			# median absolute deviation (the floor avoids dividing by zero for perfect fits)
+			if method != 'tukey':
+				scale[active] = np.maximum(1.4826 * np.median(np.abs(resids - np.median(resids, 0)), 0), 1e-12 * (1 + np.abs(endog_arr[:,active]).max(0)))
+			weights[:,active] = robust_weights(resids / scale[active], method, tuning)
+			a_new = weighted_lstsqr_residual(exog_vars, endog_arr[:,active], weights[:,active])[0]
+			converged = np.max(np.abs(a_new - a[:,active]), 0) <= tol * scale[active]
+			a[:,active] = a_new
+			n_iterations[active] += 1
+			active = active[~converged]
+			if len(active) == 0:
+				break
+	if len(active) > 0:
+		print("Warning: the robust fit of %d variable(s) did not converge in %d iterations" % (len(active), max_iterations))
+	if flat:
+		return (a[:,0], weights[:,0], scale[0], n_iterations[0])
+	return (a, weights, scale, n_iterations)
+
+
+def permute_F_ratio_cosinor(endog, time_variable, period, iterator, covars = None, blocking = None, randomise = True, reduced_fitted = None):
 	n = len(time_variable)
 	# Check that endog has two dimensions
 	if endog.ndim == 1:
@@ -180,10 +820,13 @@ def permute_F_ratio_cosinor(endog, time_variable, period, iterator, covars = Non
 	if randomise:
 		rand_array = np.random.permutation(list(range(n)))
 		endog = endog[rand_array]
+		# Freedman-Lane: endog are the residuals of the reduced model
+		if reduced_fitted is not None:
+			endog = reduced_fitted + endog
 
 	period = np.array(period)
 
-	exog_model = dummy_code_cosine(time_variable, period)
+	exog_model = dummy_code_cosine(time_variable, period, covars)
 
 	other_models = []
 	for per in period:
@@ -191,11 +834,16 @@ def permute_F_ratio_cosinor(endog, time_variable, period, iterator, covars = Non
 	other_models = np.array(other_models)
 
 	k = exog_model.shape[1]
-	DF_Between = k - 1 # aka df model
 	DF_Within = n - k # aka df residuals
 
-	SS_Total = np.sum((endog - np.mean(endog,0))**2,0)
-	SS_Residuals = cy_lin_lstsqr_mat_residual(exog_model, endog)[1]
+	if covars is not None:
+		exog_reduced = stack_ones(covars)
+		SS_Total = cached_lstsqr_residual(exog_reduced, endog)[1]
+		DF_Between = k - exog_reduced.shape[1]
+	else:
+		SS_Total = np.sum((endog - np.mean(endog,0))**2,0)
+		DF_Between = k - 1 # aka df model
+	SS_Residuals = cached_lstsqr_residual(exog_model, endog)[1]
 
 	SS_Between = SS_Total - SS_Residuals
 	MS_Residuals = (SS_Residuals/ DF_Within)
@@ -204,7 +852,7 @@ def permute_F_ratio_cosinor(endog, time_variable, period, iterator, covars = Non
 	# Compute F-statistic for each period
 	Fperm = []
 	for op in other_models:
-			SS_model = np.array(SS_Total - cy_lin_lstsqr_mat_residual(dummy_code_cosine(time_variable, op), endog)[1])
+			SS_model = np.array(SS_Total - cached_lstsqr_residual(dummy_code_cosine(time_variable, op, covars), endog)[1])
 			Ftemp = (SS_Between - SS_model)/(MS_Residuals*2)
 			Fperm.append(Ftemp)
 	return(Fmodel, Fperm)
@@ -212,7 +860,7 @@ def permute_F_ratio_cosinor(endog, time_variable, period, iterator, covars = Non
 
 # https://www.ncbi.nlm.nih.gov/pmc/articles/PMC3991883/
 # https://www.ncbi.nlm.nih.gov/pmc/articles/PMC3663600/
-def glm_cosinor(endog, time_var, exog = None, dmy_covariates = None, rand_array = None, interaction_var = None, period = [24.0], calc_MESOR = True, output_fit_only = False):
+def glm_cosinor(endog, time_var, exog = None, dmy_covariates = None, rand_array = None, interaction_var = None, period = [24.0], calc_MESOR = True, output_fit_only = False, dtype = np.float64, robust = None, return_DF_Within = False):
 	"""
 	COSINOR model using GLM
 	
@@ -226,38 +874,45 @@ def glm_cosinor(endog, time_var, exog = None, dmy_covariates = None, rand_array
 		Exogenous (independent) dummy coded variables
 		exog is an array of arrays (Nvariables, Nsubjects, Kvariable).
 	dmy_covariates : array
-		Dummy coded array of covariates of no interest.
-	init_covars : array
-		Dummy coded array of covariates for two-step regression.
+		Dummy coded array of covariates of no interest (Nsubjects, Kcovariates). The covariates are fitted jointly with the cosinor terms, and Fmodel and R2 test the cosinor terms against the covariate only model.
+	Variables with missing values (NaN) are fitted without their missing rows in groups of variables that share the same missing rows (see glm_cosinor_missing).
 	rand_array : array
 		randomized array for permutations (Nsubjects).
 	period : array
 		Period(s) as an array of floats for cosinor model.
+	dtype : dtype
+		Floating point precision (np.float32 or np.float64). float32 halves the memory of many variables; it falls back to float64 for ill-conditioned designs (see precision_dtype).
+	robust : string
+		[optional] Robust fit of all the variables with the 'huber' or 'tukey' M-estimator (see robust_lstsqr). The F-test, R2 and standard errors are calculated from the weighted least squares fit with the final weights of each variable.
+	return_DF_Within : bool
+		Also return the residual degrees of freedom of each variable, which are smaller for variables with missing values (see glm_cosinor_missing). The outputs are then (results, DF_Within).
 	Returns
 	---------
 	To-do
 	"""
 
+	if (rand_array is None) and np.isnan(endog).any():
+		results, DF_Within = glm_cosinor_missing(endog, time_var, exog = exog, dmy_covariates = dmy_covariates, interaction_var = interaction_var, period = period, calc_MESOR = calc_MESOR, output_fit_only = output_fit_only, dtype = dtype, robust = robust)
+		if return_DF_Within:
+			return(results, DF_Within)
+		return results
+
 	n = endog.shape[0]
 	# add cosinor terms
 	num_period = len(period)
-	exog_vars = np.ones((n))
-	for i in range(num_period):
-		exog_vars = np.column_stack((exog_vars,np.cos(np.divide(2.0*np.pi*time_var, period[i]))))
-		exog_vars = np.column_stack((exog_vars,np.sin(np.divide(2.0*np.pi*time_var, period[i]))))
+	exog_vars = dummy_code_cosine(time_var, period)
 
 	if interaction_var is not None:
 		for i in range(num_period):
 			exog_vars = np.column_stack((exog_vars, exog_vars[i+1] * interaction_var))
 
-
 	kvars = []
-	# add other exogenous variables to the model (currently not implemented)
+	# add other exogenous variables to the model
 	if exog is not None:
 		for var in exog:
 			var = np.array(var)
 			if var.ndim == 1:
-				kvars.append((3))
+				kvars.append((1))
 			else:
 				kvars.append((var.shape[1]))
 			exog_vars = np.column_stack((exog_vars,var))
@@ -265,18 +920,28 @@ def glm_cosinor(endog, time_var, exog = None, dmy_covariates = None, rand_array
 	# add covariates (i.e., exogenous variables that will not be outputed)
 	if dmy_covariates is not None:
 		exog_vars = np.column_stack((exog_vars, dmy_covariates))
-	exog_vars = np.array(exog_vars)
+	dtype = precision_dtype(exog_vars, dtype)
+	exog_vars = np.array(exog_vars, dtype = dtype)
+	endog = np.asarray(endog, dtype = dtype)
 
 	if rand_array is not None:
 		exog_vars = exog_vars[rand_array]
+		a, SS_Residuals = cy_lin_lstsqr_mat_residual(exog_vars,endog)
+	elif robust is not None:
+		a, weights = robust_lstsqr(exog_vars, endog, method = robust)[:2]
+		weights = weights.reshape(n, -1)
+		a, SS_Residuals, invXWX = weighted_lstsqr_residual(exog_vars, endog.reshape(n, -1), weights)
+		if endog.ndim == 1:
+			a, SS_Residuals, invXWX = a[:,0], SS_Residuals[0], invXWX[0]
+		a = a.astype(dtype)
+	else:
+		a, SS_Residuals = cached_lstsqr_residual(exog_vars,endog)
 
 	# calculate model fit (Fmodel and R-sqr)
 	k = exog_vars.shape[1]
-	DF_Between = k - 1 # aka df model
 	DF_Within = n - k # aka df residuals
 	#DF_Total = n - 1
 
-	a, SS_Residuals = cy_lin_lstsqr_mat_residual(exog_vars,endog)
 	if output_fit_only:
 		AMPLITUDE = []
 		ACROPHASE = []
@@ -297,15 +962,38 @@ def glm_cosinor(endog, time_var, exog = None, dmy_covariates = None, rand_array
 			ACROPHASE[i, (a[2+(i*2),:] > 0) & (a[1+(i*2),:] < 0)] = (-1*np.pi) + ACROPHASE[i, (a[2+(i*2),:] > 0) & (a[1+(i*2),:] < 0)]
 			ACROPHASE[i, (a[2+(i*2),:] < 0) & (a[1+(i*2),:] <= 0)] = (-1*np.pi) - ACROPHASE[i, (a[2+(i*2),:] < 0) & (a[1+(i*2),:] <= 0)]
 			ACROPHASE[i, (a[2+(i*2),:] <= 0) & (a[1+(i*2),:] > 0)] = (-2*np.pi) + ACROPHASE[i, (a[2+(i*2),:] <= 0) & (a[1+(i*2),:] > 0)]
+		if return_DF_Within:
+			return((MESOR, np.array(AMPLITUDE), np.array(ACROPHASE)), np.full(np.shape(MESOR), DF_Within))
 		return MESOR, np.array(AMPLITUDE), np.array(ACROPHASE)
 	else:
 		SS_Total = np.sum((endog - np.mean(endog,0))**2,0)
+		# The model is tested against the reduced (intercept + covariates) model. Without covariates, the reduced model is the intercept only.
+		if robust is not None:
+			reduced_exog = np.ones((n,1)) if dmy_covariates is None else stack_ones(dmy_covariates)
+			SS_Total = weighted_lstsqr_residual(reduced_exog, endog.reshape(n, -1), weights)[1]
+			if endog.ndim == 1:
+				SS_Total = SS_Total[0]
+			DF_Between = k - reduced_exog.shape[1]
+		elif dmy_covariates is not None:
+			reduced_exog = stack_ones(dmy_covariates)
+			if rand_array is not None:
+				reduced_exog = reduced_exog[rand_array]
+			SS_Total = cached_lstsqr_residual(reduced_exog, endog)[1]
+			DF_Between = k - reduced_exog.shape[1]
+		else:
+			DF_Between = k - 1 # aka df model
 		SS_Between = SS_Total - SS_Residuals
 		MS_Residuals = (SS_Residuals / DF_Within)
 		Fmodel = (SS_Between/DF_Between) / MS_Residuals
 		# Calculates sigma sqr and T-value (intercept) for MESOR
 		sigma = np.sqrt(SS_Residuals / DF_Within)
-		invXX = np.linalg.inv(np.dot(exog_vars.T, exog_vars))
+		if rand_array is not None:
+			invXX = np.linalg.inv(np.dot(exog_vars.T, exog_vars))
+		elif robust is not None:
+			# each variable has its own (X'WX)^-1 (Kvariables, Kvariables[, Nvariables])
+			invXX = np.moveaxis(invXWX, 0, -1) if invXWX.ndim == 3 else invXWX
+		else:
+			invXX = cached_factorisation(exog_vars)[0]
 
 		if (calc_MESOR) or (exog is not None):
 			if endog.ndim == 1:
@@ -316,14 +1004,16 @@ def glm_cosinor(endog, time_var, exog = None, dmy_covariates = None, rand_array
 				SE_MESOR = se[0]
 				a = a[:, np.newaxis]
 			else:
-				num_depv = endog.shape[1]
-				se = se_of_slope(num_depv,invXX,sigma**2,k)
+				if invXX.ndim == 3:
+					se = np.sqrt(np.diagonal(invXX).T * sigma**2)
+				else:
+					se = np.sqrt(np.outer(np.diag(invXX), sigma**2))
 				Tvalues = a / se
 				MESOR = a[0,:]
 				tMESOR = Tvalues[0,:]
 				SE_MESOR = se[0,:]
 			if exog is not None:
-				tEXOG = Tvalues[(3+(2*(num_period-1))):,:]
+				tEXOG = Tvalues[(1+(2*num_period)):(1+(2*num_period)+sum(kvars)),:]
 			else:
 				tEXOG = None
 		else:
@@ -363,12 +1053,98 @@ def glm_cosinor(endog, time_var, exog = None, dmy_covariates = None, rand_array
 			tACROPHASE.append(np.divide(1.0, SE_ACROPHASE[i]))
 
 		# Do not output R-squared during permutations testing.
+		# With covariates, this is the partial R-squared of the cosinor terms.
 		R2 = 1 - (SS_Residuals/SS_Total)
 
+		if return_DF_Within:
+			return((R2, MESOR, SE_MESOR, np.array(AMPLITUDE), np.array(SE_AMPLITUDE), np.array(ACROPHASE), np.array(SE_ACROPHASE), Fmodel, tMESOR, np.abs(tAMPLITUDE), np.abs(tACROPHASE), np.array(tEXOG)), np.full(np.shape(R2), DF_Within))
 		return R2, MESOR, SE_MESOR, np.array(AMPLITUDE), np.array(SE_AMPLITUDE), np.array(ACROPHASE), np.array(SE_ACROPHASE), Fmodel, tMESOR, np.abs(tAMPLITUDE), np.abs(tACROPHASE), np.array(tEXOG)
 
 
-def permute_cosinor(endog, time_variable, period, iterator, perm_stat = 'Fmodel', blocking = None):
+def missing_data_groups(endog):
+	"""
+	Groups the variables by their pattern of missing values (NaN).
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array (Nsubjects, Nvariables)
+
+	Returns
+	---------
+	groups : list
+		(rows, columns) of each group: the boolean array of the observed rows (Nsubjects) and the indices of the variables that are observed in those rows.
+	"""
+	missing = np.isnan(endog).reshape(len(endog), -1)
+	patterns, inverse = np.unique(missing.T, axis = 0, return_inverse = True)
+	inverse = inverse.ravel()
+	return [(~patterns[g], np.flatnonzero(inverse == g)) for g in range(len(patterns))]
+
+
+def glm_cosinor_missing(endog, time_var, exog = None, dmy_covariates = None, interaction_var = None, period = [24.0], calc_MESOR = True, output_fit_only = False, dtype = np.float64, robust = None):
+	"""
+	glm_cosinor for variables with missing values (NaN). The variables are grouped by their pattern of missing values (see missing_data_groups), and each group is fitted at once with the design of its observed rows, so the factorisation of each row subset is calculated (and cached) once. Covariates that are linearly dependent within a row subset (e.g., the dummy code of a subject without observed rows) are removed for that group.
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array with missing values (Nsubjects, Nvariables)
+	Other parameters are as glm_cosinor.
+
+	Returns
+	---------
+	results : tuple
+		The outputs of glm_cosinor. The outputs of variables with fewer observations than model terms are NaN.
+	DF_Within : array
+		The residual degrees of freedom of each variable (Nvariables)
+	"""
+	endog = np.asarray(endog)
+	flat = endog.ndim == 1
+	endog = endog.reshape(len(endog), -1)
+	n, num_var = endog.shape
+	time_var = np.asarray(time_var)
+	if dmy_covariates is not None:
+		dmy_covariates = np.asarray(dmy_covariates).reshape(n,-1)
+	k_exog = 0
+	if exog is not None:
+		exog = [np.asarray(var) for var in exog]
+		k_exog = sum([1 if var.ndim == 1 else var.shape[1] for var in exog])
+	results = None
+	DF_Within = np.zeros(num_var)
+	for rows, columns in missing_data_groups(endog):
+		k = 1 + 2*len(period) + (len(period) if interaction_var is not None else 0) + k_exog
+		group_covariates = None
+		if (dmy_covariates is not None) and (np.sum(rows) > k):
+			group_covariates = independent_covariates(dmy_covariates[rows], time_var[rows], period)
+			if group_covariates is not None:
+				k += group_covariates.shape[1]
+		DF_Within[columns] = np.sum(rows) - k
+		if np.sum(rows) <= k:
+			continue
+		group_results = glm_cosinor(endog[rows][:,columns],
+											time_var[rows],
+											exog = [var[rows] for var in exog] if exog is not None else None,
+											dmy_covariates = group_covariates,
+											interaction_var = np.asarray(interaction_var)[rows] if interaction_var is not None else None,
+											period = period,
+											calc_MESOR = calc_MESOR,
+											output_fit_only = output_fit_only,
+											dtype = dtype,
+											robust = robust)
+		# outputs that are not per variable (None, or tEXOG without exog) are passed through
+		if results is None:
+			results = [r if np.ndim(r) == 0 else np.full(np.shape(r)[:-1] + (num_var,), np.nan, dtype = np.result_type(r, np.float32)) for r in group_results]
+		for i, r in enumerate(group_results):
+			if np.ndim(r) > 0:
+				results[i][...,columns] = r
+	assert results is not None, "Error: no variable has more observations than model terms"
+	if flat:
+		results = [r if np.ndim(r) == 0 else r[...,0] for r in results]
+		DF_Within = DF_Within[0]
+	return(tuple(results), DF_Within)
+
+
+def permute_cosinor(endog, time_variable, period, iterator, perm_stat = 'Fmodel', blocking = None, dmy_covariates = None, reduced_fitted = None):
 	# Check that endog has two dimensions
 	if endog.ndim == 1:
 		endog = endog.reshape(len(endog),1)
@@ -377,53 +1153,485 @@ def permute_cosinor(endog, time_variable, period, iterator, perm_stat = 'Fmodel'
 	else:
 		stat_choice = 0
 	rand_array = np.random.permutation(list(range(len(time_variable))))
+	# permuting endog instead of the design allows the cached factorisation of the design to be used
+	endog = endog[rand_array]
+	# Freedman-Lane: endog are the residuals of the reduced model
+	if reduced_fitted is not None:
+		endog = reduced_fitted + endog
 	perm_stat = glm_cosinor(endog = endog,
 							time_var = time_variable,
-							rand_array = rand_array,
+							dmy_covariates = dmy_covariates,
 							period = period)[stat_choice]
 	return(perm_stat)
 
-def plot_permuted_model(endog, time_variable, period = [24.0], n_perm = 10000, outname = 'cosinor_plot_permuted.png'):
+def circular_block_cosinor(endog, time_variable, period = [24.0], n_surrogates = 10000, block_size = None, dmy_covariates = None, chunk_size = 500):
+	"""
+	Surrogate null distribution of the cosinor model F-statistic and R-squared that preserves the autocorrelation of the series. Permuting the sample order (permute_cosinor) destroys the autocorrelation, and a pure circular time-shift of the data is a phase rotation that leaves the statistic unchanged when the sampled span is a whole number of periods. Each surrogate therefore wraps the time-ordered residuals of the reduced (intercept + covariates) model into a circle, cuts it into blocks of consecutive samples at a random offset, and shuffles the blocks (Freedman-Lane). The dot products of every pair of blocks with the design are computed once per offset, so the statistics of a chunk of surrogates are sums of precomputed products rather than refits. For unevenly spaced data, the blocks are consecutive samples rather than fixed durations.
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array (Nsubjects) or (Nsubjects, Nvariables)
+	time_variable : array
+		Time points.
+	period : array
+		Period(s) of the cosinor model.
+	n_surrogates : int
+		The number of surrogates
+	block_size : int
+		[optional] The number of consecutive samples in each block. It should exceed the autocorrelation length. Default: Nsubjects^(1/3)
+	dmy_covariates : array
+		[optional] Dummy coded covariates of no interest.
+	chunk_size : int
+		The number of surrogates that are computed together.
+
+	Returns
+	---------
+	Fmodel : array
+		F-values of the cosinor model (Nvariables)
+	R2 : array
+		R-squared (Nvariables)
+	Fsurrogate : array
+		F-values of the surrogates (Nsurrogates, Nvariables)
+	R2surrogate : array
+		R-squared of the surrogates (Nsurrogates, Nvariables)
+	p_values : array
+		Surrogate p-values of Fmodel (Nvariables)
+	"""
+	endog = np.asarray(endog, dtype = np.float64).reshape(len(endog), -1)
+	time_variable = np.asarray(time_variable, dtype = np.float64)
+	n = len(time_variable)
+	# the blocks are consecutive in time
+	order = np.argsort(time_variable, kind = 'stable')
+	time_variable = time_variable[order]
+	endog = endog[order]
+	if dmy_covariates is not None:
+		dmy_covariates = np.asarray(dmy_covariates).reshape(n,-1)[order]
+		reduced_fitted, reduced_resids = freedman_lane_residuals(endog, dmy_covariates)
+	else:
+		reduced_fitted = np.ones((n,1)) * endog.mean(0)
+		reduced_resids = endog - reduced_fitted
+	exog_vars = dummy_code_cosine(time_variable, period, dmy_covariates)
+	k = exog_vars.shape[1]
+	# the reduced model columns (intercept and covariates) of the design
+	reduced_columns = np.concatenate(([0], np.arange(1 + 2*len(period), k)))
+	invXX = cached_factorisation(exog_vars)[0]
+	invZZ = cached_factorisation(exog_vars[:,reduced_columns])[0]
+	DF_Between = k - len(reduced_columns)
+	DF_Within = n - k
+
+	SS_Total = cached_lstsqr_residual(exog_vars[:,reduced_columns], endog)[1]
+	SS_Residuals = cached_lstsqr_residual(exog_vars, endog)[1]
+	Fmodel = ((SS_Total - SS_Residuals)/DF_Between) / (SS_Residuals/DF_Within)
+	R2 = 1 - (SS_Residuals/SS_Total)
+
+	if block_size is None:
+		block_size = max(1, int(round(n**(1/3.))))
+	block_size = min(int(block_size), n)
+	n_blocks = n // block_size
+	# surrogate y = reduced_fitted + shuffled residuals: X'y and y'y are sums of block products
+	Xtf = np.dot(exog_vars.T, reduced_fitted)
+	yty_fixed = np.sum(reduced_fitted**2, 0) + np.sum(reduced_resids**2, 0)
+	# the partition of the circle only depends on the offset modulo block_size
+	offsets = np.random.randint(0, block_size, n_surrogates)
+
+	surrogate_SS_Residuals = np.zeros((n_surrogates, endog.shape[1]))
+	surrogate_SS_Total = np.zeros((n_surrogates, endog.shape[1]))
+	with profile_stage('permute'):
+		for offset in np.unique(offsets):
+			index = np.mod(np.arange(n) + offset, n)
+			blocks = index[:n_blocks*block_size].reshape(n_blocks, block_size)
+			remainder = index[n_blocks*block_size:]
+			# products of destination block i with source block j (Nblocks, Nblocks, ...)
+			block_Xtr = np.einsum('ilk,jlv->ijkv', exog_vars[blocks], reduced_resids[blocks])
+			block_ftr = np.einsum('ilv,jlv->ijv', reduced_fitted[blocks], reduced_resids[blocks])
+			remainder_Xtr = np.dot(exog_vars[remainder].T, reduced_resids[remainder])
+			remainder_ftr = np.sum(reduced_fitted[remainder] * reduced_resids[remainder], 0)
+			surrogates = np.flatnonzero(offsets == offset)
+			for start in range(0, len(surrogates), chunk_size):
+				chunk = surrogates[start:start + chunk_size]
+				shuffles = np.argsort(np.random.random((len(chunk), n_blocks)), axis = 1)
+				Xty = Xtf + remainder_Xtr + block_Xtr[np.arange(n_blocks), shuffles].sum(1)
+				yty = yty_fixed + 2*(remainder_ftr + block_ftr[np.arange(n_blocks), shuffles].sum(1))
+				Zty = Xty[:,reduced_columns]
+				surrogate_SS_Residuals[chunk] = yty - np.einsum('skv,kl,slv->sv', Xty, invXX, Xty)
+				surrogate_SS_Total[chunk] = yty - np.einsum('skv,kl,slv->sv', Zty, invZZ, Zty)
+	Fsurrogate = ((surrogate_SS_Total - surrogate_SS_Residuals)/DF_Between) / (surrogate_SS_Residuals/DF_Within)
+	R2surrogate = 1 - (surrogate_SS_Residuals/surrogate_SS_Total)
+	p_values = (np.sum(Fsurrogate >= Fmodel, 0) + 1) / (n_surrogates + 1)
+	return(Fmodel, R2, Fsurrogate, R2surrogate, p_values)
+
+def fdr_correction(p_values, q = 0.05):
+	"""
+	Benjamini-Hochberg false discovery rate adjusted p-values for many tests at once. Missing p-values (NaN) are not counted as tests.
+	
+	Parameters
+	----------
+	p_values : array
+		p-values (Ntests, ...). The tests are along the first axis, and each trailing column is adjusted separately.
+	q : float
+		The false discovery rate
+
+	Returns
+	---------
+	p_adjusted : array
+		FDR adjusted p-values (Ntests, ...)
+	rejected : array
+		Tests that are significant at the false discovery rate q (Ntests, ...)
+	"""
+	p_values = np.asarray(p_values, dtype = np.float64)
+	shape = p_values.shape
+	p_values = p_values.reshape(shape[0], -1)
+	m = np.sum(~np.isnan(p_values), 0)
+	order = np.argsort(np.where(np.isnan(p_values), np.inf, p_values), axis = 0, kind = 'stable')
+	p_sorted = np.take_along_axis(p_values, order, 0)
+	rank = np.arange(1, shape[0] + 1)[:,np.newaxis]
+	p_sorted = np.where(rank <= m, p_sorted * m / rank, np.nan)
+	# step-up: the running minimum from the largest p-value
+	p_sorted = np.fmin.accumulate(p_sorted[::-1], axis = 0)[::-1]
+	p_adjusted = np.empty_like(p_sorted)
+	np.put_along_axis(p_adjusted, order, np.minimum(p_sorted, 1.), 0)
+	p_adjusted = p_adjusted.reshape(shape)
+	return(p_adjusted, p_adjusted <= q)
+
+
+def multi_roi_permutation(endog, time_variable, period = [24.0], n_perm = 10000, dmy_covariates = None, chunk_size = 100, q = 0.05, dtype = np.float64, permutations = None, Fmodel = None):
+	"""
+	Permutation testing of the cosinor model of many ROIs in a single pass with family-wise error rate (FWER) control by the maximum statistic. Every permutation applies the same permutation of the rows to all ROIs (preserving the correlations between ROIs), and the permuted data of a chunk of permutations and all ROIs are solved as one matrix against the shared design. The maximum F across ROIs of each permutation is the null distribution of the FWER corrected p-values. With covariates, the residuals of the reduced model are permuted (Freedman-Lane).
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array (Nsubjects, Nrois). ROIs with missing values are not tested.
+	time_variable : array
+		Time points.
+	period : array
+		Period(s) of the cosinor model.
+	n_perm : int
+		The number of permutations
+	dmy_covariates : array
+		[optional] Dummy coded covariates of no interest.
+	chunk_size : int
+		The number of permutations that are solved together.
+	q : float
+		The false discovery rate of the FDR corrected p-values (see fdr_correction).
+	dtype : dtype
+		Floating point precision (see glm_cosinor).
+	permutations : array
+		[optional] The permuted row indices of every permutation (Npermutations, Nsubjects), e.g., to use the same permutations for chunks of ROIs (see vertexwise_cosinor). Overrides n_perm.
+	Fmodel : array
+		[optional] The F-values of the ROIs (Nrois) if they are already fitted (e.g., by vertexwise_cosinor), so the data are not fitted again.
+
+	Returns
+	---------
+	Fmodel : array
+		F-values of the cosinor model (Nrois)
+	p_uncorrected : array
+		Permutation p-values of each ROI (Nrois)
+	p_fwer : array
+		FWER corrected p-values (Nrois)
+	p_fdr : array
+		FDR adjusted permutation p-values (Nrois)
+	max_Fnull : array
+		The maximum F across ROIs of each permutation (Npermutations)
+	"""
+	endog = np.asarray(endog, dtype = np.float64)
 	if endog.ndim == 1:
 		endog = endog.reshape(len(endog),1)
-	resids = residual_cosinor(endog = endog, time_var = time_variable, period = period)
-	if len(period) == 1:
+	n, num_roi = endog.shape
+	complete = ~np.isnan(endog).any(0)
+	if not complete.all():
+		print("Warning: %d ROIs with missing values are not tested" % np.sum(~complete))
+	endog = endog[:,complete]
+	num_tested = endog.shape[1]
+	if permutations is not None:
+		n_perm = len(permutations)
+	if num_tested == 0:
+		return(np.full(num_roi, np.nan), np.full(num_roi, np.nan), np.full(num_roi, np.nan), np.full(num_roi, np.nan), np.full(n_perm, -np.inf))
+
+	exog_vars = dummy_code_cosine(time_variable, period, dmy_covariates)
+	dtype = precision_dtype(exog_vars, dtype)
+	exog_vars = exog_vars.astype(dtype)
+	if Fmodel is None:
+		Fmodel = glm_cosinor(endog = endog, time_var = time_variable, dmy_covariates = dmy_covariates, period = period, dtype = dtype)[7]
+	else:
+		Fmodel = np.asarray(Fmodel).reshape(num_roi)[complete]
+	k = exog_vars.shape[1]
+	DF_Within = n - k
+	if dmy_covariates is not None:
+		reduced_exog = stack_ones(dmy_covariates).astype(dtype)
+		reduced_fitted, resids = freedman_lane_residuals(endog, dmy_covariates)
+		reduced_fitted = reduced_fitted.astype(dtype)
+		DF_Between = k - reduced_exog.shape[1]
+	else:
+		resids = residual_cosinor(endog = endog, time_var = time_variable, period = period)
+		reduced_fitted = None
+		DF_Between = k - 1
+	resids = resids.astype(dtype)
+	pinvX = cached_factorisation(exog_vars)[1]
+
+	exceedances = np.zeros(num_tested, dtype = np.int64)
+	max_Fnull = np.zeros(n_perm)
+	with profile_stage('permute'):
+		for start in range(0, n_perm, chunk_size):
+			stop = min(start + chunk_size, n_perm)
+			n_chunk = stop - start
+			if permutations is None:
+				chunk_permutations = np.array([np.random.permutation(n) for i in range(n_chunk)])
+			else:
+				chunk_permutations = permutations[start:stop]
+			# (Nsubjects, Nchunk * Nrois) with the ROIs of each permutation in consecutive columns
+			perm_endog = resids[chunk_permutations].transpose(1,0,2).reshape(n, n_chunk * num_tested)
+			if reduced_fitted is not None:
+				perm_endog += np.tile(reduced_fitted, n_chunk)
+			SS_Residuals = np.sum((perm_endog - np.dot(exog_vars, np.dot(pinvX, perm_endog)))**2, 0)
+			if reduced_fitted is not None:
+				SS_Total = cached_lstsqr_residual(reduced_exog, perm_endog)[1]
+			else:
+				SS_Total = np.sum((perm_endog - np.mean(perm_endog, 0))**2, 0)
+			Fperm = (((SS_Total - SS_Residuals) / DF_Between) / (SS_Residuals / DF_Within)).reshape(n_chunk, num_tested)
+			exceedances += np.sum(Fperm >= Fmodel, 0)
+			max_Fnull[start:stop] = Fperm.max(1)
+
+	p_values = np.full((3, num_roi), np.nan)
+	p_values[0, complete] = (exceedances + 1) / (n_perm + 1)
+	p_values[1, complete] = (n_perm - np.searchsorted(np.sort(max_Fnull), Fmodel, side = 'left') + 1) / (n_perm + 1)
+	p_values[2] = fdr_correction(p_values[0], q = q)[0]
+	Fmodel_all = np.full(num_roi, np.nan)
+	Fmodel_all[complete] = Fmodel
+	return(Fmodel_all, p_values[0], p_values[1], p_values[2], max_Fnull)
+
+
+# cache of geodesic smoothing operators keyed by the mesh and sigma. The weights of a mesh are only calculated once for all the data that are smoothed with them.
+_SMOOTHING_CACHE = {}
+_SMOOTHING_CACHE_SIZE = 16
+
+def geodesic_smoothing_operator(indices, dist, sigma, n_vertices):
+	"""
+	Returns the cached sparse geodesic smoothing operator of a mesh. Each row holds the normalised Gaussian weights of a vertex and its neighbours, which are the same weights as calc_gd_fwhm, so the smoothed data are the product of the operator and the data (see geodesic_smoothing).
+	
+	Parameters
+	----------
+	indices : array
+		Vertex pairs of the edges (Nedges, 2)
+	dist : array
+		Geodesic distance of each edge (Nedges)
+	sigma : float
+		Scale of the Gaussian kernel (as in calc_gd_fwhm)
+	n_vertices : int
+		The number of vertices of the mesh
+
+	Returns
+	---------
+	operator : sparse matrix
+		CSR matrix (Nvertices, Nvertices) with rows that sum to one
+	"""
+	indices = np.ascontiguousarray(indices, dtype = np.int64)
+	dist = np.ascontiguousarray(dist, dtype = np.float64)
+	assert indices.ndim == 2 and indices.shape[1] == 2, "Error: indices must be vertex pairs (Nedges, 2)"
+	assert len(indices) == len(dist), "Error: indices and dist must have a row for each edge"
+	key = (n_vertices, float(sigma), hashlib.sha1(indices.tobytes() + dist.tobytes()).hexdigest())
+	if key not in _SMOOTHING_CACHE:
+		if len(_SMOOTHING_CACHE) >= _SMOOTHING_CACHE_SIZE:
+			_SMOOTHING_CACHE.clear()
+		# the normalisation of the Gaussian cancels when the weights are normalised
+		weights = np.exp(-dist**2 / (2 * sigma))
+		rows = np.concatenate((indices[:,1], indices[:,0], np.arange(n_vertices)))
+		columns = np.concatenate((indices[:,0], indices[:,1], np.arange(n_vertices)))
+		operator = scipy.sparse.csr_matrix((np.concatenate((weights, weights, np.ones(n_vertices))), (rows, columns)), shape = (n_vertices, n_vertices))
+		operator = scipy.sparse.diags(1 / np.asarray(operator.sum(1)).ravel()).dot(operator).tocsr()
+		_SMOOTHING_CACHE[key] = operator
+	return _SMOOTHING_CACHE[key]
+
+
+def geodesic_smoothing(data, indices, dist, sigma):
+	"""
+	Geodesic smoothing of many maps at once with the cached sparse smoothing operator of the mesh (see geodesic_smoothing_operator). The result is the same as calling calc_gd_fwhm for every map.
+	
+	Parameters
+	----------
+	data : array
+		Data (Nvertices) or (Nvertices, Nmaps) e.g., time points or simulations
+	indices : array
+		Vertex pairs of the edges (Nedges, 2)
+	dist : array
+		Geodesic distance of each edge (Nedges)
+	sigma : float
+		Scale of the Gaussian kernel (as in calc_gd_fwhm)
+
+	Returns
+	---------
+	smoothed : array
+		Smoothed data (Nvertices) or (Nvertices, Nmaps)
+	"""
+	operator = geodesic_smoothing_operator(indices, dist, sigma, data.shape[0])
+	with profile_stage('smooth'):
+		smoothed = operator.dot(data)
+	return(smoothed)
+
+
+def vertexwise_cosinor(endog, time_variable, outdir, period = [24.0], dmy_covariates = None, memory_budget = 256, n_perm = 0, q = 0.05, dtype = np.float64, smoothing = None):
+	"""
+	Vertex-wise (or voxel-wise) cosinor maps of data with many columns (e.g., surface or volume data). The data stay on disk as a memory map and are fitted in chunks of columns that are sized to the memory budget, and the maps are appended to a ResultStore chunk by chunk, so the peak memory does not grow with the number of vertices. Optionally, the maps are tested with permutations: every chunk uses the same permutations, and the maximum F across all vertices of each permutation gives FWER corrected p-values (see multi_roi_permutation).
+	
+	Parameters
+	----------
+	endog : array or string
+		Data (Nsubjects, Nvertices) as an array or memory map, or a *.npy file that is opened as a memory map.
+	time_variable : array
+		Time points (Nsubjects).
+	outdir : string
+		Directory of the ResultStore of the maps.
+	period : array
+		Period(s) of the cosinor model.
+	dmy_covariates : array
+		[optional] Dummy coded covariates of no interest.
+	memory_budget : float
+		Approximate memory of the working arrays of a chunk in megabytes.
+	n_perm : int
+		The number of permutations (0 skips permutation testing).
+	q : float
+		The false discovery rate of the FDR corrected p-values.
+	dtype : dtype
+		Floating point precision (see glm_cosinor).
+	smoothing : list
+		[optional] [indices, dist, sigma] of the mesh for geodesic smoothing of the data before fitting (see geodesic_smoothing). The rows of the data are smoothed in chunks and saved to the store as smoothed_endog (Nsubjects, Nvertices), which is fitted instead of the data.
+
+	Returns
+	---------
+	store : ResultStore
+		Maps with a row for each vertex: R2, MESOR, AMPLITUDE (Nvertices, Nperiods), ACROPHASE_24 (Nvertices, Nperiods), Fmodel, neglog10p (-log10 of the parametric p-values) and, with permutations, p_uncorrected, p_fwer and p_fdr (and max_Fnull with a row for each permutation). Vertices with too few observations are NaN.
+	"""
+	if isinstance(endog, str):
+		endog = np.load(endog, mmap_mode = 'r')
+	n, num_vertex = endog.shape
+	assert len(time_variable) == n, "Error: the data must have a row for each time point (Nsubjects, Nvertices)"
+	DF_Between = 2*len(period)
+	# working arrays per column: the data, design products and outputs of the fit (~8 x Nsubjects) and, with permutations, the permuted data of a chunk of 100 permutations
+	bytes_per_column = 8 * n * 8
+	if n_perm > 0:
+		bytes_per_column += 3 * 100 * n * np.dtype(dtype).itemsize
+	chunk_columns = int(max(1, min(num_vertex, memory_budget * 2**20 // bytes_per_column)))
+	store = ResultStore(outdir, mode = 'w', attributes = {'period': period,
+																		'n_vertices': num_vertex,
+																		'n_perm': n_perm,
+																		'chunk_columns': chunk_columns,
+																		'dtype': np.dtype(dtype).name,
+																		'smoothing_sigma': None if smoothing is None else float(smoothing[2])})
+	if smoothing is not None:
+		# smoothing mixes the vertices of each row, so the rows are smoothed in chunks before the columns are fitted
+		operator = geodesic_smoothing_operator(smoothing[0], smoothing[1], smoothing[2], num_vertex)
+		chunk_rows = int(max(1, memory_budget * 2**20 // (3 * 8 * num_vertex)))
+		with profile_stage('smooth'):
+			for start in range(0, n, chunk_rows):
+				store.append('smoothed_endog', operator.dot(np.array(endog[start:start + chunk_rows], dtype = np.float64).T).T)
+		endog = store['smoothed_endog']
+	permutations = None
+	if n_perm > 0:
+		permutations = np.array([np.random.permutation(n) for i in range(n_perm)])
+		max_Fnull = np.full(n_perm, -np.inf)
+	with profile_stage('vertexwise'):
+		for start in range(0, num_vertex, chunk_columns):
+			stop = min(start + chunk_columns, num_vertex)
+			chunk = np.array(endog[:,start:stop], dtype = np.float64)
+			results, DF_Within = glm_cosinor(chunk, time_variable, dmy_covariates = dmy_covariates, period = period, dtype = dtype, return_DF_Within = True)
+			R2, MESOR, _, AMPLITUDE, _, ACROPHASE, _, Fmodel = results[:8]
+			with np.errstate(invalid = 'ignore'):
+				neglog10p = np.where(np.isnan(Fmodel), np.nan, f_neglog10_pvalues(np.nan_to_num(Fmodel), DF_Between, np.maximum(DF_Within, 1)))
+			store.append_arrays(R2 = R2,
+										MESOR = MESOR,
+										AMPLITUDE = AMPLITUDE.T,
+										ACROPHASE_24 = acrophase_to_hours(ACROPHASE, period).T,
+										Fmodel = Fmodel,
+										neglog10p = neglog10p)
+			if n_perm > 0:
+				p_uncorrected, chunk_max = multi_roi_permutation(chunk, time_variable, period = period, dmy_covariates = dmy_covariates, dtype = dtype, permutations = permutations, Fmodel = Fmodel)[1::3]
+				store.append('p_uncorrected', p_uncorrected)
+				max_Fnull = np.maximum(max_Fnull, chunk_max)
+	if n_perm > 0:
+		# the FWER and FDR corrections need the null and p-values of all the vertices
+		max_Fnull = np.sort(max_Fnull)
+		store.append('max_Fnull', max_Fnull)
+		# the permutation p-values (exceedances + 1) / (n_perm + 1) have n_perm + 1 possible values, so the Benjamini-Hochberg step-up (see fdr_correction) is calculated from the counts of each value instead of sorting the p-values of all the vertices
+		counts = np.zeros(n_perm + 1, dtype = np.int64)
+		for start in range(0, num_vertex, chunk_columns):
+			p_uncorrected = np.array(store['p_uncorrected'][start:start + chunk_columns])
+			counts += np.bincount(np.rint(p_uncorrected[~np.isnan(p_uncorrected)] * (n_perm + 1)).astype(np.int64) - 1, minlength = n_perm + 1)
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			p_fdr_values = np.where(counts > 0, np.arange(1, n_perm + 2) / (n_perm + 1) * counts.sum() / np.cumsum(counts), np.inf)
+		p_fdr_values = np.minimum(np.minimum.accumulate(p_fdr_values[::-1])[::-1], 1.)
+		for start in range(0, num_vertex, chunk_columns):
+			stop = min(start + chunk_columns, num_vertex)
+			Fmodel = np.array(store['Fmodel'][start:stop])
+			p_uncorrected = np.array(store['p_uncorrected'][start:stop])
+			p_fwer = (n_perm - np.searchsorted(max_Fnull, Fmodel, side = 'left') + 1) / (n_perm + 1)
+			p_fdr = np.full(len(p_uncorrected), np.nan)
+			tested = ~np.isnan(p_uncorrected)
+			p_fdr[tested] = p_fdr_values[np.rint(p_uncorrected[tested] * (n_perm + 1)).astype(np.int64) - 1]
+			# vertices with missing values are not permuted
+			store.append_arrays(p_fwer = np.where(tested, p_fwer, np.nan), p_fdr = p_fdr)
+	return store
+
+
+def plot_permuted_model(endog, time_variable, period = [24.0], n_perm = 10000, outname = 'cosinor_plot_permuted.png', dmy_covariates = None, pdf = None, null_method = 'permutation'):
+	assert null_method in ['permutation', 'circular_block'], "Error: null_method must be 'permutation' or 'circular_block'"
+	if endog.ndim == 1:
+		endog = endog.reshape(len(endog),1)
+	null_label = 'permutations'
+	if null_method == 'circular_block':
+		# autocorrelation preserving surrogates (see circular_block_cosinor)
+		null_label = 'circular block surrogates'
 		fsubplots = False
-		Fperm = np.array([permute_cosinor(endog = resids, time_variable = time_variable, period = period, iterator = i) for i in range(n_perm)])
+		Fperm = circular_block_cosinor(endog, time_variable, period = period, n_surrogates = n_perm, dmy_covariates = dmy_covariates)[2]
 	else:
-		print("Multiple periods detected [%s]" % " ".join(map(str,period)))
-		fsubplots = True
-		Fvalues = np.array(permute_F_ratio_cosinor(endog, time_variable, period, 0, randomise=False)[1])
-		Fperm, Fperiod = zip(*[permute_F_ratio_cosinor(resids, time_variable, period, i, randomise=True) for i in range(n_perm)])
-		Fperm = np.array(Fperm)
-		Fperiod = np.array(Fperiod)
+		if dmy_covariates is not None:
+			# Freedman-Lane permutations of the reduced model residuals
+			reduced_fitted, resids = freedman_lane_residuals(endog, dmy_covariates)
+		else:
+			reduced_fitted = None
+			resids = residual_cosinor(endog = endog, time_var = time_variable, period = period)
+		with profile_stage('permute'):
+			if len(period) == 1:
+				fsubplots = False
+				Fperm = np.array([permute_cosinor(endog = resids, time_variable = time_variable, period = period, iterator = i, dmy_covariates = dmy_covariates, reduced_fitted = reduced_fitted) for i in range(n_perm)])
+			else:
+				print("Multiple periods detected [%s]" % " ".join(map(str,period)))
+				fsubplots = True
+				Fvalues = np.array(permute_F_ratio_cosinor(endog, time_variable, period, 0, covars = dmy_covariates, randomise=False)[1])
+				Fperm, Fperiod = zip(*[permute_F_ratio_cosinor(resids, time_variable, period, i, covars = dmy_covariates, randomise=True, reduced_fitted = reduced_fitted) for i in range(n_perm)])
+				Fperm = np.array(Fperm)
+				Fperiod = np.array(Fperiod)
 
 	n = len(time_variable)
 	k = len(period)*2 + 1
 	DF_Between = k - 1 # aka df model
-	DF_Within = n - k # aka df residuals
 
-	R2, MESOR, SE_MESOR, AMPLITUDE, SE_AMPLITUDE, ACROPHASE, SE_ACROPHASE, Fmodel = glm_cosinor(endog = endog, 
+	results, DF_Within = glm_cosinor(endog = endog, 
 								time_var = time_variable,
+								dmy_covariates = dmy_covariates,
 								period = period,
 								calc_MESOR = True,
-								output_fit_only = False)[:8]
+								output_fit_only = False,
+								return_DF_Within = True)
+	R2, MESOR, SE_MESOR, AMPLITUDE, SE_AMPLITUDE, ACROPHASE, SE_ACROPHASE, Fmodel = results[:8]
+	DF_Within = int(np.min(DF_Within))
+	endog = covariate_adjusted_endog(endog, time_variable, period, dmy_covariates)
 
 	model_line, times = create_cosinor_fit(period, 
 														MESOR[0],
 														AMPLITUDE,
 														ACROPHASE,
 														time_space = np.linspace(0,24,200))
-	plt.figure(figsize=(12,8))
-	plt.subplot(2, 1, 1)
-	plt.title("Plot of the Cosinor Model")
-	plt.plot(times, model_line, c='k')
-	plt.scatter(time_variable, endog, marker = '.')
-	plt.fill_between(times, model_line - np.mean(np.squeeze(SE_AMPLITUDE)), model_line + np.mean(np.squeeze(SE_AMPLITUDE)), alpha=0.2, color='k')
+	fig = figure_template(figsize = (12,8))
+	ax = fig.add_subplot(2, 1, 1)
+	ax.set_title("Plot of the Cosinor Model")
+	ax.plot(times, model_line, c='k')
+	ax.scatter(time_variable, endog, marker = '.')
+	ax.fill_between(times, model_line - np.mean(np.squeeze(SE_AMPLITUDE)), model_line + np.mean(np.squeeze(SE_AMPLITUDE)), alpha=0.2, color='k')
 	# Mesor
-	plt.axhline(y=MESOR[0], color='k', alpha = 0.2)
-	plt.axhline(y=(MESOR[0] - np.squeeze(SE_MESOR)), color='k', ls=':', alpha = 0.2)
-	plt.axhline(y=(MESOR[0] + np.squeeze(SE_MESOR)), color='k', ls=':', alpha = 0.2)
+	ax.axhline(y=MESOR[0], color='k', alpha = 0.2)
+	ax.axhline(y=(MESOR[0] - np.squeeze(SE_MESOR)), color='k', ls=':', alpha = 0.2)
+	ax.axhline(y=(MESOR[0] + np.squeeze(SE_MESOR)), color='k', ls=':', alpha = 0.2)
 
 	ACROPHASE_24 = np.zeros_like(ACROPHASE)
 	for j, per in enumerate(period):
@@ -443,27 +1651,27 @@ def plot_permuted_model(endog, time_variable, period = [24.0], n_perm = 10000, o
 		legend_patch = []
 		for i, a_ in enumerate(a):
 			legend_patch.append(mpatches.Patch(color=color_arr[i], hatch = '|', label='Period [%1.1f]' % period[i]))
-			plt.axvline(x=a_.squeeze(), color=color_arr[i], alpha = 0.2)
-			plt.axvline(x=(a_ - a_se[i]), color=color_arr[i], ls=':', alpha = 0.2)
-			plt.axvline(x=(a_ + a_se[i]), color=color_arr[i], ls=':', alpha = 0.2)
-		plt.legend(handles=legend_patch)
+			ax.axvline(x=a_.squeeze(), color=color_arr[i], alpha = 0.2)
+			ax.axvline(x=(a_ - a_se[i]), color=color_arr[i], ls=':', alpha = 0.2)
+			ax.axvline(x=(a_ + a_se[i]), color=color_arr[i], ls=':', alpha = 0.2)
+		ax.legend(handles=legend_patch)
 	else:
-		plt.axvline(x=a.squeeze(), color='k', alpha = 0.2)
-		plt.axvline(x=(a - a_se), color='k', ls=':', alpha = 0.2)
-		plt.axvline(x=(a + a_se), color='k', ls=':', alpha = 0.2)
-	plt.xticks(list(range(25)))
+		ax.axvline(x=a.squeeze(), color='k', alpha = 0.2)
+		ax.axvline(x=(a - a_se), color='k', ls=':', alpha = 0.2)
+		ax.axvline(x=(a + a_se), color='k', ls=':', alpha = 0.2)
+	ax.set_xticks(list(range(25)))
 
-	plt.subplot(2, 1, 2)
-	plt.title("Histogram of F(model) values from %d permutations" % (n_perm))
-	n_, bins_, patches_ =  plt.hist(Fperm, bins=50)
-	txt = r"$y(t) = %1.2f $" % (MESOR)
+	ax = fig.add_subplot(2, 1, 2)
+	ax.set_title("Histogram of F(model) values from %d %s" % (n_perm, null_label))
+	n_, bins_, patches_ =  ax.hist(Fperm, bins=50)
+	txt = r"$y(t) = %1.2f $" % float(np.squeeze(MESOR))
 
 	# F distribution null pdf line
 	x = np.linspace(f.ppf(0.001, DF_Between, DF_Within),f.ppf(0.999, DF_Between, DF_Within), 1000)
-	plt.plot(x, f.pdf(x, DF_Between, DF_Within) * sum(n_ * np.diff(bins_)), ls = ':', c = 'k', alpha = 0.5)
+	ax.plot(x, f.pdf(x, DF_Between, DF_Within) * sum(n_ * np.diff(bins_)), ls = ':', c = 'k', alpha = 0.5)
 
 	for i, per in enumerate(period):
-		txt += r"$+ %1.3f\mathrm{cos} (2 \pi (t)/%d %1.3f)$" % (AMPLITUDE[i], per, ACROPHASE[i])
+		txt += r"$+ %1.3f\mathrm{cos} (2 \pi (t)/%d %1.3f)$" % (float(np.squeeze(AMPLITUDE[i])), per, float(np.squeeze(ACROPHASE[i])))
 
 	if np.squeeze(Fmodel) > Fperm.max():
 		pp_text = r'$\mathrm{p(permuted)} < 0.0001$'
@@ -473,39 +1681,38 @@ def plot_permuted_model(endog, time_variable, period = [24.0], n_perm = 10000, o
 			p_array[j] = np.true_divide(j,n_perm)
 		stat_loc = np.searchsorted(np.sort(Fperm.squeeze()), Fmodel, side="right")
 		pp = 1 - p_array[stat_loc]
-		pp_text = r'$\mathrm{p(permuted)} = %1.3e$' % pp
+		pp_text = r'$\mathrm{p(permuted)} = %1.3e$' % float(np.squeeze(pp))
 
 	critF = np.sort(Fperm.squeeze())[::-1][int(0.05*n_perm)]
 	textstr = '\n'.join((
 		txt,
-		r'R^2 = %1.2f' % R2,
-		r'F(%d,%d) = %1.2f' % (DF_Between, DF_Within, Fmodel),
+		r'R^2 = %1.2f' % float(np.squeeze(R2)),
+		r'F(%d,%d) = %1.2f' % (DF_Between, DF_Within, float(np.squeeze(Fmodel))),
 		r'F(alpha=0.05) = %1.2f' % (critF),
-		r'$\mathrm{p(parametric)}=%1.3e$' % (f.sf(Fmodel, DF_Between, DF_Within)),
+		r'$\mathrm{p(parametric)}=%s$' % format_neglog10_pvalue(f_neglog10_pvalues(Fmodel, DF_Between, DF_Within)),
 		pp_text))
 
 	left, width = .25, .5
 	bottom, height = .25, .5
 	right = left + width
 	top = bottom + height
-	plt.text(0.6 - ((len(period)-1)*0.12), 0.6, textstr,
-					transform=plt.gca().transAxes,
+	ax.text(0.6 - ((len(period)-1)*0.12), 0.6, textstr,
+					transform=ax.transAxes,
 					bbox=dict(facecolor='b', alpha=0.1))
-	plt.axvline(x=critF, color='k', alpha = 0.2)
+	ax.axvline(x=critF, color='k', alpha = 0.2)
 	if Fmodel > critF:
-		plt.axvline(x=Fmodel, color='g', alpha = .8, ls = '--')
+		ax.axvline(x=Fmodel, color='g', alpha = .8, ls = '--')
 	else:
-		plt.axvline(x=Fmodel, color='r', alpha = .8, ls = '--')
-	plt.savefig(outname, transparent=False, bbox_inches='tight')
-	plt.close()
+		ax.axvline(x=Fmodel, color='r', alpha = .8, ls = '--')
+	save_figure(fig, outname, pdf = pdf)
 	if fsubplots:
 		outname = "subplots_" + outname
-		plt.figure(figsize=(12,8))
+		fig = figure_template(figsize = (12,8))
 		n_per = len(period)
-		plt.title("Histogram of F-values for each period from %d permutations" % (n_perm))
+		fig.suptitle("Histogram of F-values for each period from %d permutations" % (n_perm))
 		for i in range(n_per):
-			plt.subplot(n_per, 1, int(i+1))
-			plt.hist(Fperiod[:,i].squeeze(), bins=50)
+			ax = fig.add_subplot(n_per, 1, int(i+1))
+			ax.hist(Fperiod[:,i].squeeze(), bins=50)
 			critF = np.sort(Fperiod[:,i].squeeze())[::-1][int(0.05*n_perm)]
 
 			if np.squeeze(Fvalues[i]) > Fperiod[:,i].max():
@@ -516,29 +1723,45 @@ def plot_permuted_model(endog, time_variable, period = [24.0], n_perm = 10000, o
 					p_array[j] = np.true_divide(j,n_perm)
 				stat_loc = np.searchsorted(np.sort(Fperiod[:,i].squeeze()), Fvalues[i], side="right")
 				pp = 1 - p_array[stat_loc]
-				pp_text = r'$\mathrm{p(permuted)} = %1.3e$' % pp
+				pp_text = r'$\mathrm{p(permuted)} = %1.3e$' % float(np.squeeze(pp))
 
 			textstr = '\n'.join((
 				r'Period [%1.1f]' % (period[i]),
-				r'F(%d,%d) = %1.2f' % (2, DF_Within, Fvalues[i]),
+				r'F(%d,%d) = %1.2f' % (2, DF_Within, float(np.squeeze(Fvalues[i]))),
 				r'F(alpha=0.05) = %1.2f' % (critF),
-				r'$\mathrm{p(parametric)}=%1.3e$' % (f.sf(Fvalues[i], 2, DF_Within)),
+				r'$\mathrm{p(parametric)}=%s$' % format_neglog10_pvalue(f_neglog10_pvalues(Fvalues[i], 2, DF_Within)),
 				pp_text))
-			plt.text(0.5, 0.5, textstr,
-							transform=plt.gca().transAxes,
+			ax.text(0.5, 0.5, textstr,
+							transform=ax.transAxes,
 							bbox=dict(facecolor='b', alpha=0.1))
-			plt.axvline(x=critF, color='k', alpha = 0.2)
+			ax.axvline(x=critF, color='k', alpha = 0.2)
 			if Fvalues[i] > critF:
-				plt.axvline(x=Fvalues[i], color='g', alpha = .8, ls = '--')
+				ax.axvline(x=Fvalues[i], color='g', alpha = .8, ls = '--')
 			else:
-				plt.axvline(x=Fvalues[i], color='r', alpha = .8, ls = '--')
-		plt.savefig(outname, transparent=False, bbox_inches='tight')
-		plt.close()
+				ax.axvline(x=Fvalues[i], color='r', alpha = .8, ls = '--')
+		save_figure(fig, outname, pdf = pdf)
 
 
 def lm_residuals(endog, exog):
 	"""
+	Residuals of a linear model. A column of ones is added if the first column of exog is not an intercept.
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array (Nsubjects, Nvariables)
+	exog : array
+		Exogenous (independent) dummy coded variables (Nsubjects, Kvariables). Sparse matrices (without an intercept column) are also accepted.
+
+	Returns
+	---------
+	endog : array
+		The residuals
 	"""
+	if scipy.sparse.issparse(exog):
+		exog = scipy.sparse.hstack([np.ones((exog.shape[0],1)), exog]).tocsr()
+		a = np.linalg.solve((exog.T @ exog).toarray(), exog.T @ endog)
+		return endog - exog @ a
 	if exog.ndim == 1:
 		exog = stack_ones(exog)
 	if np.mean(exog[:,0]) != 1:
@@ -548,8 +1771,8 @@ def lm_residuals(endog, exog):
 	return endog
 
 
-def project_cosionor_model(MESOR, AMPLITUDE, ACROPHASE, TIME_VAR, PERIOD = [24.0]):
-	TIME_VAR = np.array(TIME_VAR)
+def project_cosionor_model(MESOR, AMPLITUDE, ACROPHASE, TIME_VAR, PERIOD = [24.0], dtype = None):
+	TIME_VAR = np.array(TIME_VAR, dtype = np.float64)
 	n = len(TIME_VAR)
 	try:
 		r = len(MESOR)
@@ -558,46 +1781,751 @@ def project_cosionor_model(MESOR, AMPLITUDE, ACROPHASE, TIME_VAR, PERIOD = [24.0
 	proj = MESOR
 	for j, per in enumerate(PERIOD):
 		proj = proj + AMPLITUDE[j,:]*np.cos((np.divide(2*np.pi*np.tile(TIME_VAR,r).reshape(r,n).T, per) + ACROPHASE[j,:]))
+	if dtype is not None:
+		proj = np.asarray(proj, dtype = dtype)
 	return proj
 
 
-def residual_cosinor(endog, time_var, period = [24.0]):
-	n = endog.shape[0]
-	num_period = len(period)
-	exog_vars = np.ones((n))
-	for i in range(num_period):
-		exog_vars = np.column_stack((exog_vars,np.cos(np.divide(2.0*np.pi*time_var, period[i]))))
-		exog_vars = np.column_stack((exog_vars,np.sin(np.divide(2.0*np.pi*time_var, period[i]))))
-	return np.array(lm_residuals(endog, exog_vars))
+# the steepness of the anti-logistic cosinor is bounded; at BETA = 50 the rhythm is practically a square wave
+EXTENDED_COSINOR_MAX_BETA = 50.
+# the default maximum number of Levenberg-Marquardt iterations of the extended cosinor
+EXTENDED_COSINOR_MAX_ITERATIONS = 100
+
+def antilogistic_cosinor(time_var, params, period = 24.0, jacobian = False):
+	"""
+	Anti-logistic extended cosinor model (Marler et al., 2006) for rhythms with sharp or asymmetric peaks. The cosine of the time is transformed by a logistic function, which is parameterised by its midline (MESOR) and half its range (AMPLITUDE) so that they are comparable to the cosinor:
+	
+	y = MESOR + AMPLITUDE * (2 * L(BETA * (cos(2*pi*(t - ACROPHASE_24)/period) - ALPHA)) - 1), L(x) = 1 / (1 + exp(-x))
+	
+	ALPHA sets the fraction of the period that the rhythm is up (the width of the peak), and BETA the steepness of its rise and fall. Small BETA approximates a cosine, and large BETA approximates a square wave.
+	
+	Parameters
+	----------
+	time_var : array
+		Time points (Nsubjects) or (Nsubjects, Nvariables)
+	params : array
+		[MESOR, AMPLITUDE, ALPHA, BETA, ACROPHASE_24] (5) or (5, Nvariables)
+	period : float
+		The period of the rhythm
+	jacobian : bool
+		Also return the partial derivatives of the model with respect to the parameters
+
+	Returns
+	---------
+	fitted : array
+		The model at the time points (Nsubjects, Nvariables)
+	J : array
+		[optional] Jacobian (Nsubjects, Nvariables, 5)
+	"""
+	params = np.asarray(params, dtype = np.float64).reshape(5, -1)
+	time_var = np.asarray(time_var, dtype = np.float64)
+	if time_var.ndim == 1:
+		time_var = time_var[:,np.newaxis]
+	omega = 2*np.pi / period
+	phase = omega * (time_var - params[4])
+	cosine = np.cos(phase)
+	logistic = expit(params[3] * (cosine - params[2]))
+	fitted = params[0] + params[1] * (2 * logistic - 1)
+	if not jacobian:
+		return fitted
+	slope = 2 * params[1] * logistic * (1 - logistic)
+	J = np.empty(fitted.shape + (5,))
+	J[...,0] = 1
+	J[...,1] = 2 * logistic - 1
+	J[...,2] = -slope * params[3]
+	J[...,3] = slope * (cosine - params[2])
+	J[...,4] = slope * params[3] * omega * np.sin(phase)
+	return fitted, J
+
+
+def extended_cosinor_start(endog, time_var, period = 24.0):
+	"""
+	Warm start of the extended cosinor from the linear cosinor: the logistic with ALPHA = 0 and BETA = 2 is nearly linear in the cosine, so it takes the MESOR, acrophase and (scaled) amplitude of the linear fit of each variable (with its own time points).
+	
+	Returns
+	---------
+	params : array
+		[MESOR, AMPLITUDE, ALPHA, BETA, ACROPHASE_24] (5, Nvariables)
+	"""
+	endog = np.asarray(endog, dtype = np.float64).reshape(len(endog), -1)
+	time_var = np.broadcast_to(np.asarray(time_var, dtype = np.float64).reshape(len(endog), -1), endog.shape)
+	radians = 2*np.pi*time_var / period
+	exog_vars = np.stack((np.ones_like(radians), np.cos(radians), np.sin(radians)), 2)
+	coef = np.linalg.solve(np.einsum('nvk,nvl->vkl', exog_vars, exog_vars), np.einsum('nvk,nv->vk', exog_vars, endog)[:,:,np.newaxis])[:,:,0].T
+	AMPLITUDE = np.sqrt(coef[1]**2 + coef[2]**2)
+	# y = MESOR + AMPLITUDE * cos(2*pi*(t - ACROPHASE_24)/period)
+	ACROPHASE_24 = np.mod(np.arctan2(coef[2], coef[1]) * period / (2*np.pi), period)
+	beta = 2.
+	# the peak of the logistic is 2*L(BETA) - 1 = tanh(BETA/2)
+	AMPLITUDE = AMPLITUDE / np.tanh(beta / 2)
+	return np.array([coef[0], AMPLITUDE, np.zeros_like(AMPLITUDE), np.full_like(AMPLITUDE, beta), ACROPHASE_24])
+
+
+def fit_extended_cosinor(endog, time_var, period = 24.0, initial = None, max_iterations = EXTENDED_COSINOR_MAX_ITERATIONS, tol = 1e-6, gtol = 1e-8, xtol = 1e-8, warn = True, n_covariates = 0):
+	"""
+	Fits the anti-logistic extended cosinor (see antilogistic_cosinor) to all variables at once with a batched Levenberg-Marquardt solver. The Jacobians of all variables are evaluated together, the damped normal equations of each variable are solved as one stacked system, each variable has its own damping, and variables drop out of the iterations once they have converged. The fits start from the linear cosinor (see extended_cosinor_start) unless initial parameters are given.
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array (Nsubjects) or (Nsubjects, Nvariables)
+	time_var : array
+		Time points (Nsubjects), or (Nsubjects, Nvariables) for variables with different time points (e.g., sliding windows or simulations)
+	period : float
+		The period of the rhythm
+	initial : array
+		[optional] Starting parameters (5) or (5, Nvariables)
+	max_iterations : int
+		The maximum number of iterations
+	tol : float
+		Convergence tolerance of the relative decrease of the residual sum of squares
+	gtol : float
+		Convergence tolerance of the gradient: the largest correlation of the residuals with a (scaled) column of the Jacobian
+	xtol : float
+		Convergence tolerance of the relative size of the (scaled) step of the parameters
+	warn : bool
+		Print a warning if some variables did not converge in max_iterations
+	n_covariates : int
+		The number of covariates that were removed from the data before fitting (see covariate_adjusted_endog), which are subtracted from the residual degrees of freedom. A number for each variable (Nvariables) is also accepted.
+
+	Returns
+	---------
+	R2 : array
+		R-squared (Nvariables)
+	params : array
+		[MESOR, AMPLITUDE, ALPHA, BETA, ACROPHASE_24] (5, Nvariables). The fits are reported with positive AMPLITUDE and BETA (at most EXTENDED_COSINOR_MAX_BETA), and ACROPHASE_24 in [0, period).
+	SE_params : array
+		Asymptotic standard errors of the parameters (5, Nvariables)
+	Fmodel : array
+		F-values of the model against the mean (Nvariables) with 4 and Nsubjects - 5 - n_covariates degrees of freedom
+	n_iterations : array
+		The number of iterations of each variable (Nvariables)
+	"""
+	endog = np.asarray(endog, dtype = np.float64)
+	flat = endog.ndim == 1
+	endog = endog.reshape(len(endog), -1)
+	n, num_var = endog.shape
+	time_var = np.broadcast_to(np.asarray(time_var, dtype = np.float64).reshape(n, -1), endog.shape)
+	if initial is None:
+		params = extended_cosinor_start(endog, time_var, period)
+	else:
+		params = np.array(np.broadcast_to(np.asarray(initial, dtype = np.float64).reshape(5, -1), (5, num_var)))
+	SS_Residuals = np.sum((endog - antilogistic_cosinor(time_var, params, period))**2, 0)
+	damping = np.full(num_var, 1e-3)
+	damping_growth = np.full(num_var, 2.)
+	n_iterations = np.zeros(num_var, dtype = int)
+	active = np.arange(num_var)
+	with profile_stage('extended cosinor'):
+		for iteration in range(max_iterations):
+			fitted, J = antilogistic_cosinor(time_var[:,active], params[:,active], period, jacobian = True)
+			# ALPHA or BETA at their bounds are held while the gradient points out of the bounds (projected Levenberg-Marquardt)
+			gradient = np.einsum('nvk,nv->vk', J[...,2:4], endog[:,active] - fitted)
+			held = np.zeros((len(active), 5), dtype = bool)
+			held[:,2] = (np.abs(params[2,active]) >= 1) & (gradient[:,0] * params[2,active] > 0)
+			held[:,3] = (np.abs(params[3,active]) >= EXTENDED_COSINOR_MAX_BETA) & (gradient[:,1] * params[3,active] > 0)
+			J = J * ~held
+			JtJ = np.einsum('nvk,nvl->vkl', J, J)
+			Jtr = np.einsum('nvk,nv->vk', J, endog[:,active] - fitted)
+			# Marquardt scaling of the damping by the diagonal of J'J (the floor keeps flat directions solvable)
+			diagonal = np.einsum('vkk->vk', JtJ)
+			scale = diagonal + 1e-12 * (1 + diagonal.max(1, keepdims = True))
+			damped = JtJ + (damping[active,np.newaxis] * scale)[:,:,np.newaxis] * np.eye(5)
+			proposal = params[:,active] + np.linalg.solve(damped, Jtr[:,:,np.newaxis])[:,:,0].T
+			# the rhythm crosses the threshold ALPHA of the cosine only within [-1, 1], and BETA diverges for square waves, where the fit no longer changes
+			proposal[2] = np.clip(proposal[2], -1, 1)
+			proposal[3] = np.clip(proposal[3], -EXTENDED_COSINOR_MAX_BETA, EXTENDED_COSINOR_MAX_BETA)
+			step = proposal - params[:,active]
+			SS_proposal = np.sum((endog[:,active] - antilogistic_cosinor(time_var[:,active], proposal, period))**2, 0)
+			improved = SS_proposal < SS_Residuals[active]
+			# convergence of the residual sum of squares, the gradient or the step (scaled by the diagonal of J'J as in MINPACK)
+			small_decrease = improved & ((SS_Residuals[active] - SS_proposal) <= tol * SS_proposal)
+			small_gradient = np.max(np.abs(Jtr) / np.sqrt(scale * SS_Residuals[active,np.newaxis]), 1) <= gtol
+			small_step = improved & (np.sqrt(np.sum(step**2 * scale.T, 0)) <= xtol * (np.sqrt(np.sum(params[:,active]**2 * scale.T, 0)) + xtol))
+			converged = small_decrease | small_gradient | small_step | (damping[active] > 1e6)
+			# Nielsen's update of the damping from the ratio of the actual and predicted decrease of the residual sum of squares
+			predicted_decrease = np.einsum('kv,vk->v', step, Jtr + damping[active,np.newaxis] * scale * step.T)
+			with np.errstate(divide = 'ignore', invalid = 'ignore'):
+				gain = np.minimum((SS_Residuals[active] - SS_proposal) / predicted_decrease, 1.)
+			damping[active] = np.where(improved, damping[active] * np.maximum(1/3., 1 - (2 * np.nan_to_num(gain, nan = 1.) - 1)**3), damping[active] * damping_growth[active])
+			damping_growth[active] = np.where(improved, 2., damping_growth[active] * 2)
+			params[:,active[improved]] = proposal[:,improved]
+			SS_Residuals[active[improved]] = SS_proposal[improved]
+			n_iterations[active] += 1
+			active = active[~converged]
+			if len(active) == 0:
+				break
+	if (len(active) > 0) and warn:
+		print("Warning: the extended cosinor fit of %d variable(s) did not converge in %d iterations" % (len(active), max_iterations))
+
+	J = antilogistic_cosinor(time_var, params, period, jacobian = True)[1]
+	DF_Within = n - 5 - np.broadcast_to(np.asarray(n_covariates, dtype = np.float64), (num_var,))
+	covariance = np.linalg.pinv(np.einsum('nvk,nvl->vkl', J, J)) * (SS_Residuals / DF_Within)[:,np.newaxis,np.newaxis]
+	# equivalent parameters with positive amplitude and steepness (the rhythm is shifted by half a period)
+	transform = np.broadcast_to(np.eye(5), (num_var, 5, 5)).copy()
+	negative = params[1] < 0
+	params[1:3, negative] *= -1
+	params[4, negative] += period / 2
+	transform[negative, 1] *= -1
+	transform[negative, 2] *= -1
+	negative = params[3] < 0
+	params[2:4, negative] *= -1
+	params[4, negative] += period / 2
+	transform[negative, 2] *= -1
+	transform[negative, 3] *= -1
+	params[4] = np.mod(params[4], period)
+	covariance = np.einsum('vij,vjk,vlk->vil', transform, covariance, transform)
+	SE_params = np.sqrt(np.abs(np.einsum('vkk->kv', covariance)))
+
+	SS_Total = np.sum((endog - endog.mean(0))**2, 0)
+	R2 = 1 - (SS_Residuals / SS_Total)
+	Fmodel = ((SS_Total - SS_Residuals) / 4) / (SS_Residuals / DF_Within)
+	if flat:
+		return (R2[0], params[:,0], SE_params[:,0], Fmodel[0], n_iterations[0])
+	return (R2, params, SE_params, Fmodel, n_iterations)
+
+
+def residual_cosinor(endog, time_var, period = [24.0], dmy_covariates = None, robust = None):
+	"""
+	Residuals of the cosinor model
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array (Nsubjects, Nvariables)
+	time_var : array
+		Time points.
+	period : array
+		Period(s) of the cosinor model.
+	dmy_covariates : array
+		[optional] Dummy coded covariates of no interest fitted jointly with the cosinor model.
+	robust : string
+		[optional] Residuals of the robust 'huber' or 'tukey' fit (see robust_lstsqr), so that outliers do not distort the fit.
+
+	Returns
+	---------
+	resids : array
+		The residuals of the cosinor model (NaN for missing values)
+	"""
+	if np.isnan(endog).any():
+		# variables that share the same missing rows are fitted together
+		endog = np.asarray(endog, dtype = np.float64)
+		resids = np.full(endog.shape, np.nan)
+		endog_2d = endog.reshape(len(endog), -1)
+		resids_2d = resids.reshape(len(endog), -1)
+		time_var = np.asarray(time_var)
+		for rows, columns in missing_data_groups(endog_2d):
+			if np.sum(rows) <= 1 + 2*len(period):
+				continue
+			group_covariates = None
+			if dmy_covariates is not None:
+				group_covariates = independent_covariates(np.asarray(dmy_covariates).reshape(len(endog),-1)[rows], time_var[rows], period)
+			resids_2d[np.ix_(rows, columns)] = residual_cosinor(endog_2d[rows][:,columns], time_var[rows], period = period, dmy_covariates = group_covariates, robust = robust)
+		return resids
+	exog_vars = dummy_code_cosine(time_var, period, dmy_covariates)
+	if robust is not None:
+		a = robust_lstsqr(exog_vars, endog, method = robust)[0]
+	else:
+		a = np.dot(cached_factorisation(exog_vars)[1], endog)
+	return np.array(endog - np.dot(exog_vars, a))
+
+
+def covariate_adjusted_endog(endog, time_var, period, dmy_covariates):
+	"""
+	Removes the covariate effects estimated by the joint cosinor model (e.g., for plotting). With demeaned covariates, the adjusted data are at the mean of the covariates.
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array (Nsubjects, Nvariables)
+	time_var : array
+		Time points.
+	period : array
+		Period(s) of the cosinor model.
+	dmy_covariates : array
+		Dummy coded covariates of no interest.
+
+	Returns
+	---------
+	endog : array
+		The covariate adjusted endogenous variable
+	"""
+	if dmy_covariates is None:
+		return endog
+	exog_vars = dummy_code_cosine(time_var, period, dmy_covariates)
+	a = np.dot(cached_factorisation(exog_vars)[1], endog)
+	return endog - np.dot(exog_vars[:,(1+2*len(period)):], a[(1+2*len(period)):])
 
 
-def periodogram(endog, time_variable, periodrange = [3, 24], step = 1.0, save_plot = False, outname = 'periodogram_plot.png'):
+def independent_covariates(dmy_covariates, time_var, period = [24.0], tol = 1e-8):
+	"""
+	Removes covariates that are linearly dependent on the cosinor terms or on the preceding covariates (e.g., dummy coded levels that are absent from a subset of the data).
+	
+	Parameters
+	----------
+	dmy_covariates : array
+		Dummy coded covariates of no interest (Nsubjects, Kcovariates).
+	time_var : array
+		Time points.
+	period : array
+		Period(s) of the cosinor model.
+	tol : float
+		Relative tolerance on the diagonal of the R matrix from the QR decomposition.
+
+	Returns
+	---------
+	dmy_covariates : array
+		The linearly independent covariates or None if there are none.
+	"""
+	dmy_covariates = np.asarray(dmy_covariates).reshape(len(time_var),-1)
+	exog_vars = dummy_code_cosine(time_var, period, dmy_covariates)
+	R_diag = np.abs(np.diag(np.linalg.qr(exog_vars, mode = 'r')))
+	keep = (R_diag > (tol * R_diag.max()))[(1+2*len(period)):]
+	if not keep.any():
+		return None
+	return dmy_covariates[:,keep]
+
+
+def freedman_lane_residuals(endog, dmy_covariates):
+	"""
+	Fitted values and residuals of the reduced (intercept + covariates) model used for Freedman-Lane permutations. Permuted data are created by adding the permuted residuals to the fitted values.
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array (Nsubjects, Nvariables)
+	dmy_covariates : array
+		Dummy coded covariates of no interest.
+
+	Returns
+	---------
+	reduced_fitted : array
+		Fitted values of the reduced model
+	reduced_resids : array
+		Residuals of the reduced model
+	"""
+	exog_vars = stack_ones(dmy_covariates)
+	reduced_fitted = np.dot(exog_vars, np.dot(cached_factorisation(exog_vars)[1], endog))
+	return (reduced_fitted, endog - reduced_fitted)
+
+
+def _extirpolate(x, y, n_grid, M = 4):
+	# Press & Rybicki (1989) extirpolation of the values y (Nsubjects, Nvariables) at the fractional positions x onto a regular grid (Ngrid, Nvariables) with Lagrange weights of M points
+	result = np.zeros((n_grid,) + y.shape[1:], dtype = y.dtype)
+	integers = (x % 1 == 0)
+	np.add.at(result, x[integers].astype(int), y[integers])
+	x = x[~integers]
+	y = y[~integers]
+	ilo = np.clip((x - M // 2).astype(int), 0, n_grid - M)
+	numerator = y * np.prod(x - ilo - np.arange(M)[:,np.newaxis], 0).reshape((-1,) + (1,) * (y.ndim - 1))
+	denominator = float(np.prod(np.arange(1, M)))
+	for j in range(M):
+		if j > 0:
+			denominator *= j / (j - M)
+		ind = ilo + (M - 1 - j)
+		np.add.at(result, ind, numerator / (denominator * (x - ind)).reshape((-1,) + (1,) * (y.ndim - 1)))
+	return result
+
+
+def trig_sums(time_variable, h, f0, df, n_frequencies, freq_factor = 1, use_fft = True, oversampling = 10, M = 6):
+	"""
+	Sums of h*sin(2*pi*f*t) and h*cos(2*pi*f*t) over the time points for the regular frequency grid f = freq_factor*(f0 + df*j), j = 0 ... n_frequencies - 1. With use_fft, h is extirpolated onto a regular time grid and the sums of all frequencies are obtained by an FFT (Press & Rybicki, 1989) in O(N log N).
+	
+	Parameters
+	----------
+	time_variable : array
+		Time points (Nsubjects)
+	h : array
+		Weights (Nsubjects) or (Nsubjects, Nvariables)
+	f0 : float
+		The first frequency
+	df : float
+		The frequency step
+	n_frequencies : int
+		The number of frequencies
+	freq_factor : float
+		Multiplier of the frequencies (e.g., 2 for the sums at twice the frequencies)
+	use_fft : bool
+		Use extirpolation and FFT instead of the direct sums.
+	oversampling : int
+		Oversampling of the FFT grid relative to the number of frequencies.
+	M : int
+		The number of grid points used for the extirpolation of each time point.
+
+	Returns
+	---------
+	S : array
+		Sums of the sines (Nfrequencies, ...)
+	C : array
+		Sums of the cosines (Nfrequencies, ...)
+	"""
+	df *= freq_factor
+	f0 *= freq_factor
+	time_variable = np.asarray(time_variable, dtype = np.float64)
+	h = np.asarray(h, dtype = np.float64)
+	if use_fft:
+		n_fft = int(2**np.ceil(np.log2(n_frequencies * oversampling)))
+		t0 = time_variable.min()
+		h = h * np.exp(2j * np.pi * f0 * (time_variable - t0)).reshape((-1,) + (1,) * (h.ndim - 1))
+		grid = _extirpolate(((time_variable - t0) * n_fft * df) % n_fft, h, n_fft, M)
+		fft_grid = np.fft.ifft(grid, axis = 0)[:n_frequencies]
+		if t0 != 0:
+			frequencies = f0 + df * np.arange(n_frequencies)
+			fft_grid *= np.exp(2j * np.pi * t0 * frequencies).reshape((-1,) + (1,) * (h.ndim - 1))
+		C = n_fft * fft_grid.real
+		S = n_fft * fft_grid.imag
+	else:
+		radians = 2 * np.pi * (f0 + df * np.arange(n_frequencies))[:,np.newaxis] * time_variable
+		C = np.dot(np.cos(radians), h)
+		S = np.dot(np.sin(radians), h)
+	return(S, C)
+
+
+def lomb_scargle(endog, time_variable, periodrange = [3, 24], samples_per_peak = 5, use_fft = True):
+	"""
+	Generalized (floating mean) Lomb-Scargle periodogram of unevenly sampled data for many variables at once (Zechmeister & Kurster, 2009). The power at each frequency is the R-squared of the single period cosinor model. The trigonometric sums of all frequencies are computed with the extirpolation and FFT of Press & Rybicki (1989).
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array (Nsubjects) or (Nsubjects, Nvariables)
+	time_variable : array
+		Time points.
+	periodrange : array
+		The shortest and longest period [low, high]
+	samples_per_peak : int
+		The frequency step is 1/(samples_per_peak * span of the time points).
+	use_fft : bool
+		Use the fast (O(N log N)) trigonometric sums. Otherwise, the sums are direct (O(N*Nfrequencies)).
+
+	Returns
+	---------
+	periods : array
+		The periods in descending order (Nfrequencies)
+	power : array
+		The power (R-squared) (Nfrequencies, Nvariables)
+	"""
+	endog = np.asarray(endog, dtype = np.float64).reshape(len(endog), -1)
+	time_variable = np.asarray(time_variable, dtype = np.float64)
+	n = len(time_variable)
+	f_min = 1. / periodrange[1]
+	f_max = 1. / periodrange[0]
+	df = 1. / (samples_per_peak * (time_variable.max() - time_variable.min()))
+	n_frequencies = int(np.ceil((f_max - f_min) / df)) + 1
+
+	w = np.ones(n) / n
+	y = endog - np.dot(w, endog)
+	with profile_stage('periodogram'):
+		Sh, Ch = trig_sums(time_variable, w[:,np.newaxis] * y, f_min, df, n_frequencies, use_fft = use_fft)
+		S2, C2 = trig_sums(time_variable, w, f_min, df, n_frequencies, freq_factor = 2, use_fft = use_fft)
+		S, C = trig_sums(time_variable, w, f_min, df, n_frequencies, use_fft = use_fft)
+		# the time offset tau that makes the sine and cosine terms orthogonal; trigonometric identities avoid evaluating tau
+		tan_2omega_tau = (S2 - 2 * S * C) / (C2 - (C * C - S * S))
+		S2w = tan_2omega_tau / np.sqrt(1 + tan_2omega_tau * tan_2omega_tau)
+		C2w = 1 / np.sqrt(1 + tan_2omega_tau * tan_2omega_tau)
+		Cw = np.sqrt(0.5) * np.sqrt(1 + C2w)
+		Sw = np.sqrt(0.5) * np.sign(S2w) * np.sqrt(1 - C2w)
+		YY = np.dot(w, y**2)
+		YC = Ch * Cw[:,np.newaxis] + Sh * Sw[:,np.newaxis]
+		YS = Sh * Cw[:,np.newaxis] - Ch * Sw[:,np.newaxis]
+		CC = 0.5 * (1 + C2 * C2w + S2 * S2w) - (C * Cw + S * Sw)**2
+		SS = 0.5 * (1 - C2 * C2w - S2 * S2w) - (S * Cw - C * Sw)**2
+		power = (YC * YC / CC[:,np.newaxis] + YS * YS / SS[:,np.newaxis]) / YY
+	periods = 1. / (f_min + df * np.arange(n_frequencies))
+	return(periods, power)
+
+
+def lomb_scargle_false_alarm(power, time_variable, f_max):
+	"""
+	Baluev (2008) upper bound of the false alarm probability of the highest peak of a Lomb-Scargle periodogram (standard normalisation) searched up to the frequency f_max.
+	
+	Parameters
+	----------
+	power : array
+		Peak power (R-squared)
+	time_variable : array
+		Time points.
+	f_max : float
+		The highest frequency of the periodogram (1/shortest period)
+
+	Returns
+	---------
+	false_alarm : array
+		False alarm probabilities with the shape of power
+	"""
+	time_variable = np.asarray(time_variable, dtype = np.float64)
+	n = len(time_variable)
+	NH = n - 1 # degrees of freedom of the null model
+	NK = n - 3 # degrees of freedom of the cosinor model
+	power = np.clip(power, 0, 1)
+	fap_single = (1 - power)**(0.5 * (NH - 2))
+	gamma_NH = np.sqrt(2. / NH) * np.exp(gammaln(NH / 2.) - gammaln((NH - 1) / 2.))
+	# effective bandwidth
+	W = f_max * np.sqrt(4 * np.pi * np.var(time_variable))
+	tau = gamma_NH * W * (1 - power)**(0.5 * (NK - 1)) * np.sqrt(0.5 * NH * power)
+	return np.clip(1 - (1 - fap_single) * np.exp(-tau), 0, 1)
+
+
+def lomb_scargle_peaks(periods, power, time_variable, n_peaks = 1):
+	"""
+	The highest local maxima of a Lomb-Scargle periodogram of each variable with their false alarm probabilities.
+	
+	Parameters
+	----------
+	periods : array
+		The periods of the periodogram (Nfrequencies)
+	power : array
+		The power (Nfrequencies, Nvariables)
+	time_variable : array
+		Time points.
+	n_peaks : int
+		The number of peaks for each variable
+
+	Returns
+	---------
+	peak_periods : array
+		Periods of the peaks in descending order of power (Npeaks, Nvariables)
+	peak_power : array
+		Power of the peaks (Npeaks, Nvariables)
+	false_alarm : array
+		False alarm probabilities of the peaks (Npeaks, Nvariables)
+	"""
+	power = np.asarray(power).reshape(len(periods), -1)
+	local_maxima = np.ones(power.shape, dtype = bool)
+	local_maxima[1:] &= power[1:] > power[:-1]
+	local_maxima[:-1] &= power[:-1] >= power[1:]
+	peak_candidates = np.where(local_maxima, power, -np.inf)
+	peak_index = np.argsort(-peak_candidates, axis = 0, kind = 'stable')[:n_peaks]
+	peak_power = np.take_along_axis(peak_candidates, peak_index, 0)
+	peak_periods = np.where(np.isfinite(peak_power), np.asarray(periods)[peak_index], np.nan)
+	peak_power = np.where(np.isfinite(peak_power), peak_power, np.nan)
+	false_alarm = lomb_scargle_false_alarm(peak_power, time_variable, 1. / np.min(periods))
+	return(peak_periods, peak_power, false_alarm)
+
+
+def periodogram(endog, time_variable, periodrange = [3, 24], step = 1.0, save_plot = False, outname = 'periodogram_plot.png', dmy_covariates = None, pdf = None, method = 'cosinor', n_peaks = 3):
+	"""
+	R-squared of the single period cosinor model over a range of periods.
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array
+	time_variable : array
+		Time points.
+	periodrange : array
+		The shortest and longest period [low, high]
+	step : float
+		The period step (method = 'cosinor')
+	save_plot : bool
+		Save the plot of the periodogram.
+	outname : string
+		The figure name.
+	dmy_covariates : array
+		[optional] Dummy coded covariates of no interest that are fitted jointly (method = 'cosinor').
+	pdf : PdfPages
+		[optional] Add the figure as a page of a multi-page PDF instead of saving outname.
+	method : string
+		'cosinor' fits the cosinor model at every step. 'lomb_scargle' computes the equivalent generalized Lomb-Scargle periodogram on a fine frequency grid (see lomb_scargle), and annotates the peak periods with their false alarm probabilities on the plot (see lomb_scargle_peaks).
+	n_peaks : int
+		The number of peaks annotated (method = 'lomb_scargle')
+
+	Returns
+	---------
+	periods : array
+		The periods
+	R2 : array
+		R-squared at each period
+	"""
+	assert method in ['cosinor', 'lomb_scargle'], "Error: method must be 'cosinor' or 'lomb_scargle'"
 	# Check that endog has two dimensions
 	if endog.ndim == 1:
 		endog = endog.reshape(len(endog),1)
 
-	periods =  np.arange(periodrange[0],(periodrange[1]+step),step)
-	coeff = []
-	for period in periods:
-		period = [period]
-		R2 = glm_cosinor(endog = endog, time_var = time_variable, period = period, calc_MESOR = True, output_fit_only = False)[0]
-		if R2 < 0:
-			R2 = 0
-		coeff.append(R2)
-	if save_plot:
-		plt.plot(periods, coeff)
-		plt.ylabel("R-squared of cosinor model")
-		plt.xlabel("Period")
-		plt.xticks(np.arange(0, (periodrange[1]+step), step))
-		plt.grid(True)
-		plt.title("Periodogram")
-		plt.savefig(outname, transparent=False, bbox_inches='tight')
-		plt.close()
+	if method == 'lomb_scargle':
+		assert dmy_covariates is None, "Error: covariates are not supported by the Lomb-Scargle periodogram"
+		periods, coeff = lomb_scargle(endog[:,0], time_variable, periodrange = periodrange)
+		coeff = coeff[:,0]
+		peak_periods, peak_power, false_alarm = lomb_scargle_peaks(periods, coeff, time_variable, n_peaks = n_peaks)
+	else:
+		periods =  np.arange(periodrange[0],(periodrange[1]+step),step)
+		with profile_stage('periodogram'):
+			coeff = []
+			for period in periods:
+				period = [period]
+				R2 = glm_cosinor(endog = endog, time_var = time_variable, dmy_covariates = dmy_covariates, period = period, calc_MESOR = True, output_fit_only = False)[0]
+				R2 = float(np.squeeze(R2))
+				if R2 < 0:
+					R2 = 0
+				coeff.append(R2)
+		coeff = np.array(coeff)
+	if save_plot:
+		fig = figure_template()
+		ax = fig.add_subplot(1, 1, 1)
+		ax.plot(periods, coeff)
+		ax.set_ylabel("R-squared of cosinor model")
+		ax.set_xlabel("Period")
+		ax.set_xticks(np.arange(0, (periodrange[1]+step), step))
+		ax.grid(True)
+		if method == 'lomb_scargle':
+			ax.set_title("Lomb-Scargle periodogram")
+			for i in range(len(peak_periods)):
+				if np.isfinite(peak_periods[i,0]):
+					ax.annotate("%1.2f\nFAP=%1.1e" % (peak_periods[i,0], false_alarm[i,0]), xy = (peak_periods[i,0], peak_power[i,0]), xytext = (3, 3), textcoords = 'offset points', fontsize = 8)
+		else:
+			ax.set_title("Periodogram")
+		save_figure(fig, outname, pdf = pdf)
+	return(periods, coeff)
+
+
+def greedy_period_search(endog, time_variable, candidate_periods = None, periodrange = [3, 24], step = 0.5, max_components = 3, criterion = 'bic', dmy_covariates = None):
+	"""
+	Multi-component period search. Starting from the intercept (and covariates) model, the candidate period that most reduces the residual sum of squares (i.e., the largest F-ratio improvement; see regression_f_ratio) is added at each step until the information criterion no longer decreases. The design is kept as an orthonormal basis that is extended by Gram-Schmidt when a period is added, so the candidates of each step are evaluated by projecting their cosine and sine columns and the residuals onto the complement of the basis instead of refitting every model. Variables (e.g., ROIs) with the same selected periods share the basis and are evaluated together.
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array (Nsubjects) or (Nsubjects, Nvariables)
+	time_variable : array
+		Time points.
+	candidate_periods : array
+		[optional] The candidate periods. Default: np.arange(periodrange[0], periodrange[1] + step, step)
+	periodrange : array
+		The shortest and longest candidate period [low, high]
+	step : float
+		The step of the candidate periods
+	max_components : int
+		The maximum number of periods
+	criterion : string
+		'bic' or 'aic'
+	dmy_covariates : array
+		[optional] Dummy coded covariates of no interest that are always in the model.
+
+	Returns
+	---------
+	selected_periods : list
+		The selected periods of each variable in the order they were added (Nvariables lists)
+	F_ratios : list
+		The F-ratio of each added period against the previous model (Nvariables lists)
+	p_values : list
+		The p-values of the F-ratios (Nvariables lists)
+	"""
+	assert criterion in ['bic', 'aic'], "Error: criterion must be 'bic' or 'aic'"
+	endog = np.asarray(endog, dtype = np.float64).reshape(len(endog), -1)
+	time_variable = np.asarray(time_variable, dtype = np.float64)
+	n, num_depv = endog.shape
+	if candidate_periods is None:
+		candidate_periods = np.arange(periodrange[0], (periodrange[1] + step), step)
+	candidate_periods = np.asarray(candidate_periods, dtype = np.float64)
+	# cosine and sine columns of every candidate (Nsubjects, Ncandidates, 2)
+	radians = np.divide(2.0*np.pi*time_variable[:,np.newaxis], candidate_periods)
+	candidate_exog = np.stack((np.cos(radians), np.sin(radians)), 2)
+	candidate_norms = np.einsum('nmj,nmj->mj', candidate_exog, candidate_exog)
 
+	if dmy_covariates is not None:
+		basis = np.linalg.qr(stack_ones(dmy_covariates))[0]
+	else:
+		basis = np.ones((n,1)) / np.sqrt(n)
+	k = basis.shape[1]
+	penalty = np.log(n) if criterion == 'bic' else 2.
+	SS_Residuals = np.sum((endog - np.dot(basis, np.dot(basis.T, endog)))**2, 0)
+	information_criterion = n * np.log(SS_Residuals / n) + k * penalty
+
+	selected_periods = [[] for v in range(num_depv)]
+	F_ratios = [[] for v in range(num_depv)]
+	p_values = [[] for v in range(num_depv)]
+	# variables grouped by their selected candidates; each group shares an orthonormal basis
+	groups = {(): (basis, np.arange(num_depv))}
+	with profile_stage('period search'):
+		for component in range(max_components):
+			next_groups = {}
+			for selected, (basis, variables) in groups.items():
+				k = basis.shape[1]
+				DF_Within = n - k - 2
+				if DF_Within < 1:
+					continue
+				resids = endog[:,variables] - np.dot(basis, np.dot(basis.T, endog[:,variables]))
+				# candidate columns orthogonal to the current model
+				orthogonal_exog = candidate_exog - np.einsum('nq,qmj->nmj', basis, np.einsum('nq,nmj->qmj', basis, candidate_exog))
+				BtB = np.einsum('nmi,nmj->mij', orthogonal_exog, orthogonal_exog)
+				Btr = np.einsum('nmi,nv->miv', orthogonal_exog, resids)
+				# candidates that are (nearly) in the span of the model cannot be added
+				BtB_diagonal = np.einsum('mjj->mj', BtB)
+				valid = np.all(BtB_diagonal > 1e-8 * candidate_norms, 1)
+				valid &= np.linalg.det(BtB) > 1e-8 * np.prod(BtB_diagonal, 1)
+				valid[list(selected)] = False
+				reduction = np.full((len(candidate_periods), len(variables)), -np.inf)
+				reduction[valid] = np.einsum('miv,mij,mjv->mv', Btr[valid], np.linalg.inv(BtB[valid]), Btr[valid])
+				best = np.argmax(reduction, 0)
+				best_reduction = reduction[best, np.arange(len(variables))]
+				new_SS_Residuals = SS_Residuals[variables] - best_reduction
+				new_criterion = n * np.log(new_SS_Residuals / n) + (k + 2) * penalty
+				accepted = np.isfinite(best_reduction) & (new_criterion < information_criterion[variables])
+				F_ratio = (best_reduction / 2) / (new_SS_Residuals / DF_Within)
+				p_value = 10**(-f_neglog10_pvalues(F_ratio, 2, DF_Within))
+				for candidate in np.unique(best[accepted]):
+					group = accepted & (best == candidate)
+					group_variables = variables[group]
+					for j, v in enumerate(group_variables):
+						selected_periods[v].append(float(candidate_periods[candidate]))
+						F_ratios[v].append(float(F_ratio[group][j]))
+						p_values[v].append(float(p_value[group][j]))
+					SS_Residuals[group_variables] = new_SS_Residuals[group]
+					information_criterion[group_variables] = new_criterion[group]
+					# Gram-Schmidt extension of the basis by the orthogonalised candidate columns
+					new_columns = np.linalg.qr(orthogonal_exog[:,candidate,:])[0]
+					new_columns -= np.dot(basis, np.dot(basis.T, new_columns))
+					new_columns = np.linalg.qr(new_columns)[0]
+					next_groups[selected + (candidate,)] = (np.column_stack((basis, new_columns)), group_variables)
+			groups = next_groups
+			if len(groups) == 0:
+				break
+	return(selected_periods, F_ratios, p_values)
+
+
+def sliding_window_cosinor(endog, time_variable, subset_size = 24, period = [24.0], save_plot = False, outname = 'sliding_window_plot.png', dmy_covariates = None, pdf = None, model = 'cosinor'):
+	"""
+	Cosinor models of a window of consecutive time points that slides along the data.
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array
+	time_variable : array
+		Time points.
+	subset_size : int
+		The number of time points in each window
+	period : array
+		Period(s) of the cosinor model.
+	save_plot : bool
+		Save the plots of the window metrics.
+	outname : string
+		The figure name.
+	dmy_covariates : array
+		[optional] Dummy coded covariates of no interest.
+	pdf : PdfPages
+		[optional] Add the figure as a page of a multi-page PDF instead of saving outname.
+	model : string
+		'cosinor' or 'antilogistic' for the extended cosinor (see fit_extended_cosinor). The windows of the extended cosinor are fitted together, and the covariates are removed from the data before fitting (see covariate_adjusted_endog).
 
-def sliding_window_cosinor(endog, time_variable, subset_size = 24, period = [24.0], save_plot = False, outname = 'sliding_window_plot.png'):
+	Returns
+	---------
+	steps : array
+		Window steps
+	R2 : array
+		R-squared of each window
+	MESOR : array
+		MESOR of each window
+	AMPLITUDE : array
+		Amplitude(s) of each window
+	ACROPHASE_24 : array
+		Acrophase(s) in hours of each window
+	neglog10p : array
+		-log10 p-values of each window
+	"""
 	if endog.ndim == 1:
 		endog = endog.reshape(len(endog),1)
+	if dmy_covariates is not None:
+		dmy_covariates = np.asarray(dmy_covariates).reshape(len(endog),-1)
 
 	n_steps = (len(time_variable) - subset_size)
 	step_R2 = []
@@ -606,174 +2534,345 @@ def sliding_window_cosinor(endog, time_variable, subset_size = 24, period = [24.
 	step_ampl = []
 	step_ampl_SE = []
 	step_acro24 = []
-	step_neglogp = []
+	step_Fmodel = []
+	step_DF = []
 	steps = []
 
-	for i in range(n_steps):
-		temp_time = time_variable[i:int(i+subset_size)]
-		temp_endog = endog[i:int(i+subset_size),0]
-
-		n = len(temp_endog)
-		k = len(period)*2 + 1
-		DF_Between = k - 1 # aka df model
-		DF_Within = n - k # aka df residuals
-
-		R2, MESOR, SE_MESOR, AMPLITUDE, SE_AMPLITUDE, ACROPHASE, SE_ACROPHASE, Fmodel = glm_cosinor(endog = temp_endog, 
-									time_var = temp_time,
-									period = period,
-									calc_MESOR = True,
-									output_fit_only = False)[:8]
-		ACROPHASE_24 = np.zeros_like(ACROPHASE)
-		for j, per in enumerate(period):
-			acrotemp = np.abs(ACROPHASE[j]/(2*np.pi)) * per
-			acrotemp[acrotemp>per] -= per
-			ACROPHASE_24[j] = acrotemp
-
-		step_R2.append(np.squeeze(R2))
-		step_mesor.append(np.squeeze(MESOR))
-		step_mesor_SE.append(np.squeeze(SE_MESOR))
-		step_ampl.append(np.squeeze(AMPLITUDE))
-		step_ampl_SE.append(np.squeeze(SE_AMPLITUDE))
-		step_acro24.append(np.squeeze(ACROPHASE_24))
-		step_neglogp.append(-np.log10(f.sf(Fmodel, DF_Between, DF_Within)))
-		steps.append(i+1)
+	with profile_stage('sliding window'):
+		if model == 'antilogistic':
+			assert len(period) == 1, "Error: the extended cosinor has a single period"
+			windows = np.arange(subset_size)[:,np.newaxis] + np.arange(n_steps)
+			adjusted = covariate_adjusted_endog(endog, time_variable, period, dmy_covariates)[:,0]
+			# the covariates that are not collinear within each window are removed from its degrees of freedom
+			n_covariates = np.zeros(n_steps)
+			if dmy_covariates is not None:
+				for i in range(n_steps):
+					window_covariates = independent_covariates(dmy_covariates[i:int(i+subset_size)], time_variable[i:int(i+subset_size)], period)
+					n_covariates[i] = 0 if window_covariates is None else window_covariates.shape[1]
+			R2, params, SE_params, Fmodel = fit_extended_cosinor(adjusted[windows], np.asarray(time_variable)[windows], period[0], n_covariates = n_covariates)[:4]
+			step_R2, step_mesor, step_ampl, step_acro24, step_Fmodel = R2, params[0], params[1], params[4], Fmodel
+			step_mesor_SE, step_ampl_SE = SE_params[0], SE_params[1]
+			step_DF = [(4, subset_size - 5 - n_covariates[i]) for i in range(n_steps)]
+			steps = list(range(1, n_steps + 1))
+		else:
+			for i in range(n_steps):
+				temp_time = time_variable[i:int(i+subset_size)]
+				temp_endog = endog[i:int(i+subset_size),0]
+				if dmy_covariates is not None:
+					# covariates that are collinear within the window (e.g., absent levels) are removed
+					temp_covariates = independent_covariates(dmy_covariates[i:int(i+subset_size)], time_variable[i:int(i+subset_size)], period)
+				else:
+					temp_covariates = None
+
+				n = len(temp_endog)
+				k = len(period)*2 + 1
+				DF_Between = k - 1 # aka df model
+				DF_Within = n - k # aka df residuals
+				if temp_covariates is not None:
+					DF_Within -= temp_covariates.shape[1]
+
+				R2, MESOR, SE_MESOR, AMPLITUDE, SE_AMPLITUDE, ACROPHASE, SE_ACROPHASE, Fmodel = glm_cosinor(endog = temp_endog, 
+											time_var = temp_time,
+											dmy_covariates = temp_covariates,
+											period = period,
+											calc_MESOR = True,
+											output_fit_only = False)[:8]
+				ACROPHASE_24 = np.zeros_like(ACROPHASE)
+				for j, per in enumerate(period):
+					acrotemp = np.abs(ACROPHASE[j]/(2*np.pi)) * per
+					acrotemp[acrotemp>per] -= per
+					ACROPHASE_24[j] = acrotemp
+
+				step_R2.append(np.squeeze(R2))
+				step_mesor.append(np.squeeze(MESOR))
+				step_mesor_SE.append(np.squeeze(SE_MESOR))
+				step_ampl.append(np.squeeze(AMPLITUDE))
+				step_ampl_SE.append(np.squeeze(SE_AMPLITUDE))
+				step_acro24.append(np.squeeze(ACROPHASE_24))
+				step_Fmodel.append(float(np.squeeze(Fmodel)))
+				step_DF.append((DF_Between, DF_Within))
+				steps.append(i+1)
+		# the p-values of all windows in one call
+		step_DF = np.array(step_DF).reshape(-1,2)
+		step_neglogp = f_neglog10_pvalues(step_Fmodel, step_DF[:,0], step_DF[:,1])
+	step_R2 = np.array(step_R2)
+	step_mesor =  np.array(step_mesor)
+	step_mesor_SE =  np.array(step_mesor_SE)
+	step_ampl =  np.array(step_ampl)
+	step_ampl_SE =  np.array(step_ampl_SE)
+	step_acro24 = np.array(step_acro24)
 	if save_plot:
-		step_R2 = np.array(step_R2)
-		step_mesor =  np.array(step_mesor)
-		step_mesor_SE =  np.array(step_mesor_SE)
-		step_ampl =  np.array(step_ampl)
-		step_ampl_SE =  np.array(step_ampl_SE)
-		step_acro24 = np.array(step_acro24)
-		step_neglogp =  np.array(step_neglogp)
-
-		plt.figure(figsize=(12,24))
-		plt.subplot(5, 1, 1)
-		plt.plot(steps, step_R2)
-		plt.title('Sliding window plots')
-		plt.ylabel('R-sqr')
-		plt.gca().yaxis.set_major_formatter(StrMethodFormatter('{x:,.2f}'))
-		plt.xticks(steps)
-		plt.grid(True)
-
-		plt.subplot(5, 1, 2)
-		plt.plot(steps, step_mesor)
-		plt.fill_between(steps, step_mesor - step_mesor_SE, step_mesor + step_mesor_SE, alpha=0.2, color='k')
-		plt.ylabel('MESOR')
-		plt.gca().yaxis.set_major_formatter(StrMethodFormatter('{x:,.2f}'))
-		plt.xticks(steps)
-		plt.grid(True)
-
-		plt.subplot(5, 1, 3)
-		plt.plot(steps, step_ampl)
+
+		fig = figure_template(figsize = (12,24))
+		ax = fig.add_subplot(5, 1, 1)
+		ax.plot(steps, step_R2)
+		ax.set_title('Sliding window plots')
+		ax.set_ylabel('R-sqr')
+		ax.yaxis.set_major_formatter(StrMethodFormatter('{x:,.2f}'))
+		ax.set_xticks(steps)
+		ax.grid(True)
+
+		ax = fig.add_subplot(5, 1, 2)
+		ax.plot(steps, step_mesor)
+		ax.fill_between(steps, step_mesor - step_mesor_SE, step_mesor + step_mesor_SE, alpha=0.2, color='k')
+		ax.set_ylabel('MESOR')
+		ax.yaxis.set_major_formatter(StrMethodFormatter('{x:,.2f}'))
+		ax.set_xticks(steps)
+		ax.grid(True)
+
+		ax = fig.add_subplot(5, 1, 3)
+		ax.plot(steps, step_ampl)
 		if len(period) == 1:
-			plt.fill_between(steps, 
+			ax.fill_between(steps, 
 								step_ampl - step_ampl_SE,
 								step_ampl + step_ampl_SE,
 								alpha=0.2,
 								color='k')
-		plt.ylabel('Amplitude')
-		plt.gca().yaxis.set_major_formatter(StrMethodFormatter('{x:,.2f}'))
-		plt.xticks(steps)
-		plt.grid(True)
-
-		plt.subplot(5, 1, 4)
-		plt.plot(steps, step_acro24)
-		plt.ylabel('Acrophase [24h]')
-		plt.gca().yaxis.set_major_formatter(StrMethodFormatter('{x:,.1f}'))
-		plt.xticks(steps)
-		plt.grid(True)
-
-		plt.subplot(5, 1, 5)
-		plt.plot(steps, step_neglogp)
-		plt.ylabel('-logP')
-		plt.axhline(y=-np.log10(0.05), color='k', linestyle=':')
-		plt.gca().yaxis.set_major_formatter(StrMethodFormatter('{x:,.2f}'))
-		plt.xticks(steps)
-		plt.xlabel("Step (size = %d)" % subset_size)
-		plt.grid(True)
-		plt.savefig(outname, transparent=False, bbox_inches='tight')
-		plt.close()
-
-def plot_cosinor_simulations(endog, time_variable, period = [24.0], n_simulations = 200, randomise_time = False, resample_eveningly = False, n_sampling = None, range_sampling = None, outbasename = 'cosinor_simulation_plot'):
-	n = len(endog)
+		ax.set_ylabel('Amplitude')
+		ax.yaxis.set_major_formatter(StrMethodFormatter('{x:,.2f}'))
+		ax.set_xticks(steps)
+		ax.grid(True)
+
+		ax = fig.add_subplot(5, 1, 4)
+		ax.plot(steps, step_acro24)
+		ax.set_ylabel('Acrophase [24h]')
+		ax.yaxis.set_major_formatter(StrMethodFormatter('{x:,.1f}'))
+		ax.set_xticks(steps)
+		ax.grid(True)
+
+		ax = fig.add_subplot(5, 1, 5)
+		ax.plot(steps, step_neglogp)
+		ax.set_ylabel('-log10(p)')
+		ax.axhline(y=-np.log10(0.05), color='k', linestyle=':')
+		ax.yaxis.set_major_formatter(StrMethodFormatter('{x:,.2f}'))
+		ax.set_xticks(steps)
+		ax.set_xlabel("Step (size = %d)" % subset_size)
+		ax.grid(True)
+		save_figure(fig, outname, pdf = pdf)
+	return(np.array(steps), step_R2, step_mesor, step_ampl, step_acro24, step_neglogp)
+
+def plot_cosinor_simulations(endog, time_variable, period = [24.0], n_simulations = 200, randomise_time = False, resample_eveningly = False, n_sampling = None, range_sampling = None, outbasename = 'cosinor_simulation_plot', dmy_covariates = None, pdf = None, plot_style = 'lines', quantiles = [2.5, 25.], sampling_times = None, model = 'cosinor'):
+	"""
+	Plots the residuals of the cosinor model, and the cosinor model with the curves of simulated models (see simulate_cosinor_batch).
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array of real data.
+	time_variable : array
+		Time points.
+	period : array
+		The period(s) of the cosinor model
+	n_simulations : int
+		The number of simulations
+	randomise_time : bool
+		Randomise the time points for the simulation within the sample range.
+	resample_eveningly : bool
+		The time points will be equally distributed across the sample range.
+	n_sampling : int
+		The number of time points to simulate
+	range_sampling: array
+		The time range for simulating [start, stop]
+	outbasename : string
+		The base name of the figures.
+	dmy_covariates : array
+		[optional] Dummy coded covariates of no interest.
+	pdf : PdfPages
+		[optional] Add the figures as pages of a multi-page PDF.
+	plot_style : string
+		'lines' plots every simulated curve. 'envelope' plots the median and quantile bands of the simulated curves, which summarises any number of simulations.
+	quantiles : array
+		Lower quantiles (percent) of the envelope bands, e.g., 2.5 plots the 2.5-97.5% band.
+	sampling_times : array
+		[optional] Simulate the model at these time points (see simulate_cosinor_batch).
+	model : string
+		'cosinor' or 'antilogistic' to plot the extended cosinor and its simulated curves (see simulate_extended_cosinor_batch)
+	Returns
+	---------
+	None
+	"""
+	assert plot_style in ['lines', 'envelope'], "Error: plot_style must be 'lines' or 'envelope'"
+	assert model in ['cosinor', 'antilogistic'], "Error: model must be 'cosinor' or 'antilogistic'"
+	endog_raw = endog
 
 	arr_xtick = np.arange(0, 25, 1)
 
-	resids = residual_cosinor(endog = endog, time_var = time_variable, period = period)
-	plt.scatter(time_variable, resids, marker = '.', color='k')
-	plt.axhline(y=0, color='k')
-	plt.axhline(y=resids.std(), color='k', ls = ":")
-	plt.axhline(y=-resids.std(), color='k', ls = ":")
-	plt.xticks(arr_xtick)
-	plt.title('Residuals of Cosinor Model')
+	if model == 'antilogistic':
+		assert len(period) == 1, "Error: the extended cosinor has a single period"
+		adjusted = covariate_adjusted_endog(np.asarray(endog, dtype = np.float64).reshape(len(endog), -1), time_variable, period, dmy_covariates)[:,:1]
+		params = fit_extended_cosinor(adjusted, time_variable, period[0])[1]
+		resids = adjusted - antilogistic_cosinor(time_variable, params, period[0])
+	else:
+		resids = residual_cosinor(endog = endog, time_var = time_variable, period = period, dmy_covariates = dmy_covariates)
+	fig = figure_template()
+	ax = fig.add_subplot(1, 1, 1)
+	ax.scatter(time_variable, resids, marker = '.', color='k')
+	ax.axhline(y=0, color='k')
+	ax.axhline(y=resids.std(), color='k', ls = ":")
+	ax.axhline(y=-resids.std(), color='k', ls = ":")
+	ax.set_xticks(arr_xtick)
+	ax.set_title('Residuals of Cosinor Model')
 
 	max_r = resids.max()
 	min_r = resids.min()
-	plt.ylim(min_r*1.2, max_r*1.2)
+	ax.set_ylim(min_r*1.2, max_r*1.2)
 
-	plt.savefig("%s_residuals.png" % outbasename, transparent=False, bbox_inches='tight')
-	plt.close()
+	save_figure(fig, "%s_residuals.png" % outbasename, pdf = pdf)
 
 	R2, MESOR, SE_MESOR, AMPLITUDE, SE_AMPLITUDE, ACROPHASE, SE_ACROPHASE, Fmodel = glm_cosinor(endog = endog, 
 								time_var = time_variable,
+								dmy_covariates = dmy_covariates,
 								period = period,
 								calc_MESOR = True,
 								output_fit_only = False)[:8]
+	endog = covariate_adjusted_endog(endog, time_variable, period, dmy_covariates)
 
-	model_line, times = create_cosinor_fit(period, 
-														np.squeeze(MESOR),
-														AMPLITUDE,
-														ACROPHASE,
-														time_space = np.linspace(0,24,200))
-	plt.figure(figsize=(12,8))
-	plt.plot(times, model_line, c='k')
-	plt.scatter(time_variable, endog, marker = '.')
+	if model == 'antilogistic':
+		times = np.linspace(0,24,200)
+		model_line = antilogistic_cosinor(times, params, period[0])[:,0]
+	else:
+		model_line, times = create_cosinor_fit(period, 
+															np.squeeze(MESOR),
+															AMPLITUDE,
+															ACROPHASE,
+															time_space = np.linspace(0,24,200))
+	fig = figure_template(figsize = (12,8))
+	ax = fig.add_subplot(1, 1, 1)
+	ax.plot(times, model_line, c='k')
+	ax.scatter(time_variable, endog, marker = '.')
+
+	# the simulated curves are projected from the coefficients (or extended cosinor parameters) of all simulations at once
+	sim_coef = simulate_cosinor_batch(endog = endog_raw,
+											time_variable = time_variable,
+											period = period,
+											n_simulations = n_simulations,
+											resids = resids,
+											randomise_time = randomise_time,
+											resample_eveningly = resample_eveningly,
+											n_sampling = n_sampling,
+											range_sampling = range_sampling,
+											dmy_covariates = dmy_covariates,
+											sampling_times = sampling_times,
+											model = model)[5]
+	pred_time = np.linspace(0,25, 200)
+	if model == 'antilogistic':
+		sim_curves = antilogistic_cosinor(pred_time, sim_coef, period[0])
+	else:
+		sim_curves = np.dot(dummy_code_cosine(pred_time, period), sim_coef)
+	if plot_style == 'envelope':
+		for q, alpha in zip(quantiles, np.linspace(0.15, 0.3, len(quantiles))):
+			ax.fill_between(pred_time, np.percentile(sim_curves, q, axis = 1), np.percentile(sim_curves, 100 - q, axis = 1), alpha = alpha, color = 'k', lw = 0, label = '%g-%g%%' % (q, 100 - q))
+		ax.plot(pred_time, np.median(sim_curves, axis = 1), linestyle = ':', c='k', label = 'median')
+		ax.legend()
+	else:
+		# all simulated curves are drawn as a single collection
+		segments = np.stack((np.broadcast_to(pred_time, sim_curves.T.shape), sim_curves.T), axis = 2)
+		ax.add_collection(LineCollection(segments, alpha = 0.2, linestyle = ':', colors = 'k'))
+		ax.autoscale_view()
+	ax.set_xticks(arr_xtick)
+	ax.set_title('Cosinor Model + Simulated Curves')
+	ax.set_xlabel('Time (hour)')
+	save_figure(fig, "%s.png" % outbasename, pdf = pdf)
 
-	if randomise_time:
-		if n_sampling is None:
-			n_sampling = n
-		if range_sampling is None:
-			range_sampling = [0,23.99]
-		if resample_eveningly:
-			sim_time = np.linspace(range_sampling[0],range_sampling[1],n_sampling)
+
+# Figures are reused between plots (one per figure size and process). Figures are drawn with the object-oriented API on an Agg canvas, so the pyplot state machine is never used.
+_FIGURE_TEMPLATES = {}
+
+def figure_template(figsize = (6.4,4.8)):
+	"""
+	Returns a cleared figure of the requested size attached to an Agg canvas. The same figure is reused for every plot of that size.
+	
+	Parameters
+	----------
+	figsize : tuple
+		Figure size in inches (width, height)
+
+	Returns
+	---------
+	fig : Figure
+		matplotlib figure
+	"""
+	figsize = tuple(figsize)
+	if figsize not in _FIGURE_TEMPLATES:
+		fig = Figure(figsize = figsize)
+		FigureCanvasAgg(fig)
+		_FIGURE_TEMPLATES[figsize] = fig
+	fig = _FIGURE_TEMPLATES[figsize]
+	fig.clf()
+	return fig
+
+
+def save_figure(fig, outname, pdf = None):
+	"""
+	Saves a figure as an image, or as a page of a multi-page PDF, and clears it for reuse.
+	
+	Parameters
+	----------
+	fig : Figure
+		matplotlib figure
+	outname : string
+		The figure name.
+	pdf : PdfPages
+		[optional] Add the figure as a page to the multi-page PDF instead of saving outname.
+
+	Returns
+	---------
+	None
+	"""
+	with profile_stage('plot'):
+		if pdf is not None:
+			pdf.savefig(fig, bbox_inches='tight')
 		else:
-			sim_time = np.sort(np.random.uniform(low=range_sampling[0], high=range_sampling[1], size=(n_sampling,)))
-	else:
-		n_sampling = n
-		sim_time = time_variable
+			fig.savefig(outname, transparent=False, bbox_inches='tight')
+		fig.clf()
 
-	# the mean and std of for the noise is calculated from the residuals
-	noise_mean = resids.mean()
-	noise_std = resids.std()
-	noise_npts = n_sampling
 
-	for i in range(n_simulations):
-		noise = np.random.normal(noise_mean, noise_std, noise_npts).reshape(noise_npts,1)
-		# calculate the predicted cosinor curve
-		predicted = project_cosionor_model(MESOR, AMPLITUDE, ACROPHASE, TIME_VAR = sim_time, PERIOD = period)
-		sim_endog = noise + predicted
-		sMESOR, sAMPLITUDE, sACROPHASE = glm_cosinor(endog = sim_endog, 
-																time_var = sim_time,
-																period = period,
-																calc_MESOR = True,
-																output_fit_only = True)
+def _render_job(job):
+	plot_function, kwargs = job
+	plot_function(**kwargs)
+	return None
+
 
+def render_figures(jobs, n_jobs = 1, pdfname = None):
+	"""
+	Renders a batch of figures. PNG figures are rendered in a process pool. If pdfname is set, all figures are written as pages of a single PDF; the pages are rendered sequentially because the PDF is a single stream.
+	
+	Parameters
+	----------
+	jobs : list
+		List of (plot_function, kwargs) e.g., [(periodogram, {'endog': data, 'time_variable': time_h, 'save_plot': True})]
+	n_jobs : int
+		Number of worker processes.
+	pdfname : string
+		[optional] Name of the multi-page PDF.
 
-		pred_time = np.linspace(0,25, 200)
-		predicted = project_cosionor_model(sMESOR, sAMPLITUDE, sACROPHASE, TIME_VAR = pred_time, PERIOD = period)
-		plt.plot(pred_time, predicted, alpha = 0.2, linestyle = ':', c='k')
-	plt.xticks(arr_xtick)
-	plt.title('Cosinor Model + Simulated Curves')
-	plt.xlabel('Time (hour)')
-	plt.savefig("%s.png" % outbasename, transparent=False, bbox_inches='tight')
-	plt.close()
+	Returns
+	---------
+	None
+	"""
+	if pdfname is not None:
+		with PdfPages(pdfname) as pdf:
+			for plot_function, kwargs in jobs:
+				kwargs = dict(kwargs)
+				kwargs['pdf'] = pdf
+				plot_function(**kwargs)
+	elif n_jobs > 1:
+		pool = Pool(n_jobs)
+		try:
+			pool.map(_render_job, jobs, chunksize = 1)
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		for job in jobs:
+			_render_job(job)
 
 
 def create_cosinor_fit(period, MESOR, AMPLITUDE, ACROPHASE, time_space = np.linspace(0,24,200)):
 	if ACROPHASE.shape[1] == 1:
 		model_line = MESOR
 		for j, per in enumerate(period):
-			model_line += float(AMPLITUDE[j]) * np.cos(np.divide((2*np.pi*time_space),per) + float(ACROPHASE[j]))
+			model_line += float(np.squeeze(AMPLITUDE[j])) * np.cos(np.divide((2*np.pi*time_space),per) + float(np.squeeze(ACROPHASE[j])))
 	return(model_line, time_space)
 
 
@@ -786,7 +2885,7 @@ def check_columns(pdData):
 		if len(a) > 10:
 			astr = '[n>10]'
 		else:
-			astr = ','.join(a.astype(np.str))
+			astr = ','.join(a.astype(str))
 			astr = '['+astr+']'
 		if num_missing == 0:
 			print("[%d] : %s\t%s" % (counter, roi, astr))
@@ -794,7 +2893,36 @@ def check_columns(pdData):
 			print("[%d] : %s\t%s\t\tCONTAINS %d MISSING VARIABLES!" % (counter, roi, astr, num_missing))
 
 
-def load_vars(pdCSV, variables, exog = [], names = [], demean_flag = True):
+def load_vars(pdCSV, variables, exog = None, names = None, demean_flag = True, sparse = False):
+	"""
+	Codes the covariates listed in variables from a pandas CSV
+	
+	Parameters
+	----------
+	pdCSV : dictionary
+		Pandas CSV
+	variables : array
+		Variable names each followed by its type. e.g., ['day', 'd', 'age', 'c'] (d = discrete, c = continous)
+	exog : list
+		[optional] list of previously coded variables to append to. A new list is created on every call by default.
+	names : list
+		[optional] list of previously coded variable names to append to. A new list is created on every call by default.
+	demean_flag : bool
+		Demean the coded variables
+	sparse : bool
+		Return discrete variables as sparse CSR matrices (requires demean_flag = False)
+
+	Returns
+	---------
+	exog : list
+		list of coded arrays of shape [(# subjects), (# columns)]
+	names : list
+		list of variable names
+	"""
+	if exog is None:
+		exog = []
+	if names is None:
+		names = []
 	if len(variables) % 2 == 1:
 		print("Error: each input must be followed by data type. e.g., -ic day d age c (d = discrete, c = continous)")
 	num_exog = int(len(variables) / 2)
@@ -808,7 +2936,7 @@ def load_vars(pdCSV, variables, exog = [], names = [], demean_flag = True):
 			exog.append(temp)
 		elif variables[k] == 'd':
 			print("Coding %s as discrete variable" % variables[j])
-			temp = dummy_code(np.array(pdCSV[variables[j]]), iscontinous = False, demean = demean_flag)
+			temp = dummy_code(np.array(pdCSV[variables[j]]), iscontinous = False, demean = demean_flag, sparse = sparse)
 			if temp.ndim == 1:
 				temp = temp[:,np.newaxis]
 			exog.append(temp)
@@ -818,7 +2946,50 @@ def load_vars(pdCSV, variables, exog = [], names = [], demean_flag = True):
 	return (exog, names)
 
 
-def dummy_code(variable, iscontinous = False, demean = True):
+def load_covariates(pdCSV, variables, demean_flag = True, add_intercept = False):
+	"""
+	Codes the covariates listed in variables directly into a single design matrix. The matrix is allocated once and each coded block is written into it, so it can be passed to lm_residuals or glm_cosinor (dmy_covariates) without further copies.
+	
+	Parameters
+	----------
+	pdCSV : dictionary
+		Pandas CSV
+	variables : array
+		Variable names each followed by its type. e.g., ['day', 'd', 'age', 'c']
+	demean_flag : bool
+		Demean the coded variables
+	add_intercept : bool
+		Make the first column a column of ones (e.g., for lm_residuals)
+
+	Returns
+	---------
+	dmy_covariates : array
+		Design matrix of shape [(# subjects), (# columns)]
+	names : list
+		list of variable names
+	"""
+	exog, names = load_vars(pdCSV, variables, demean_flag = demean_flag)
+	n = len(pdCSV)
+	offset = int(add_intercept)
+	dmy_covariates = np.empty((n, offset + sum([var.shape[1] for var in exog])))
+	if add_intercept:
+		dmy_covariates[:,0] = 1
+	for var in exog:
+		dmy_covariates[:,offset:offset + var.shape[1]] = var
+		offset += var.shape[1]
+	return (dmy_covariates, names)
+
+
+# cache of coded variables. Keys are built from the content of the variable, so repeated coding of the same column (e.g., by subject loops or batch runs) is free.
+_DUMMY_CODE_CACHE = {}
+_DUMMY_CODE_CACHE_SIZE = 256
+
+def _variable_key(variable, *options):
+	hashed = hashlib.sha1(pd.util.hash_array(np.asarray(variable).ravel()).tobytes()).hexdigest()
+	return (hashed, len(variable)) + options
+
+
+def dummy_code(variable, iscontinous = False, demean = True, sparse = False, use_cache = True):
 	"""
 	Dummy codes a variable
 	
@@ -826,6 +2997,14 @@ def dummy_code(variable, iscontinous = False, demean = True):
 	----------
 	variable : array
 		1D array variable of any type 
+	iscontinous : bool
+		The variable is continous (it is only demeaned)
+	demean : bool
+		Demean the coded variable
+	sparse : bool
+		Return a sparse CSR one-hot matrix for discrete variables (cannot be demeaned)
+	use_cache : bool
+		Re-use the coding of identical variables. Cached arrays are read-only, and cached sparse matrices are returned as copies.
 
 	Returns
 	---------
@@ -833,22 +3012,42 @@ def dummy_code(variable, iscontinous = False, demean = True):
 		dummy coded array of shape [(# subjects), (unique variables - 1)]
 	
 	"""
+	if sparse:
+		assert not demean, "Error: sparse dummy coded variables cannot be demeaned"
+	variable = np.asarray(variable)
+	if use_cache:
+		key = _variable_key(variable, iscontinous, demean, sparse)
+		if key in _DUMMY_CODE_CACHE:
+			if sparse:
+				return _DUMMY_CODE_CACHE[key].copy()
+			return _DUMMY_CODE_CACHE[key]
 	if iscontinous:
 		if demean:
 			dummy_vars = variable - np.mean(variable,0)
 		else:
-			dummy_vars = variable
+			dummy_vars = np.array(variable)
 	else:
-		unique_vars = np.unique(variable)
-		dummy_vars = []
-		for var in unique_vars:
-			temp_var = np.zeros((len(variable)))
-			temp_var[variable == var] = 1
-			dummy_vars.append(temp_var)
-		dummy_vars = np.array(dummy_vars)[1:] # remove the first column as reference variable
-		dummy_vars = np.squeeze(dummy_vars).astype(np.int).T
-		if demean:
-			dummy_vars = dummy_vars - np.mean(dummy_vars,0)
+		unique_vars, inverse = np.unique(variable, return_inverse = True)
+		inverse = inverse.ravel()
+		# the first unique value is the reference variable
+		rows = np.flatnonzero(inverse)
+		shape = (len(variable), len(unique_vars) - 1)
+		if sparse:
+			dummy_vars = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, inverse[rows] - 1)), shape = shape)
+		else:
+			dummy_vars = np.zeros(shape)
+			dummy_vars[rows, inverse[rows] - 1] = 1
+			if demean:
+				dummy_vars -= np.mean(dummy_vars,0)
+			dummy_vars = np.squeeze(dummy_vars)
+	if use_cache:
+		if len(_DUMMY_CODE_CACHE) >= _DUMMY_CODE_CACHE_SIZE:
+			_DUMMY_CODE_CACHE.clear()
+		if sparse:
+			_DUMMY_CODE_CACHE[key] = dummy_vars.copy()
+		else:
+			dummy_vars.flags.writeable = False
+			_DUMMY_CODE_CACHE[key] = dummy_vars
 	return dummy_vars
 
 
@@ -869,7 +3068,7 @@ def stack_ones(arr):
 	return np.column_stack([np.ones(len(arr)),arr])
 
 
-def create_simulated_data(modeloptions, period = [24.0], range_sampling = [0, 23.99], resample_eveningly = False, save_csv = None, random_acrophase = False, summate_models = None):
+def create_simulated_data(modeloptions, period = [24.0], range_sampling = [0, 23.99], resample_eveningly = False, save_csv = None, random_acrophase = False, summate_models = None, save_store = None):
 	"""
 	Create simulated data. 
 	
@@ -889,6 +3088,8 @@ def create_simulated_data(modeloptions, period = [24.0], range_sampling = [0, 23
 		Randomise the acrophase
 	summate_models : bool
 		Add a previous model to the current one.
+	save_store : str
+		[optional] Save the simulated data (scan_time, simulated_roi) and the model settings to a binary ResultStore directory instead of a CSV.
 	Returns
 	---------
 	pdCSV : dictionary
@@ -932,6 +3133,18 @@ def create_simulated_data(modeloptions, period = [24.0], range_sampling = [0, 23
 		pd_out['simulated_roi'] = pd_out['simulated_roi'] + summate_models['simulated_roi']
 	if save_csv is not None:
 		pd_out.to_csv(save_csv, sep=',', encoding='utf-8', index = False, index_label=None)
+	if save_store is not None:
+		store = ResultStore(save_store, mode = 'w', attributes = {'period': period,
+																		'amplitude': float(modeloptions[0]),
+																		'acrophase24': acrophase24,
+																		'n_timepoints': n_timepoints,
+																		'noise_mean': noise_mean,
+																		'noise_std': noise_std,
+																		'range_sampling': range_sampling,
+																		'resample_eveningly': resample_eveningly,
+																		'summated_model': summate_models is not None})
+		store.append_arrays(scan_time = np.array(pd_out['scan_time'], dtype = np.float64),
+									simulated_roi = np.array(pd_out['simulated_roi'], dtype = np.float64))
 	return(pd_out)
 
 def ttest_independent_sample(data1, data2):
@@ -941,9 +3154,9 @@ def ttest_independent_sample(data1, data2):
 	Parameters
 	----------
 	data1 : array
-		1-D array
+		1-D array (or 2-D array of Nsubjects by Nvariables)
 	data2 : array
-		1-D array
+		1-D array (or 2-D array of Nsubjects by Nvariables)
 
 	Returns
 	---------
@@ -953,19 +3166,315 @@ def ttest_independent_sample(data1, data2):
 	"""
 	data1 = np.array(data1)
 	data2 = np.array(data2)
-	tval = (np.mean(data1) - np.mean(data2))/np.sqrt((np.var(data1, ddof=1)/len(data1)) + (np.var(data2, ddof=1)/len(data1)))
+	tval = (np.mean(data1, 0) - np.mean(data2, 0))/np.sqrt((np.var(data1, ddof=1, axis=0)/len(data1)) + (np.var(data2, ddof=1, axis=0)/len(data2)))
 	return tval
 
+
+def binned_ttest(endog1, time1, endog2, time2, bins = 10):
+	"""
+	Independent sample T-tests of two populations within every time bin, computed for all bins (and variables) at once.
+	
+	Parameters
+	----------
+	endog1 : array
+		Endogenous variable of population 1 (Nsubjects1) or (Nsubjects1, Nvariables)
+	time1 : array
+		Time points of population 1
+	endog2 : array
+		Endogenous variable of population 2 (Nsubjects2) or (Nsubjects2, Nvariables)
+	time2 : array
+		Time points of population 2
+	bins : int or array
+		The number of equally sized time bins over the range of the time points, or the bin edges. Time points outside the edges are not used.
+
+	Returns
+	---------
+	tvalues : array
+		T-values (Nbins, Nvariables)
+	dof : array
+		Degrees of freedom (Nbins)
+	p_values : array
+		Two-tailed p-values (Nbins, Nvariables)
+	bin_edges : array
+		Bin edges (Nbins + 1)
+	"""
+	endog1 = np.asarray(endog1, dtype = np.float64).reshape(len(endog1), -1)
+	endog2 = np.asarray(endog2, dtype = np.float64).reshape(len(endog2), -1)
+	time1 = np.asarray(time1, dtype = np.float64)
+	time2 = np.asarray(time2, dtype = np.float64)
+	if np.ndim(bins) == 0:
+		bin_edges = np.linspace(min(time1.min(), time2.min()), max(time1.max(), time2.max()), int(bins) + 1)
+	else:
+		bin_edges = np.asarray(bins, dtype = np.float64)
+	n_bins = len(bin_edges) - 1
+
+	stats = []
+	for endog, time_var in [(endog1, time1), (endog2, time2)]:
+		bin_index = _time_bins(time_var, bin_edges)
+		# one-hot bin membership (Nbins, Nsubjects)
+		membership = (bin_index[np.newaxis,:] == np.arange(n_bins)[:,np.newaxis]).astype(np.float64)
+		n_bin = membership.sum(1)
+		with np.errstate(invalid = 'ignore', divide = 'ignore'):
+			mean = np.dot(membership, endog) / n_bin[:,np.newaxis]
+			centred = endog - mean[np.clip(bin_index, 0, n_bins - 1)]
+			var = np.dot(membership, centred**2) / (n_bin[:,np.newaxis] - 1)
+		stats.append((n_bin, mean, var))
+	(n1, mean1, var1), (n2, mean2, var2) = stats
+	dof = n1 + n2 - 2
+	with np.errstate(invalid = 'ignore', divide = 'ignore'):
+		tvalues = (mean1 - mean2) / np.sqrt(var1/n1[:,np.newaxis] + var2/n2[:,np.newaxis])
+	p_values = 2 * t.sf(np.abs(tvalues), dof[:,np.newaxis])
+	return(tvalues, dof, p_values, bin_edges)
+
+
+def _time_bins(time_var, bin_edges):
+	# bin of each time point; the last bin includes its upper edge and points outside the edges are -1 or Nbins
+	bin_index = np.digitize(time_var, bin_edges) - 1
+	bin_index[time_var == bin_edges[-1]] = len(bin_edges) - 2
+	return bin_index
+
+
+def _weighted_cosinor_parameters(weighted_exog, exog_vars, endog, XtX, Xty, period):
+	# weighted normal equations of many resamples at once; weighted_exog is W*X (Nresamples, Nsubjects, Kvariables)
+	XtWX = np.matmul(weighted_exog.transpose(0,2,1), exog_vars)
+	XtWy = np.matmul(weighted_exog.transpose(0,2,1), endog)
+	if XtX is not None:
+		# the complementary group
+		XtWX = XtX - XtWX
+		XtWy = Xty - XtWy
+	a = np.linalg.solve(XtWX, XtWy)
+	return cosinor_parameters(np.moveaxis(a, 1, 0), period)
+
+
+def _wrap_phase(radians):
+	return np.mod(radians + np.pi, 2*np.pi) - np.pi
+
+
+def cosinor_group_differences(endog1, time1, endog2, time2, period = [24.0], n_resamples = 10000, method = 'permutation', chunk_size = 500):
+	"""
+	Tests the differences of the MESOR, amplitude and acrophase between two populations. For the permutation test, the population labels are shuffled; for the bootstrap, the subjects of each population are resampled with replacement. Every resample is fitted by weighted least squares, and the weighted normal equations of a chunk of resamples (and all variables) are solved together.
+	
+	Parameters
+	----------
+	endog1 : array
+		Endogenous variable of population 1 (Nsubjects1) or (Nsubjects1, Nvariables)
+	time1 : array
+		Time points of population 1
+	endog2 : array
+		Endogenous variable of population 2 (Nsubjects2) or (Nsubjects2, Nvariables)
+	time2 : array
+		Time points of population 2
+	period : array
+		Period(s) of the cosinor model.
+	n_resamples : int
+		The number of permutations or bootstrap samples
+	method : string
+		'permutation' or 'bootstrap'
+	chunk_size : int
+		The number of resamples that are solved together.
+
+	Returns
+	---------
+	differences : dict
+		Population 1 minus population 2 {'MESOR' (Nvariables), 'AMPLITUDE' (Nperiods, Nvariables), 'ACROPHASE' (Nperiods, Nvariables)}. Acrophase differences are in radians within [-pi, pi) (in hours, -ACROPHASE*period/(2*pi)).
+	p_values : dict
+		Two-tailed p-values of the differences with the same keys
+	distribution : dict
+		The permuted (null) or bootstrapped differences (Nresamples, ...) with the same keys. For the bootstrap, the acrophase differences are unwrapped around the observed difference so that np.percentile gives their confidence interval.
+	"""
+	assert method in ['permutation', 'bootstrap'], "Error: method must be 'permutation' or 'bootstrap'"
+	endog1 = np.asarray(endog1, dtype = np.float64).reshape(len(endog1), -1)
+	endog2 = np.asarray(endog2, dtype = np.float64).reshape(len(endog2), -1)
+	n1 = len(endog1)
+	n2 = len(endog2)
+	n = n1 + n2
+	endog = np.concatenate((endog1, endog2))
+	exog_vars = dummy_code_cosine(np.concatenate((np.asarray(time1, dtype = np.float64), np.asarray(time2, dtype = np.float64))), period)
+	XtX = np.dot(exog_vars.T, exog_vars)
+	Xty = np.dot(exog_vars.T, endog)
+
+	def group_differences(params1, params2):
+		return {'MESOR': params1[0] - params2[0],
+					'AMPLITUDE': params1[1] - params2[1],
+					'ACROPHASE': _wrap_phase(params1[2] - params2[2])}
+
+	observed = group_differences(cosinor_parameters(cached_lstsqr_residual(exog_vars[:n1], endog1)[0], period),
+											cosinor_parameters(cached_lstsqr_residual(exog_vars[n1:], endog2)[0], period))
+
+	distribution = {'MESOR': [], 'AMPLITUDE': [], 'ACROPHASE': []}
+	with profile_stage('compare'):
+		for start in range(0, n_resamples, chunk_size):
+			n_chunk = min(chunk_size, n_resamples - start)
+			if method == 'permutation':
+				# random subsets of n1 subjects are population 1
+				weights = (np.argsort(np.random.random((n_chunk, n)), axis = 1) < n1).astype(np.float64)
+				weighted_exog = weights[:,:,np.newaxis] * exog_vars
+				params1 = _weighted_cosinor_parameters(weighted_exog, exog_vars, endog, None, None, period)
+				params2 = _weighted_cosinor_parameters(weighted_exog, exog_vars, endog, XtX, Xty, period)
+			else:
+				# resampling with replacement is a multinomial weighting of the subjects
+				weights1 = np.random.multinomial(n1, np.ones(n1)/n1, size = n_chunk).astype(np.float64)
+				weights2 = np.random.multinomial(n2, np.ones(n2)/n2, size = n_chunk).astype(np.float64)
+				params1 = _weighted_cosinor_parameters(weights1[:,:,np.newaxis] * exog_vars[:n1], exog_vars[:n1], endog1, None, None, period)
+				params2 = _weighted_cosinor_parameters(weights2[:,:,np.newaxis] * exog_vars[n1:], exog_vars[n1:], endog2, None, None, period)
+			chunk_differences = group_differences(params1, params2)
+			distribution['MESOR'].append(chunk_differences['MESOR'])
+			distribution['AMPLITUDE'].append(np.moveaxis(chunk_differences['AMPLITUDE'], 1, 0))
+			distribution['ACROPHASE'].append(np.moveaxis(chunk_differences['ACROPHASE'], 1, 0))
+
+	p_values = {}
+	for key in distribution:
+		distribution[key] = np.concatenate(distribution[key])
+		if method == 'permutation':
+			p_values[key] = (np.sum(np.abs(distribution[key]) >= np.abs(observed[key]), 0) + 1) / (n_resamples + 1)
+		else:
+			if key == 'ACROPHASE':
+				distribution[key] = observed[key] + _wrap_phase(distribution[key] - observed[key])
+			p_values[key] = np.minimum(2 * np.minimum(np.mean(distribution[key] <= 0, 0), np.mean(distribution[key] >= 0, 0)), 1.0)
+	return(observed, p_values, distribution)
+
+def _column_percentiles(sorted_arr, q):
+	# linear interpolation of the percentiles q (0-100, broadcast to the trailing shape) of every column of sorted_arr (Nresamples, ...)
+	position = np.clip(np.asarray(q, dtype = np.float64) / 100. * (len(sorted_arr) - 1), 0, len(sorted_arr) - 1)
+	position = np.broadcast_to(position, sorted_arr.shape[1:])
+	lower = np.floor(position).astype(int)
+	upper = np.minimum(lower + 1, len(sorted_arr) - 1)
+	fraction = position - lower
+	lower_value = np.take_along_axis(sorted_arr, lower[np.newaxis], 0)[0]
+	upper_value = np.take_along_axis(sorted_arr, upper[np.newaxis], 0)[0]
+	return lower_value + fraction * (upper_value - lower_value)
+
+
+def bootstrap_cosinor(endog, time_variable, period = [24.0], n_bootstrap = 10000, method = 'case', ci = 95., ci_method = 'percentile', block_size = None, dmy_covariates = None, chunk_size = 500):
+	"""
+	Bootstrap confidence intervals of the MESOR, amplitude and acrophase for many variables (e.g., ROIs) at once. The bootstrap samples are solved in chunks: case resampling as weighted normal equations of multinomial weights, residual and block resampling as index matrices of the residuals applied to the cached pseudo-inverse of the design.
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array (Nsubjects) or (Nsubjects, Nvariables)
+	time_variable : array
+		Time points.
+	period : array
+		Period(s) of the cosinor model.
+	n_bootstrap : int
+		The number of bootstrap samples
+	method : string
+		'case' resamples the time points and observations, 'residual' resamples the residuals of the model, 'block' resamples blocks of consecutive residuals (moving block bootstrap) for autocorrelated series.
+	ci : float
+		The confidence level (%)
+	ci_method : string
+		'percentile' or 'bca' (bias-corrected and accelerated; the acceleration is estimated by the jackknife)
+	block_size : int
+		[optional] The number of consecutive time points of each block (method = 'block'). Default: Nsubjects^(1/3)
+	dmy_covariates : array
+		[optional] Dummy coded covariates of no interest that are fitted jointly.
+	chunk_size : int
+		The number of bootstrap samples that are solved together.
+
+	Returns
+	---------
+	estimates : dict
+		The fitted {'MESOR' (Nvariables), 'AMPLITUDE' (Nperiods, Nvariables), 'ACROPHASE' (Nperiods, Nvariables)}. The acrophase is in radians within (-2*pi, 0].
+	ci_lower : dict
+		Lower bounds of the confidence intervals with the same keys
+	ci_upper : dict
+		Upper bounds of the confidence intervals with the same keys. The acrophase bounds are circular (unwrapped around the estimate), so that ci_lower <= ACROPHASE <= ci_upper.
+	distribution : dict
+		The bootstrap distributions (Nbootstrap, ...) with the same keys
+	"""
+	assert method in ['case', 'residual', 'block'], "Error: method must be 'case', 'residual' or 'block'"
+	assert ci_method in ['percentile', 'bca'], "Error: ci_method must be 'percentile' or 'bca'"
+	endog = np.asarray(endog, dtype = np.float64).reshape(len(endog), -1)
+	time_variable = np.asarray(time_variable, dtype = np.float64)
+	n = len(endog)
+	exog_vars = dummy_code_cosine(time_variable, period, dmy_covariates)
+	k = exog_vars.shape[1]
+	_, pinvX = cached_factorisation(exog_vars)
+	a = np.dot(pinvX, endog)
+	MESOR, AMPLITUDE, ACROPHASE = cosinor_parameters(a, period)
+	estimates = {'MESOR': MESOR, 'AMPLITUDE': AMPLITUDE, 'ACROPHASE': ACROPHASE}
+
+	if method != 'case':
+		# residuals in time order, rescaled for the degrees of freedom of the model
+		order = np.argsort(time_variable, kind = 'stable')
+		resids = (endog - np.dot(exog_vars, a))[order] * np.sqrt(n / (n - k))
+		pinvX_ordered = pinvX[:, order]
+		if method == 'block':
+			if block_size is None:
+				block_size = max(1, int(round(n**(1/3.))))
+			block_size = min(int(block_size), n)
+			n_blocks = int(np.ceil(n / block_size))
+
+	distribution = {'MESOR': [], 'AMPLITUDE': [], 'ACROPHASE': []}
+	with profile_stage('bootstrap'):
+		for start in range(0, n_bootstrap, chunk_size):
+			n_chunk = min(chunk_size, n_bootstrap - start)
+			if method == 'case':
+				weights = np.random.multinomial(n, np.ones(n)/n, size = n_chunk).astype(np.float64)
+				params = _weighted_cosinor_parameters(weights[:,:,np.newaxis] * exog_vars, exog_vars, endog, None, None, period)
+			else:
+				if method == 'residual':
+					index = np.random.randint(0, n, size = (n_chunk, n))
+				else:
+					block_starts = np.random.randint(0, n - block_size + 1, size = (n_chunk, n_blocks))
+					index = (block_starts[:,:,np.newaxis] + np.arange(block_size)).reshape(n_chunk, -1)[:,:n]
+				# a* = a + pinv(X) e*
+				boot_a = a[:,np.newaxis,:] + np.einsum('kn,snv->ksv', pinvX_ordered, resids[index])
+				params = cosinor_parameters(boot_a, period)
+			distribution['MESOR'].append(params[0])
+			distribution['AMPLITUDE'].append(np.moveaxis(params[1], 1, 0))
+			distribution['ACROPHASE'].append(np.moveaxis(params[2], 1, 0))
+
+	for key in distribution:
+		distribution[key] = np.concatenate(distribution[key])
+	# circular acrophase: unwrap the bootstrap samples around the estimate
+	distribution['ACROPHASE'] = ACROPHASE + _wrap_phase(distribution['ACROPHASE'] - ACROPHASE)
+
+	alpha = (100. - ci) / 2.
+	if ci_method == 'bca':
+		# jackknife (leave-one-out) estimates for the acceleration in closed form: a_-i = a - (X'X)^-1 x_i e_i / (1 - h_i)
+		resids = endog - np.dot(exog_vars, a)
+		leverage = np.sum(exog_vars * pinvX.T, 1)
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			jackknife_a = a[:,np.newaxis,:] - pinvX[:,:,np.newaxis] * (resids / (1 - leverage)[:,np.newaxis])
+		jackknife = cosinor_parameters(jackknife_a, period)
+		jackknife = {'MESOR': jackknife[0], 'AMPLITUDE': np.moveaxis(jackknife[1], 1, 0), 'ACROPHASE': np.moveaxis(jackknife[2], 1, 0)}
+		jackknife['ACROPHASE'] = ACROPHASE + _wrap_phase(jackknife['ACROPHASE'] - ACROPHASE)
+
+	ci_lower = {}
+	ci_upper = {}
+	for key in distribution:
+		sorted_distribution = np.sort(distribution[key], 0)
+		if ci_method == 'percentile':
+			q_lower = alpha
+			q_upper = 100. - alpha
+		else:
+			with np.errstate(divide = 'ignore', invalid = 'ignore'):
+				z0 = norm.ppf(np.mean(distribution[key] < estimates[key], 0))
+				deviation = jackknife[key].mean(0) - jackknife[key]
+				acceleration = np.sum(deviation**3, 0) / (6 * np.sum(deviation**2, 0)**1.5)
+				acceleration = np.nan_to_num(acceleration)
+				z_lower = z0 + norm.ppf(alpha/100.)
+				z_upper = z0 + norm.ppf(1 - alpha/100.)
+				q_lower = 100. * norm.cdf(z0 + z_lower / (1 - acceleration*z_lower))
+				q_upper = 100. * norm.cdf(z0 + z_upper / (1 - acceleration*z_upper))
+			q_lower = np.nan_to_num(q_lower, nan = alpha)
+			q_upper = np.nan_to_num(q_upper, nan = 100. - alpha)
+		ci_lower[key] = _column_percentiles(sorted_distribution, q_lower)
+		ci_upper[key] = _column_percentiles(sorted_distribution, q_upper)
+	return(estimates, ci_lower, ci_upper, distribution)
+
+
 def set_box_color(bp, color):
 	# https://stackoverflow.com/questions/16592222/matplotlib-group-boxplots
-	plt.setp(bp['boxes'], color=color)
-	plt.setp(bp['whiskers'], color=color)
-	plt.setp(bp['caps'], color=color)
-	plt.setp(bp['medians'], color=color)
+	for key in ['boxes', 'whiskers', 'caps', 'medians']:
+		for artist in bp[key]:
+			artist.set_color(color)
 
-def compare_two_populations(endog1, endog2, scan_time, period = [24.0], outname = 'compare_two_sim_pops.png'):
+def compare_two_populations(endog1, endog2, scan_time, period = [24.0], outname = 'compare_two_sim_pops.png', pdf = None, scan_time2 = None, bins = 10, n_resamples = 10000, method = 'permutation', save_plot = True):
 	"""
-	Build figures comparing to populations based on cosinor simulated data.
+	Compares two populations based on cosinor simulated data with T-tests within time bins and tests of the differences of the cosinor parameters (see cosinor_group_differences). Optionally, builds the figure.
 	
 	Parameters
 	----------
@@ -979,36 +3488,66 @@ def compare_two_populations(endog1, endog2, scan_time, period = [24.0], outname
 		Period of the cosinor model
 	outname : string
 		The figure name.
+	pdf : PdfPages
+		[optional] Add the figure as a page of a multi-page PDF instead of saving outname.
+	scan_time2 : array
+		[optional] time of sampling of population 2 if it differs from scan_time.
+	bins : int or array
+		The number of time bins, or the bin edges, for the T-tests.
+	n_resamples : int
+		The number of permutations or bootstrap samples. The cosinor parameters are not tested if n_resamples is 0.
+	method : string
+		'permutation' or 'bootstrap'
+	save_plot : bool
+		Build and save the figure.
 	Returns
 	---------
-	None
+	bin_tvalues : array
+		T-values within each bin (Nbins)
+	bin_p_values : array
+		Two-tailed p-values within each bin (Nbins)
+	differences : dict
+		Differences of the MESOR, amplitude and acrophase (population 1 minus population 2), or None
+	p_values : dict
+		p-values of the differences, or None
 	
 	"""
 	endog1 = np.array(endog1)
 	endog2 = np.array(endog2)
 	scan_time = np.array(scan_time)
-	print(np.array(endog1).shape, np.array(endog2).shape)
-	assert len(endog1) == len(endog2), "Error: the endogenous variable must be the same length"
-	#sliding window
-	block_size = int(len(endog1) / 10)
+	if scan_time2 is None:
+		assert len(endog1) == len(endog2), "Error: the endogenous variable must be the same length"
+		scan_time2 = scan_time
+	else:
+		scan_time2 = np.array(scan_time2)
+	# T-tests of every bin
+	bin_tvalues, dof, bin_p_values, bin_edges = binned_ttest(endog1, scan_time, endog2, scan_time2, bins = bins)
+	bin_tvalues = bin_tvalues[:,0]
+	bin_p_values = bin_p_values[:,0]
+
+	differences = p_values = None
+	if n_resamples > 0:
+		differences, p_values, _ = cosinor_group_differences(endog1, scan_time, endog2, scan_time2, period = period, n_resamples = n_resamples, method = method)
+
+	if not save_plot:
+		return(bin_tvalues, bin_p_values, differences, p_values)
+
 	labels = []
 	data1 = []
 	data2 = []
-	for i in range(10):
-		dof = int(len(endog1[i*block_size:(i+1)*block_size])*2 -2)
-		tval = ttest_independent_sample(endog1[i*block_size:(i+1)*block_size], endog2[i*block_size:(i+1)*block_size])
-		p = (1 - t.cdf(np.abs(tval),df=dof))*2
+	for i in range(len(bin_tvalues)):
+		p = bin_p_values[i]
 		if p < 0.05:
 			sig = '*'
 		if p < 0.001:
 			sig = '**'
 		if p < 0.0001:
 			sig = '***'
-		if p >= 0.05:
+		if not p < 0.05:
 			sig = ''
-		labels.append('%1.1f-%1.1fh\n' % (scan_time[i*block_size], scan_time[(i+1)*block_size-1]) + r'$t_{%d}=%1.1f ^{%s}$' % (dof,tval, sig))
-		data1.append(endog1[i*block_size:(i+1)*block_size])
-		data2.append(endog2[i*block_size:(i+1)*block_size])
+		labels.append('%1.1f-%1.1fh\n' % (bin_edges[i], bin_edges[i+1]) + r'$t_{%d}=%1.1f ^{%s}$' % (dof[i], bin_tvalues[i], sig))
+		data1.append(endog1[_time_bins(scan_time, bin_edges) == i])
+		data2.append(endog2[_time_bins(scan_time2, bin_edges) == i])
 
 
 	M_1, AMP_1, ACR_1 = glm_cosinor(endog = np.array(endog1).reshape(len(endog1),1), 
@@ -1019,43 +3558,49 @@ def compare_two_populations(endog1, endog2, scan_time, period = [24.0], outname
 	y1 = project_cosionor_model(M_1, AMP_1, ACR_1, TIME_VAR = scan_time, PERIOD = period)
 
 	M_2, AMP_2, ACR_2 = glm_cosinor(endog = np.array(endog2).reshape(len(endog2),1), 
-											time_var = scan_time,
+											time_var = scan_time2,
 											period = period,
 											calc_MESOR = True,
 											output_fit_only = True)
 
-	y2 = project_cosionor_model(M_2, AMP_2, ACR_2, TIME_VAR = scan_time, PERIOD = period)
+	y2 = project_cosionor_model(M_2, AMP_2, ACR_2, TIME_VAR = scan_time2, PERIOD = period)
 
-	plt.figure(figsize=(12,8))
-	plt.subplot(2, 1, 1)
-	plt.plot(scan_time, y1, c='#D7191C')
-	plt.scatter(scan_time, endog1, marker = '.', c='#D7191C', alpha = 0.2)
-	plt.axhline(y=M_1, color='#D7191C', alpha = 0.2)
+	fig = figure_template(figsize = (12,8))
+	ax = fig.add_subplot(2, 1, 1)
+	ax.plot(scan_time, y1, c='#D7191C')
+	ax.scatter(scan_time, endog1, marker = '.', c='#D7191C', alpha = 0.2)
+	ax.axhline(y=M_1, color='#D7191C', alpha = 0.2)
 	for i in range(len(period)):
-		plt.axvline(x=np.abs(ACR_1[i]/(2*np.pi)) * period[i], color='#D7191C', ls = ':', alpha = 0.2)
-	plt.plot(scan_time, y2, c='#2C7BB6')
-	plt.scatter(scan_time, endog2, marker = '.', c='#2C7BB6', alpha = 0.2)
-	plt.axhline(y=M_2, color='#2C7BB6', alpha = 0.2)
+		ax.axvline(x=np.abs(ACR_1[i]/(2*np.pi)) * period[i], color='#D7191C', ls = ':', alpha = 0.2)
+	ax.plot(scan_time2, y2, c='#2C7BB6')
+	ax.scatter(scan_time2, endog2, marker = '.', c='#2C7BB6', alpha = 0.2)
+	ax.axhline(y=M_2, color='#2C7BB6', alpha = 0.2)
 	for i in range(len(period)):
-		plt.axvline(x=np.abs(ACR_2[i]/(2*np.pi)) * period[i], color='#2C7BB6', ls = ':', alpha = 0.2)
-	plt.plot([], c='#D7191C', label=r'$Population1, \mu \pm SD = %1.1f\pm%1.1f$' % (endog1.mean(), endog1.std()))
-	plt.plot([], c='#2C7BB6', label=r'$Population2, \mu \pm SD = %1.1f\pm%1.1f$' % (endog2.mean(), endog2.std()))
-	plt.xticks(list(range(25)))
-	plt.legend()
-
-	plt.subplot(2, 1, 2)
-	bpl = plt.boxplot(data1, positions=np.array(range(len(data1)))*2.0-0.4, sym='', widths=0.6)
-	bpr = plt.boxplot(data2, positions=np.array(range(len(data2)))*2.0+0.4, sym='', widths=0.6)
+		ax.axvline(x=np.abs(ACR_2[i]/(2*np.pi)) * period[i], color='#2C7BB6', ls = ':', alpha = 0.2)
+	ax.plot([], c='#D7191C', label=r'$Population1, \mu \pm SD = %1.1f\pm%1.1f$' % (endog1.mean(), endog1.std()))
+	ax.plot([], c='#2C7BB6', label=r'$Population2, \mu \pm SD = %1.1f\pm%1.1f$' % (endog2.mean(), endog2.std()))
+	if differences is not None:
+		txt = r"$\Delta MESOR = %1.2f, p = %1.4f$" % (float(np.squeeze(differences['MESOR'])), float(np.squeeze(p_values['MESOR'])))
+		for i, per in enumerate(period):
+			txt += r"; $\Delta Amplitude_{%1.1f} = %1.2f, p = %1.4f$; $\Delta Acrophase_{%1.1f} = %1.2fh, p = %1.4f$" % (per, float(np.squeeze(differences['AMPLITUDE'][i])), float(np.squeeze(p_values['AMPLITUDE'][i])), per, -float(np.squeeze(differences['ACROPHASE'][i]))*per/(2*np.pi), float(np.squeeze(p_values['ACROPHASE'][i])))
+		ax.set_title("%s (%d %s)" % (txt, n_resamples, 'permutations' if method == 'permutation' else 'bootstrap samples'), fontsize = 9)
+	ax.set_xticks(list(range(25)))
+	ax.legend()
+
+	ax = fig.add_subplot(2, 1, 2)
+	bpl = ax.boxplot(data1, positions=np.array(range(len(data1)))*2.0-0.4, sym='', widths=0.6)
+	bpr = ax.boxplot(data2, positions=np.array(range(len(data2)))*2.0+0.4, sym='', widths=0.6)
 	set_box_color(bpl, '#D7191C') # colors are from http://colorbrewer2.org/
 	set_box_color(bpr, '#2C7BB6')
-	plt.plot([], c='#D7191C', label='Population1')
-	plt.plot([], c='#2C7BB6', label='Population2')
-	plt.legend()
-	plt.xticks(range(0, len(labels) * 2, 2), labels)
-	plt.xlim(-2, len(labels)*2)
-	plt.tight_layout()
-	plt.savefig(outname, transparent=False, bbox_inches='tight')
-	plt.close()
+	ax.plot([], c='#D7191C', label='Population1')
+	ax.plot([], c='#2C7BB6', label='Population2')
+	ax.legend()
+	ax.set_xticks(range(0, len(labels) * 2, 2))
+	ax.set_xticklabels(labels)
+	ax.set_xlim(-2, len(labels)*2)
+	fig.tight_layout()
+	save_figure(fig, outname, pdf = pdf)
+	return(bin_tvalues, bin_p_values, differences, p_values)
 
 
 def str2array(string, datatype = float):
@@ -1136,12 +3681,31 @@ def simulated_data_from_json(jsonname):
 	"""
 	with open(jsonname) as json_file:
 		model_settings = json.load(json_file)
-		period = np.array(model_settings['period'])
-		n_timepoints = int(model_settings['n_timepoints'])
-		AMPLITUDE = np.array(model_settings['AMPLITUDE'])
-		ACROPHASE24 = np.array(model_settings['ACROPHASE24'])
-		MESOR = model_settings['MESOR']
-		Noise_std = np.array(model_settings['Noise_std'])
+	return(simulated_data_from_model(model_settings))
+
+
+def simulated_data_from_model(model_settings):
+	"""
+	Simulated data from cosinor model settings (the schema of interactive_model_definition).
+	
+	Parameters
+	----------
+	model_settings : dict
+		{period, n_timepoints, AMPLITUDE, ACROPHASE24, MESOR, Noise_std}
+
+	Returns
+	---------
+	pdMODEL : dictionary
+		pandas dictionary of the simulated model
+	Period
+		period of the simulated model.
+	"""
+	period = np.array(model_settings['period'])
+	n_timepoints = int(model_settings['n_timepoints'])
+	AMPLITUDE = np.array(model_settings['AMPLITUDE'])
+	ACROPHASE24 = np.array(model_settings['ACROPHASE24'])
+	MESOR = model_settings['MESOR']
+	Noise_std = np.array(model_settings['Noise_std'])
 	for i, per in enumerate(period):
 		if i == 0:
 			pdMODEL = create_simulated_data(modeloptions = [AMPLITUDE[i], ACROPHASE24[i], n_timepoints, MESOR, Noise_std[i]], period = [per], range_sampling = [0, 23.99], resample_eveningly = True, save_csv = None, random_acrophase = False, summate_models = None)
@@ -1149,3 +3713,259 @@ def simulated_data_from_json(jsonname):
 			pdMODEL = create_simulated_data(modeloptions = [AMPLITUDE[i], ACROPHASE24[i], n_timepoints, 0, Noise_std[i]], period = [per], range_sampling = [0, 23.99], resample_eveningly = True, save_csv = None, random_acrophase = False, summate_models = pdMODEL)
 	return(pdMODEL, period)
 
+
+
+def cosinor_power(time_variable, AMPLITUDE, ACROPHASE24, noise_std, period = [24.0], alpha = 0.05):
+	"""
+	Analytic power of the cosinor F-test and the expected standard errors of the amplitude and acrophase for many model configurations at once. For fixed time points, Fmodel follows a noncentral F-distribution with 2*Nperiods and n - (1 + 2*Nperiods) degrees of freedom and noncentrality lambda = b' (C' (X'X)^-1 C)^-1 b / noise_std^2, where b are the cosinor coefficients [beta_1, gamma_1, ...] of the model. The standard errors are from the same error propagation as glm_cosinor. For randomised time points, pass a set of sampled designs (Ndesigns, Ntimepoints); the power is then averaged over the designs, which only requires Monte Carlo sampling of the time points instead of refitting simulated data.
+	
+	Parameters
+	----------
+	time_variable : array
+		Time points (Ntimepoints) or sampled time points of random designs (Ndesigns, Ntimepoints)
+	AMPLITUDE : array
+		Amplitude of each period (Nperiods, ...). Trailing dimensions are configurations that are broadcast with ACROPHASE24 and noise_std.
+	ACROPHASE24 : array
+		Acrophase of each period in hours (Nperiods, ...)
+	noise_std : array
+		Standard deviation of the noise (...)
+	period : array
+		Period(s) of the cosinor model.
+	alpha : float
+		Significance level of the F-test.
+
+	Returns
+	---------
+	power : array
+		Probability that Fmodel is significant at alpha (...)
+	noncentrality : array
+		Noncentrality parameter of Fmodel (...). The mean over designs for random designs.
+	SE_AMPLITUDE : array
+		Expected standard error of the amplitude (Nperiods, ...)
+	SE_ACROPHASE_24 : array
+		Expected standard error of the acrophase in hours (Nperiods, ...)
+	"""
+	num_period = len(period)
+	period = np.asarray(period, dtype = np.float64)
+	designs = np.atleast_2d(np.asarray(time_variable, dtype = np.float64))
+	n = designs.shape[1]
+	k = 1 + 2*num_period
+	DF_Between = k - 1
+	DF_Within = n - k
+	assert DF_Within > 0, "Error: the number of time points must be larger than %d" % k
+	AMPLITUDE = np.asarray(AMPLITUDE, dtype = np.float64)
+	AMPLITUDE = AMPLITUDE.reshape((num_period,) + AMPLITUDE.shape[1:])
+	ACROPHASE24 = np.asarray(ACROPHASE24, dtype = np.float64)
+	ACROPHASE24 = ACROPHASE24.reshape((num_period,) + ACROPHASE24.shape[1:])
+	noise_std = np.asarray(noise_std, dtype = np.float64)
+	shape = np.broadcast_shapes(AMPLITUDE.shape[1:], ACROPHASE24.shape[1:], noise_std.shape)
+	AMPLITUDE = np.broadcast_to(AMPLITUDE, (num_period,) + shape).reshape(num_period, -1)
+	ACROPHASE = -2*np.pi*np.broadcast_to(ACROPHASE24, (num_period,) + shape).reshape(num_period, -1) / period[:,np.newaxis]
+	noise_var = np.broadcast_to(noise_std, shape).reshape(-1)**2
+	coef = np.empty((2*num_period, AMPLITUDE.shape[1]))
+	coef[0::2] = AMPLITUDE * np.cos(ACROPHASE)
+	coef[1::2] = -AMPLITUDE * np.sin(ACROPHASE)
+
+	exog_vars = np.empty((len(designs), n, k))
+	exog_vars[:,:,0] = 1
+	radians = 2*np.pi*designs[:,:,np.newaxis] / period
+	exog_vars[:,:,1::2] = np.cos(radians)
+	exog_vars[:,:,2::2] = np.sin(radians)
+	invXX = np.linalg.inv(np.einsum('dnk,dnl->dkl', exog_vars, exog_vars))[:,1:,1:]
+	# noncentrality for each design and configuration (Ndesigns, Nconfigurations)
+	noncentrality = np.einsum('kc,dkl,lc->dc', coef, np.linalg.inv(invXX), coef) / noise_var
+	critical_F = f.isf(alpha, DF_Between, DF_Within)
+	power = ncf.sf(critical_F, DF_Between, DF_Within, noncentrality).mean(0)
+	var_AMPLITUDE = np.zeros((num_period, coef.shape[1]))
+	var_ACROPHASE = np.zeros((num_period, coef.shape[1]))
+	for i in range(num_period):
+		cos_acro = np.cos(ACROPHASE[i])
+		sin_acro = np.sin(ACROPHASE[i])
+		V_bb = invXX[:,2*i,2*i,np.newaxis]
+		V_bg = invXX[:,2*i,2*i+1,np.newaxis]
+		V_gg = invXX[:,2*i+1,2*i+1,np.newaxis]
+		var_AMPLITUDE[i] = np.mean(noise_var * (V_bb*cos_acro**2 - 2*V_bg*sin_acro*cos_acro + V_gg*sin_acro**2), 0)
+		var_ACROPHASE[i] = np.mean(noise_var * (V_bb*sin_acro**2 + 2*V_bg*sin_acro*cos_acro + V_gg*cos_acro**2), 0) / AMPLITUDE[i]**2
+	SE_ACROPHASE_24 = np.sqrt(var_ACROPHASE) * period[:,np.newaxis] / (2*np.pi)
+	return(power.reshape(shape), noncentrality.mean(0).reshape(shape), np.sqrt(var_AMPLITUDE).reshape((num_period,) + shape), SE_ACROPHASE_24.reshape((num_period,) + shape))
+
+
+def model_power(model, period = [24.0], alpha = 0.05, range_sampling = [0, 23.99], resample_eveningly = True, n_designs = 1000):
+	"""
+	Analytic power and precision of a simulated cosinor model (see cosinor_power).
+	
+	Parameters
+	----------
+	model : list, dict or string
+		The model options of create_simulated_data [amplitude, acrophase24, n_timepoints, noise_mean, noise_std] (the amplitude and acrophase are used for every period), the model settings of interactive_model_definition {period, n_timepoints, AMPLITUDE, ACROPHASE24, MESOR, Noise_std}, or the JSON file of the model settings. The noise of every period of the model settings is summed as in simulated_data_from_model.
+	period : array
+		Period(s) of the model options (the model settings have their own periods).
+	alpha : float
+		Significance level of the F-test.
+	range_sampling : array
+		The time range for sampling [start, stop]
+	resample_eveningly : bool
+		The time points are equally distributed across the sample range. Otherwise, the time points are random and the power is averaged over n_designs random designs.
+	n_designs : int
+		The number of random designs (resample_eveningly = False).
+
+	Returns
+	---------
+	power : float
+		Power of the F-test
+	SE_AMPLITUDE : array
+		Expected standard error of the amplitude of each period
+	SE_ACROPHASE_24 : array
+		Expected standard error of the acrophase of each period in hours
+	"""
+	if isinstance(model, str):
+		with open(model) as json_file:
+			model = json.load(json_file)
+	if isinstance(model, dict):
+		period = [float(per) for per in model['period']]
+		n_timepoints = int(model['n_timepoints'])
+		AMPLITUDE = np.array(model['AMPLITUDE'], dtype = np.float64)
+		ACROPHASE24 = np.array(model['ACROPHASE24'], dtype = np.float64)
+		noise_std = np.sqrt(np.sum(np.array(model['Noise_std'], dtype = np.float64)**2))
+	else:
+		n_timepoints = int(model[2])
+		AMPLITUDE = np.full(len(period), float(model[0]))
+		ACROPHASE24 = np.full(len(period), float(model[1]))
+		noise_std = np.sqrt(len(period)) * float(model[4])
+	if resample_eveningly:
+		time_variable = np.linspace(range_sampling[0], range_sampling[1], n_timepoints)
+	else:
+		time_variable = np.sort(np.random.uniform(low=range_sampling[0], high=range_sampling[1], size=(n_designs, n_timepoints)), axis = 1)
+	power, _, SE_AMPLITUDE, SE_ACROPHASE_24 = cosinor_power(time_variable, AMPLITUDE, ACROPHASE24, noise_std, period = period, alpha = alpha)
+	return(float(power), SE_AMPLITUDE, SE_ACROPHASE_24)
+
+
+def optimise_schedule(n_timepoints, windows = [[0, 23.99]], period = [24.0], criterion = 'acrophase', AMPLITUDE = None, ACROPHASE24 = None, noise_std = 1.0, min_spacing = 0.0, grid_step = 0.1, max_iterations = 1000, initial_times = None, alpha = 0.05):
+	"""
+	Designs a sampling schedule (scan times) that minimises the variance of the acrophase or amplitude, or maximises the power of the cosinor F-test, with an exchange algorithm. The candidate times are a grid over the allowed windows. Each iteration evaluates every move of a scheduled time to a candidate time with rank-one (Sherman-Morrison) downdates and updates of (X'X)^-1, so all the n_timepoints x Ncandidates schedules of an iteration are evaluated at once, and the best move is made until no move improves the schedule.
+	
+	Parameters
+	----------
+	n_timepoints : int
+		The number of time points (the sampling budget)
+	windows : array
+		Allowed time windows in hours [[start, stop], ...]
+	period : array
+		Period(s) of the cosinor model.
+	criterion : string
+		'acrophase' (sum of the variances of the acrophases in hours^2), 'amplitude' (sum of the variances of the amplitudes) or 'power' (noncentrality of the F-test).
+	AMPLITUDE : array
+		[optional] Amplitude of each period. Required for 'power'. For 'acrophase', the variances are relative to an amplitude of one if it is not set.
+	ACROPHASE24 : array
+		[optional] Acrophase of each period in hours. Required for 'power'. If it is not set, the variances are averaged over all acrophases.
+	noise_std : float
+		Standard deviation of the noise (only scales the criterion and the power).
+	min_spacing : float
+		The minimum time between time points in hours (0 allows repeated time points).
+	grid_step : float
+		The spacing of the candidate times in hours.
+	max_iterations : int
+		The maximum number of moves.
+	initial_times : array
+		[optional] The starting schedule (default: evenly spaced within the windows).
+	alpha : float
+		Significance level of the reported power.
+
+	Returns
+	---------
+	schedule : array
+		The sorted time points (n_timepoints)
+	criterion_value : float
+		The variance (acrophase, amplitude) or noncentrality (power) of the schedule
+	power : float
+		The power of the F-test of the schedule (NaN without AMPLITUDE and ACROPHASE24)
+	"""
+	assert criterion in ['acrophase', 'amplitude', 'power'], "Error: criterion must be 'acrophase', 'amplitude' or 'power'"
+	assert (criterion != 'power') or ((AMPLITUDE is not None) and (ACROPHASE24 is not None)), "Error: the power criterion requires AMPLITUDE and ACROPHASE24"
+	num_period = len(period)
+	period = np.asarray(period, dtype = np.float64)
+	k = 1 + 2*num_period
+	assert n_timepoints > k, "Error: the number of time points must be larger than %d" % k
+	windows = np.asarray(windows, dtype = np.float64).reshape(-1, 2)
+	candidates = np.unique(np.round(np.concatenate([np.arange(start, stop + grid_step/2., grid_step) for start, stop in windows]), 6))
+	candidates = candidates[np.any((candidates[:,np.newaxis] >= windows[:,0] - 1e-9) & (candidates[:,np.newaxis] <= windows[:,1] + 1e-9), 1)]
+	Z = dummy_code_cosine(candidates, period)
+
+	# the criteria are trace(G' V G) with V = (X'X)^-1, or the noncentrality b' (V_cc)^-1 b
+	report_power = (AMPLITUDE is not None) and (ACROPHASE24 is not None)
+	# without AMPLITUDE, the acrophase variances are scaled to an amplitude of one (but no power is reported)
+	AMPLITUDE = np.ones(num_period) if AMPLITUDE is None else np.asarray(AMPLITUDE, dtype = np.float64).reshape(num_period)
+	if ACROPHASE24 is None:
+		# the average over acrophases of the variances of the amplitude and of the acrophase is (V_bb + V_gg)/2
+		G = np.zeros((k, 2*num_period))
+		for i in range(num_period):
+			scale = 1. if criterion == 'amplitude' else period[i] / (2*np.pi*AMPLITUDE[i])
+			G[1+2*i,2*i] = G[2+2*i,2*i+1] = scale / np.sqrt(2)
+	else:
+		ACROPHASE = -2*np.pi*np.asarray(ACROPHASE24, dtype = np.float64).reshape(num_period) / period
+		G = np.zeros((k, num_period))
+		b = np.zeros(2*num_period)
+		for i in range(num_period):
+			if criterion == 'amplitude':
+				G[1+2*i,i], G[2+2*i,i] = np.cos(ACROPHASE[i]), -np.sin(ACROPHASE[i])
+			else:
+				scale = period[i] / (2*np.pi*AMPLITUDE[i])
+				G[1+2*i,i], G[2+2*i,i] = scale * np.sin(ACROPHASE[i]), scale * np.cos(ACROPHASE[i])
+			b[2*i], b[2*i+1] = AMPLITUDE[i]*np.cos(ACROPHASE[i]), -AMPLITUDE[i]*np.sin(ACROPHASE[i])
+	noise_var = float(noise_std)**2
+
+	def _criterion(V):
+		if criterion == 'power':
+			return -np.dot(b, np.linalg.solve(V[1:,1:], b)) / noise_var
+		return np.sum(G * np.dot(V, G)) * noise_var
+
+	if initial_times is None:
+		assert len(candidates) >= n_timepoints, "Error: the windows have fewer candidate times than n_timepoints (decrease grid_step)"
+		times = candidates[np.round(np.linspace(0, len(candidates) - 1, n_timepoints)).astype(int)]
+	else:
+		times = np.array(initial_times, dtype = np.float64)
+		assert len(times) == n_timepoints, "Error: initial_times must have n_timepoints time points"
+	if min_spacing > 0:
+		assert np.all(np.diff(np.sort(times)) >= min_spacing - 1e-9), "Error: the initial schedule does not have the minimum spacing (the windows may be too short for n_timepoints)"
+	X = dummy_code_cosine(times, period)
+	V = np.linalg.inv(np.dot(X.T, X))
+	current = _criterion(V)
+	for iteration in range(max_iterations):
+		too_close = np.abs(candidates[:,np.newaxis] - times[np.newaxis,:]) < (min_spacing - 1e-9)
+		n_close = too_close.sum(1)
+		best = (current, None, None)
+		for i in range(n_timepoints):
+			# remove time point i: V_i = V + V x x' V / (1 - x' V x)
+			Vx = np.dot(V, X[i])
+			d = 1 - np.dot(X[i], Vx)
+			if d < 1e-10:
+				continue
+			V_i = V + np.outer(Vx, Vx) / d
+			# add every candidate z: V' = V_i - V_i z z' V_i / (1 + z' V_i z)
+			VZ = np.dot(Z, V_i)
+			q = 1 + np.sum(VZ * Z, 1)
+			if criterion == 'power':
+				W = np.linalg.inv(V_i[1:,1:])
+				U = VZ[:,1:]
+				WU = np.dot(U, W)
+				values = -(np.dot(b, np.dot(W, b)) + np.dot(WU, b)**2 / (q - np.sum(WU * U, 1))) / noise_var
+			else:
+				values = (np.sum(G * np.dot(V_i, G)) - np.sum(np.dot(VZ, G)**2, 1) / q) * noise_var
+			feasible = ((n_close - too_close[:,i]) == 0) & (candidates != times[i])
+			if not feasible.any():
+				continue
+			j = np.argmin(np.where(feasible, values, np.inf))
+			if values[j] < best[0]:
+				best = (values[j], i, j)
+		if (best[1] is None) or (best[0] > current - 1e-10 * np.abs(current)):
+			break
+		_, i, j = best
+		times[i] = candidates[j]
+		X[i] = Z[j]
+		V = np.linalg.inv(np.dot(X.T, X))
+		current = _criterion(V)
+	power = np.nan
+	if report_power:
+		power = float(cosinor_power(times, AMPLITUDE, ACROPHASE24, noise_std, period = period, alpha = alpha)[0])
+	criterion_value = -current if criterion == 'power' else current
+	return(np.sort(times), criterion_value, power)
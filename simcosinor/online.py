@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+from __future__ import division
+import io
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+
+from simcosinor.functions import dummy_code_cosine, cosinor_parameters, acrophase_to_hours, f_neglog10_pvalues
+from simcosinor.profiling import profile_stage
+
+class OnlineCosinor:
+	"""
+	Online cosinor model of continuously recorded data. The estimator keeps the sufficient statistics of the least squares fit (X'X, X'y and y'y of each variable), so new samples are added in O(k^2) per sample, and the MESOR, amplitude, acrophase and F-test of the samples so far are available at any time without refitting the whole series. With a forgetting factor < 1, the weight of each sample decays by the factor for every newer sample, so the estimates follow changes of the rhythm (the effective number of samples is about 1 / (1 - forgetting)).
+
+	Parameters
+	----------
+	n_variables : int
+		The number of variables (e.g., ROIs or channels)
+	period : array
+		Period(s) of the cosinor model.
+	forgetting : float
+		Exponential forgetting factor in (0, 1] (1: all samples have the same weight)
+	names : list
+		[optional] Variable names
+
+	e.g.,
+	model = OnlineCosinor(n_variables = 2, period = [24.0], forgetting = 0.999)
+	model.update(time_variable, endog)
+	R2, MESOR, AMPLITUDE, ACROPHASE_24, Fmodel, neglog10p = model.estimates()
+	model.save('state.npz')
+	"""
+	def __init__(self, n_variables = 1, period = [24.0], forgetting = 1.0, names = None):
+		assert (forgetting > 0) and (forgetting <= 1), "Error: the forgetting factor must be in (0, 1]"
+		self.period = [float(p) for p in period]
+		self.forgetting = float(forgetting)
+		self.names = list(names) if names is not None else ["var%d" % (i + 1) for i in range(n_variables)]
+		assert len(self.names) == n_variables, "Error: there must be a name for each variable"
+		k = 1 + 2*len(self.period)
+		self.XX = np.zeros((k, k))
+		self.Xy = np.zeros((k, n_variables))
+		self.yy = np.zeros(n_variables)
+		self.n_samples = 0
+		self.last_time = None
+		# byte offset of the next unread line of a tailed CSV (see stream_cosinor)
+		self.offset = 0
+
+	@property
+	def n_effective(self):
+		"""
+		The sum of the sample weights (the number of samples without forgetting)
+		"""
+		return self.XX[0,0]
+
+	def update(self, time_variable, endog):
+		"""
+		Adds samples to the model. Rows with missing values (NaN) are skipped.
+
+		Parameters
+		----------
+		time_variable : array
+			Time points of the new samples (Nsamples)
+		endog : array
+			New samples (Nsamples) or (Nsamples, Nvariables)
+		"""
+		time_variable = np.asarray(time_variable, dtype = np.float64).ravel()
+		endog = np.asarray(endog, dtype = np.float64).reshape(len(time_variable), -1)
+		assert endog.shape[1] == self.Xy.shape[1], "Error: the model has %d variables" % self.Xy.shape[1]
+		complete = ~np.isnan(endog).any(1) & ~np.isnan(time_variable)
+		time_variable = time_variable[complete]
+		endog = endog[complete]
+		n = len(time_variable)
+		if n == 0:
+			return
+		with profile_stage('online update'):
+			exog_vars = dummy_code_cosine(time_variable, self.period)
+			# the weights of the new samples (the newest sample has weight 1) and the decay of the old statistics
+			weights = self.forgetting ** np.arange(n - 1, -1, -1, dtype = np.float64)
+			decay = self.forgetting ** n
+			weighted_exog = exog_vars * weights[:,np.newaxis]
+			self.XX = decay * self.XX + np.dot(weighted_exog.T, exog_vars)
+			self.Xy = decay * self.Xy + np.dot(weighted_exog.T, endog)
+			self.yy = decay * self.yy + np.dot(weights, endog**2)
+		self.n_samples += n
+		self.last_time = float(time_variable[-1])
+
+	def estimates(self):
+		"""
+		The cosinor model of the samples so far.
+
+		Returns
+		---------
+		R2 : array
+			R-squared (Nvariables)
+		MESOR : array
+			MESOR (Nvariables)
+		AMPLITUDE : array
+			Amplitude (Nperiods, Nvariables)
+		ACROPHASE_24 : array
+			Acrophase in hours of each period (Nperiods, Nvariables)
+		Fmodel : array
+			F-values (Nvariables)
+		neglog10p : array
+			-log10 p-values of the F-test with the effective number of samples (Nvariables)
+		"""
+		k = self.XX.shape[0]
+		assert self.n_samples > k, "Error: the model requires more than %d samples" % k
+		a = np.linalg.solve(self.XX, self.Xy)
+		SS_Residuals = np.maximum(self.yy - np.sum(a * self.Xy, 0), 0)
+		SS_Total = self.yy - self.Xy[0]**2 / self.XX[0,0]
+		DF_Between = k - 1
+		DF_Within = self.n_effective - k
+		R2 = 1 - (SS_Residuals / SS_Total)
+		Fmodel = (((SS_Total - SS_Residuals) / DF_Between) / (SS_Residuals / DF_Within)) if DF_Within > 0 else np.full(len(R2), np.nan)
+		MESOR, AMPLITUDE, ACROPHASE = cosinor_parameters(a, self.period)
+		neglog10p = f_neglog10_pvalues(Fmodel, DF_Between, DF_Within) if DF_Within > 0 else np.full(len(R2), np.nan)
+		return (R2, MESOR, AMPLITUDE, acrophase_to_hours(ACROPHASE, self.period), Fmodel, neglog10p)
+
+	def summary(self):
+		"""
+		The current estimates as a DataFrame with a row for each variable.
+		"""
+		R2, MESOR, AMPLITUDE, ACROPHASE_24, Fmodel, neglog10p = self.estimates()
+		summary = pd.DataFrame({'R2': R2, 'MESOR': MESOR}, index = self.names)
+		for j, per in enumerate(self.period):
+			summary['AMPLITUDE_%s' % per] = AMPLITUDE[j]
+			summary['ACROPHASE24_%s' % per] = ACROPHASE_24[j]
+		summary['Fmodel'] = Fmodel
+		summary['neglog10p'] = neglog10p
+		return summary
+
+	def save(self, path):
+		"""
+		Checkpoints the state of the model to a *.npz file. The file is replaced atomically, so an interrupted save leaves the previous checkpoint.
+		"""
+		settings = {'period': self.period,
+						'forgetting': self.forgetting,
+						'names': self.names,
+						'n_samples': self.n_samples,
+						'last_time': self.last_time,
+						'offset': self.offset}
+		temp_path = path + '.tmp'
+		with open(temp_path, 'wb') as outfile:
+			np.savez(outfile, XX = self.XX, Xy = self.Xy, yy = self.yy, settings = json.dumps(settings))
+		os.replace(temp_path, path)
+
+	@classmethod
+	def load(cls, path):
+		"""
+		Restores a model from a checkpoint (see save).
+		"""
+		with np.load(path) as checkpoint:
+			settings = json.loads(str(checkpoint['settings']))
+			model = cls(n_variables = len(settings['names']), period = settings['period'], forgetting = settings['forgetting'], names = settings['names'])
+			model.XX = checkpoint['XX']
+			model.Xy = checkpoint['Xy']
+			model.yy = checkpoint['yy']
+		model.n_samples = settings['n_samples']
+		model.last_time = settings['last_time']
+		model.offset = settings['offset']
+		return model
+
+
+def tail_csv(csvname, offset = 0, follow = True, poll_interval = 1.0, max_bytes = 2**24):
+	"""
+	Reads the rows that are appended to a growing CSV file. While following the file, only complete lines are read, so a row that is still being written is read on the next poll. Without follow, the file is complete, and a last row without a newline is read at the end of the file.
+
+	Parameters
+	----------
+	csvname : string
+		CSV file with a header
+	offset : int
+		Byte offset of the first unread line (0: the start of the file)
+	follow : bool
+		Keep polling the file for new rows. Otherwise, stop at the end of the file.
+	poll_interval : float
+		Seconds between polls
+	max_bytes : int
+		The bytes read at once. The read grows for a line that is longer than max_bytes.
+
+	Returns
+	---------
+	Generator of (rows, offset): the new rows as a DataFrame, and the byte offset after them
+	"""
+	with open(csvname, 'rb') as csvfile:
+		header = csvfile.readline()
+		if not header.endswith(b'\n'):
+			header += b'\n'
+		offset = max(offset, csvfile.tell())
+		read_bytes = max_bytes
+		while True:
+			csvfile.seek(offset)
+			block = csvfile.read(read_bytes)
+			end = block.rfind(b'\n') + 1
+			if end > 0:
+				offset += end
+				read_bytes = max_bytes
+				yield (pd.read_csv(io.BytesIO(header + block[:end]), delimiter=',', index_col=None), offset)
+			elif len(block) == read_bytes:
+				# a line longer than the block
+				read_bytes *= 2
+			elif follow:
+				time.sleep(poll_interval)
+			else:
+				# the last row of a complete file may not end with a newline
+				if block.strip():
+					offset += len(block)
+					yield (pd.read_csv(io.BytesIO(header + block), delimiter=',', index_col=None), offset)
+				break
+
+
+def stream_cosinor(csvname, time_variable, variables, checkpoint = None, period = [24.0], forgetting = 1.0, follow = True, poll_interval = 1.0, report = None):
+	"""
+	Online cosinor models of the variables of a growing CSV file (e.g., a wearable or monitoring recording). The new rows are added to the model as they are written, the state is checkpointed after each block of rows, and a stream that is restarted with the same checkpoint continues after the last row that was added.
+
+	Parameters
+	----------
+	csvname : string
+		CSV file with a header
+	time_variable : string
+		Column of the time points
+	variables : list
+		Columns of the variables
+	checkpoint : string
+		[optional] *.npz file of the state of the model (see OnlineCosinor.save)
+	period : array
+		Period(s) of the cosinor model (ignored when resuming from a checkpoint)
+	forgetting : float
+		Exponential forgetting factor (ignored when resuming from a checkpoint)
+	follow : bool
+		Keep reading rows as they are written (until the stream is interrupted, e.g., by KeyboardInterrupt). Otherwise, stop at the end of the file.
+	poll_interval : float
+		Seconds between polls of the file
+	report : function
+		[optional] Called with the model after each block of rows (e.g., to print model.summary())
+
+	Returns
+	---------
+	model : OnlineCosinor
+		The model of all the rows read
+	"""
+	if (checkpoint is not None) and os.path.exists(checkpoint):
+		model = OnlineCosinor.load(checkpoint)
+		assert model.names == list(variables), "Error: the checkpoint %s has the variables %s" % (checkpoint, ", ".join(model.names))
+	else:
+		model = OnlineCosinor(n_variables = len(variables), period = period, forgetting = forgetting, names = variables)
+	for rows, offset in tail_csv(csvname, offset = model.offset, follow = follow, poll_interval = poll_interval):
+		model.update(np.array(rows[time_variable]), np.array(rows[list(variables)]))
+		model.offset = offset
+		if checkpoint is not None:
+			model.save(checkpoint)
+		if (report is not None) and (model.n_samples > model.XX.shape[0]):
+			report(model)
+	return model
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+from __future__ import division
+import os
+import sys
+import csv
+import json
+import time
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+try:
+	import resource
+except ImportError:
+	resource = None
+
+# The profiler that records the stages of the library (see profile_run). Stages are not recorded when it is None.
+_ACTIVE_PROFILER = None
+
+def max_rss():
+	"""
+	The peak resident memory of the process so far in bytes (None if the resource module is not available, e.g., on Windows).
+	"""
+	if resource is None:
+		return None
+	maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# kilobytes on Linux, bytes on macOS
+	if sys.platform == 'darwin':
+		return int(maxrss)
+	return int(maxrss) * 1024
+
+class StageProfiler:
+	"""
+	Records the wall time, number of calls and memory of named stages (e.g., load, fit, simulate, permute, periodogram, sliding window, plot). Times are inclusive of nested stages. Work done in worker processes (e.g., render_figures with n_jobs > 1) is only counted as the wall time of the enclosing stage. The peak resident memory of the process at the end of each stage (max_rss) is recorded at no cost; it is the high-water mark of the whole run so far, so it only grows.
+
+	Parameters
+	----------
+	trace_memory : bool
+		Also record the peak memory allocated within each stage using tracemalloc. Tracing slows down every allocation (several-fold for the permutations), so the wall times of a traced run are not representative.
+	cprofile_dir : string
+		[optional] Directory for cProfile dumps ({stage}.prof) of each stage that is not nested in another stage.
+	"""
+	def __init__(self, trace_memory = False, cprofile_dir = None):
+		self.trace_memory = trace_memory
+		self.cprofile_dir = cprofile_dir
+		self.stages = {}
+		self._order = []
+		self._stack = []
+		self._cprofiles = {}
+
+	def _update_peaks(self):
+		if not (self.trace_memory and tracemalloc.is_tracing()):
+			return
+		_, peak = tracemalloc.get_traced_memory()
+		for frame in self._stack:
+			frame['peak'] = max(frame['peak'], peak - frame['start_memory'])
+		# without reset_peak (python < 3.9), the peaks are those of the whole run
+		if hasattr(tracemalloc, 'reset_peak'):
+			tracemalloc.reset_peak()
+
+	@contextmanager
+	def stage(self, name):
+		"""
+		Context manager that records a stage. Re-entering a stage that is already active is not recorded again.
+		"""
+		if name in [frame['name'] for frame in self._stack]:
+			yield
+			return
+		if name not in self.stages:
+			self.stages[name] = {'stage': name, 'calls': 0, 'wall_time': 0., 'max_rss': None, 'peak_memory': None}
+			self._order.append(name)
+		self._update_peaks()
+		frame = {'name': name, 'peak': 0, 'start_memory': 0}
+		if self.trace_memory and tracemalloc.is_tracing():
+			frame['start_memory'] = tracemalloc.get_traced_memory()[0]
+		profile = None
+		if (self.cprofile_dir is not None) and (len(self._stack) == 0):
+			profile = self._cprofiles.setdefault(name, cProfile.Profile())
+			profile.enable()
+		self._stack.append(frame)
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			wall_time = time.perf_counter() - start
+			if profile is not None:
+				profile.disable()
+			self._update_peaks()
+			self._stack.pop()
+			record = self.stages[name]
+			record['calls'] += 1
+			record['wall_time'] += wall_time
+			record['max_rss'] = max_rss()
+			if self.trace_memory:
+				record['peak_memory'] = max(record['peak_memory'] or 0, frame['peak'])
+
+	def report(self):
+		"""
+		Returns
+		---------
+		report : list
+			list of dictionaries {stage, calls, wall_time (s), max_rss (bytes), peak_memory (bytes; None without trace_memory)} in the order the stages were first entered.
+		"""
+		return [dict(self.stages[name]) for name in self._order]
+
+	def save(self, outname):
+		"""
+		Saves the timing report as JSON or CSV (by the extension of outname) and writes the cProfile dumps.
+		"""
+		report = self.report()
+		if outname.endswith('.csv'):
+			with open(outname, 'w') as outfile:
+				writer = csv.DictWriter(outfile, fieldnames = ['stage', 'calls', 'wall_time', 'max_rss', 'peak_memory'])
+				writer.writeheader()
+				writer.writerows(report)
+		else:
+			with open(outname, 'w') as outfile:
+				json.dump(report, outfile, indent=3)
+		if self.cprofile_dir is not None:
+			if not os.path.exists(self.cprofile_dir):
+				os.makedirs(self.cprofile_dir)
+			for name, profile in self._cprofiles.items():
+				profile.dump_stats(os.path.join(self.cprofile_dir, "%s.prof" % name.replace(' ', '_')))
+
+
+@contextmanager
+def profile_stage(name):
+	"""
+	Records a stage with the active profiler (see profile_run). Does nothing if no profiler is active.
+	"""
+	if _ACTIVE_PROFILER is None:
+		yield
+	else:
+		with _ACTIVE_PROFILER.stage(name):
+			yield
+
+
+@contextmanager
+def profile_run(outname = None, trace_memory = False, cprofile_dir = None):
+	"""
+	Activates a StageProfiler for the library while the context is open.
+
+	Parameters
+	----------
+	outname : string
+		[optional] Save the timing report as *.json or *.csv when the context closes.
+	trace_memory : bool
+		Record the peak memory allocated within each stage with tracemalloc (see StageProfiler). Off by default, because tracing inflates the wall times.
+	cprofile_dir : string
+		[optional] Directory for cProfile dumps of each stage.
+
+	Returns
+	---------
+	profiler : StageProfiler
+		e.g.,
+		with profile_run('timing.json') as profiler:
+			with profile_stage('fit'):
+				...
+	"""
+	global _ACTIVE_PROFILER
+	previous = _ACTIVE_PROFILER
+	profiler = StageProfiler(trace_memory = trace_memory, cprofile_dir = cprofile_dir)
+	started_tracing = False
+	if trace_memory and not tracemalloc.is_tracing():
+		tracemalloc.start()
+		started_tracing = True
+	_ACTIVE_PROFILER = profiler
+	try:
+		yield profiler
+	finally:
+		_ACTIVE_PROFILER = previous
+		if started_tracing:
+			tracemalloc.stop()
+		if outname is not None:
+			profiler.save(outname)
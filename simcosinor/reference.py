@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+
+# Reference oracles of the equivalence harness (see simcosinor.equivalence). These are the implementations of simcosinor 0.0.1 before the vectorised engines, kept unchanged so that a change of behaviour of the engines is caught. Only the plotting is removed: periodogram and sliding_window_cosinor return the values that they plotted. Do not optimise or fix these functions; the deliberate differences of the engines are allowances of the harness (see ALLOWANCES).
+
+from __future__ import division
+import numpy as np
+from simcosinor.cynumstats import cy_lin_lstsqr_mat_residual, cy_lin_lstsqr_mat, se_of_slope
+from scipy.stats import f
+
+
+def stack_ones(arr):
+	"""
+	Add a column of ones to an array
+	
+	Parameters
+	----------
+	arr : array
+
+	Returns
+	---------
+	arr : array
+		array with a column of ones
+	
+	"""
+	return np.column_stack([np.ones(len(arr)),arr])
+
+
+def lm_residuals(endog, exog):
+	"""
+	"""
+	if exog.ndim == 1:
+		exog = stack_ones(exog)
+	if np.mean(exog[:,0]) != 1:
+		exog = stack_ones(exog)
+	a = cy_lin_lstsqr_mat(exog,endog)
+	endog = endog - np.dot(exog,a)
+	return endog
+
+
+def residual_cosinor(endog, time_var, period = [24.0]):
+	n = endog.shape[0]
+	num_period = len(period)
+	exog_vars = np.ones((n))
+	for i in range(num_period):
+		exog_vars = np.column_stack((exog_vars,np.cos(np.divide(2.0*np.pi*time_var, period[i]))))
+		exog_vars = np.column_stack((exog_vars,np.sin(np.divide(2.0*np.pi*time_var, period[i]))))
+	return np.array(lm_residuals(endog, exog_vars))
+
+
+# https://www.ncbi.nlm.nih.gov/pmc/articles/PMC3991883/
+# https://www.ncbi.nlm.nih.gov/pmc/articles/PMC3663600/
+def glm_cosinor(endog, time_var, exog = None, dmy_covariates = None, rand_array = None, interaction_var = None, period = [24.0], calc_MESOR = True, output_fit_only = False):
+	"""
+	COSINOR model using GLM
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array (Nsubjects, Nvariables)
+	time_var : array
+		Time variable [0-23.99] (Nsubjects).
+	exog : array
+		Exogenous (independent) dummy coded variables
+		exog is an array of arrays (Nvariables, Nsubjects, Kvariable).
+	dmy_covariates : array
+		Dummy coded array of covariates of no interest.
+	init_covars : array
+		Dummy coded array of covariates for two-step regression.
+	rand_array : array
+		randomized array for permutations (Nsubjects).
+	period : array
+		Period(s) as an array of floats for cosinor model.
+	Returns
+	---------
+	To-do
+	"""
+
+	n = endog.shape[0]
+	# add cosinor terms
+	num_period = len(period)
+	exog_vars = np.ones((n))
+	for i in range(num_period):
+		exog_vars = np.column_stack((exog_vars,np.cos(np.divide(2.0*np.pi*time_var, period[i]))))
+		exog_vars = np.column_stack((exog_vars,np.sin(np.divide(2.0*np.pi*time_var, period[i]))))
+
+	if interaction_var is not None:
+		for i in range(num_period):
+			exog_vars = np.column_stack((exog_vars, exog_vars[i+1] * interaction_var))
+
+
+	kvars = []
+	# add other exogenous variables to the model (currently not implemented)
+	if exog is not None:
+		for var in exog:
+			var = np.array(var)
+			if var.ndim == 1:
+				kvars.append((3))
+			else:
+				kvars.append((var.shape[1]))
+			exog_vars = np.column_stack((exog_vars,var))
+
+	# add covariates (i.e., exogenous variables that will not be outputed)
+	if dmy_covariates is not None:
+		exog_vars = np.column_stack((exog_vars, dmy_covariates))
+	exog_vars = np.array(exog_vars)
+
+	if rand_array is not None:
+		exog_vars = exog_vars[rand_array]
+
+	# calculate model fit (Fmodel and R-sqr)
+	k = exog_vars.shape[1]
+	DF_Between = k - 1 # aka df model
+	DF_Within = n - k # aka df residuals
+	#DF_Total = n - 1
+
+	a, SS_Residuals = cy_lin_lstsqr_mat_residual(exog_vars,endog)
+	if output_fit_only:
+		AMPLITUDE = []
+		ACROPHASE = []
+		MESOR = a[0]
+		for i in range(num_period):
+			# beta, gamma
+			AMPLITUDE.append(np.sqrt((a[1+(i*2),:]**2) + (a[2+(i*2),:]**2)))
+			# Acrophase calculation
+			if i == 0: # awful hack
+				ACROPHASE = np.arctan(np.abs(np.divide(-a[2+(i*2),:], a[1+(i*2),:])))
+				ACROPHASE = ACROPHASE[np.newaxis,:]
+			else:
+				temp_acro = np.arctan(np.abs(np.divide(-a[2+(i*2),:], a[1+(i*2),:])))
+				temp_acro = temp_acro[np.newaxis,:]
+				ACROPHASE = np.append(ACROPHASE,temp_acro, axis=0)
+			ACROPHASE = np.array(ACROPHASE)
+			ACROPHASE[i, (a[2+(i*2),:] > 0) & (a[1+(i*2),:] >= 0)] = -ACROPHASE[i, (a[2+(i*2),:] > 0) & (a[1+(i*2),:] >= 0)]
+			ACROPHASE[i, (a[2+(i*2),:] > 0) & (a[1+(i*2),:] < 0)] = (-1*np.pi) + ACROPHASE[i, (a[2+(i*2),:] > 0) & (a[1+(i*2),:] < 0)]
+			ACROPHASE[i, (a[2+(i*2),:] < 0) & (a[1+(i*2),:] <= 0)] = (-1*np.pi) - ACROPHASE[i, (a[2+(i*2),:] < 0) & (a[1+(i*2),:] <= 0)]
+			ACROPHASE[i, (a[2+(i*2),:] <= 0) & (a[1+(i*2),:] > 0)] = (-2*np.pi) + ACROPHASE[i, (a[2+(i*2),:] <= 0) & (a[1+(i*2),:] > 0)]
+		return MESOR, np.array(AMPLITUDE), np.array(ACROPHASE)
+	else:
+		SS_Total = np.sum((endog - np.mean(endog,0))**2,0)
+		SS_Between = SS_Total - SS_Residuals
+		MS_Residuals = (SS_Residuals / DF_Within)
+		Fmodel = (SS_Between/DF_Between) / MS_Residuals
+		# Calculates sigma sqr and T-value (intercept) for MESOR
+		sigma = np.sqrt(SS_Residuals / DF_Within)
+		invXX = np.linalg.inv(np.dot(exog_vars.T, exog_vars))
+
+		if (calc_MESOR) or (exog is not None):
+			if endog.ndim == 1:
+				se = np.sqrt(np.diag(sigma * sigma * invXX))
+				Tvalues = a / se
+				MESOR = a[0]
+				tMESOR = Tvalues[0]
+				SE_MESOR = se[0]
+				a = a[:, np.newaxis]
+			else:
+				num_depv = endog.shape[1]
+				se = se_of_slope(num_depv,invXX,sigma**2,k)
+				Tvalues = a / se
+				MESOR = a[0,:]
+				tMESOR = Tvalues[0,:]
+				SE_MESOR = se[0,:]
+			if exog is not None:
+				tEXOG = Tvalues[(3+(2*(num_period-1))):,:]
+			else:
+				tEXOG = None
+		else:
+			MESOR = tMESOR = SE_MESOR = tEXOG = None
+
+		AMPLITUDE = []
+		ACROPHASE = []
+		SE_ACROPHASE = []
+		SE_AMPLITUDE = []
+		tAMPLITUDE = []
+		tACROPHASE = []
+		
+		for i in range(num_period):
+			# beta, gamma
+			AMPLITUDE.append(np.sqrt((a[1+(i*2),:]**2) + (a[2+(i*2),:]**2)))
+			# Acrophase calculation
+			if i == 0: # awful hack
+				ACROPHASE = np.arctan(np.abs(np.divide(-a[2+(i*2),:], a[1+(i*2),:])))
+				ACROPHASE = ACROPHASE[np.newaxis,:]
+			else:
+				temp_acro = np.arctan(np.abs(np.divide(-a[2+(i*2),:], a[1+(i*2),:])))
+				temp_acro = temp_acro[np.newaxis,:]
+				ACROPHASE = np.append(ACROPHASE,temp_acro, axis=0)
+
+			# standard errors from error propagation
+			SE_ACROPHASE.append(sigma * np.sqrt((invXX[(1+(i*2)),1+(i*2)]*np.sin(ACROPHASE[i])**2) + (2*invXX[1+(i*2),2+(i*2)]*np.sin(ACROPHASE[i])*np.cos(ACROPHASE[i])) + (invXX[2+(i*2),2+(i*2)]*np.cos(ACROPHASE[i])**2)) / AMPLITUDE[i])
+			SE_AMPLITUDE.append(sigma * np.sqrt((invXX[(1+(i*2)),1+(i*2)]*np.cos(ACROPHASE[i])**2) - (2*invXX[1+(i*2),2+(i*2)]*np.sin(ACROPHASE[i])*np.cos(ACROPHASE[i])) + (invXX[2+(i*2),2+(i*2)]*np.sin(ACROPHASE[i])**2)))
+
+			ACROPHASE = np.array(ACROPHASE)
+			if rand_array is None:
+				ACROPHASE[i, (a[2+(i*2),:] > 0) & (a[1+(i*2),:] >= 0)] = -ACROPHASE[i, (a[2+(i*2),:] > 0) & (a[1+(i*2),:] >= 0)]
+				ACROPHASE[i, (a[2+(i*2),:] > 0) & (a[1+(i*2),:] < 0)] = (-1*np.pi) + ACROPHASE[i, (a[2+(i*2),:] > 0) & (a[1+(i*2),:] < 0)]
+				ACROPHASE[i, (a[2+(i*2),:] < 0) & (a[1+(i*2),:] <= 0)] = (-1*np.pi) - ACROPHASE[i, (a[2+(i*2),:] < 0) & (a[1+(i*2),:] <= 0)]
+				ACROPHASE[i, (a[2+(i*2),:] <= 0) & (a[1+(i*2),:] > 0)] = (-2*np.pi) + ACROPHASE[i, (a[2+(i*2),:] <= 0) & (a[1+(i*2),:] > 0)]
+			# t values
+			tAMPLITUDE.append(np.divide(AMPLITUDE[i], SE_AMPLITUDE[i]))
+			tACROPHASE.append(np.divide(1.0, SE_ACROPHASE[i]))
+
+		# Do not output R-squared during permutations testing.
+		R2 = 1 - (SS_Residuals/SS_Total)
+
+		return R2, MESOR, SE_MESOR, np.array(AMPLITUDE), np.array(SE_AMPLITUDE), np.array(ACROPHASE), np.array(SE_ACROPHASE), Fmodel, tMESOR, np.abs(tAMPLITUDE), np.abs(tACROPHASE), np.array(tEXOG)
+
+
+def permute_cosinor(endog, time_variable, period, iterator, perm_stat = 'Fmodel', blocking = None):
+	# Check that endog has two dimensions
+	if endog.ndim == 1:
+		endog = endog.reshape(len(endog),1)
+	if perm_stat == 'Fmodel':
+		stat_choice = 7
+	else:
+		stat_choice = 0
+	rand_array = np.random.permutation(list(range(len(time_variable))))
+	perm_stat = glm_cosinor(endog = endog,
+							time_var = time_variable,
+							rand_array = rand_array,
+							period = period)[stat_choice]
+	return(perm_stat)
+
+
+def periodogram(endog, time_variable, periodrange = [3, 24], step = 1.0):
+	# Check that endog has two dimensions
+	if endog.ndim == 1:
+		endog = endog.reshape(len(endog),1)
+
+	periods =  np.arange(periodrange[0],(periodrange[1]+step),step)
+	coeff = []
+	for period in periods:
+		period = [period]
+		R2 = glm_cosinor(endog = endog, time_var = time_variable, period = period, calc_MESOR = True, output_fit_only = False)[0]
+		if R2 < 0:
+			R2 = 0
+		coeff.append(R2)
+	return(periods, np.array(coeff))
+
+
+def sliding_window_cosinor(endog, time_variable, subset_size = 24, period = [24.0]):
+	if endog.ndim == 1:
+		endog = endog.reshape(len(endog),1)
+
+	n_steps = (len(time_variable) - subset_size)
+	step_R2 = []
+	step_mesor = []
+	step_mesor_SE = []
+	step_ampl = []
+	step_ampl_SE = []
+	step_acro24 = []
+	step_neglogp = []
+	steps = []
+
+	for i in range(n_steps):
+		temp_time = time_variable[i:int(i+subset_size)]
+		temp_endog = endog[i:int(i+subset_size),0]
+
+		n = len(temp_endog)
+		k = len(period)*2 + 1
+		DF_Between = k - 1 # aka df model
+		DF_Within = n - k # aka df residuals
+
+		R2, MESOR, SE_MESOR, AMPLITUDE, SE_AMPLITUDE, ACROPHASE, SE_ACROPHASE, Fmodel = glm_cosinor(endog = temp_endog, 
+									time_var = temp_time,
+									period = period,
+									calc_MESOR = True,
+									output_fit_only = False)[:8]
+		ACROPHASE_24 = np.zeros_like(ACROPHASE)
+		for j, per in enumerate(period):
+			acrotemp = np.abs(ACROPHASE[j]/(2*np.pi)) * per
+			acrotemp[acrotemp>per] -= per
+			ACROPHASE_24[j] = acrotemp
+
+		step_R2.append(np.squeeze(R2))
+		step_mesor.append(np.squeeze(MESOR))
+		step_mesor_SE.append(np.squeeze(SE_MESOR))
+		step_ampl.append(np.squeeze(AMPLITUDE))
+		step_ampl_SE.append(np.squeeze(SE_AMPLITUDE))
+		step_acro24.append(np.squeeze(ACROPHASE_24))
+		step_neglogp.append(-np.log10(f.sf(Fmodel, DF_Between, DF_Within)))
+		steps.append(i+1)
+	return(np.array(steps), np.array(step_R2), np.array(step_mesor), np.array(step_ampl), np.array(step_acro24), np.array(step_neglogp))
+
+
+def project_cosionor_model(MESOR, AMPLITUDE, ACROPHASE, TIME_VAR, PERIOD = [24.0]):
+	TIME_VAR = np.array(TIME_VAR)
+	n = len(TIME_VAR)
+	try:
+		r = len(MESOR)
+	except:
+		r = 1
+	proj = MESOR
+	for j, per in enumerate(PERIOD):
+		proj = proj + AMPLITUDE[j,:]*np.cos((np.divide(2*np.pi*np.tile(TIME_VAR,r).reshape(r,n).T, per) + ACROPHASE[j,:]))
+	return proj
+
+
+def run_cosinor_simulation(endog, time_variable, period = [24.0], resids = None, randomise_time = False, resample_eveningly = False, n_sampling = None, range_sampling = None, i = 0):
+
+	"""
+	Cosinor simulations. The MESOR, amplitude, and acrophase are determined from real data. Simulated data are calculated by adding random gaussian noise to the projected cosinor model. For estimationg of the noise, the residuals from cosinor model are used to determine the mean, and standard deviation. 
+	
+	Parameters
+	----------
+	endog : array
+		Endogenous (dependent) variable array of real data.
+	time_variable : array
+		Time points.
+	period : array
+		The period(s) of the cosinor model
+	resids : array
+		[optional] input precomputed residuals. Otherwise, it is calculated.
+	randomise_time : bool
+		Randomise the time points for the simulation within the sample range.
+	resample_eveningly : bool
+		The time points will be equally distributed across the sample range.
+	n_sampling : int
+		The number of time points to simulate
+	range_sampling: array
+		The time range for simulating [start, stop]
+	i : int
+		Iterator for parallel processing.
+	Returns
+	---------
+	sim_R2 : float
+		R-squared of the simulated model
+	sim_Fmodel : float
+		F-value of the simulated model
+	sim_tAMPLITUDE : float
+		The amplitude T-value(s) of the simulated model
+	ACROPHASE_24 : float
+		The acrophase of the simulated model converted to 24H from radians
+	p_values
+		The simulated model p-value
+	"""
+
+	n = len(endog)
+	k = len(period)*2 + 1
+	DF_Between = k - 1 # aka df model
+	DF_Within = n - k # aka df residuals
+
+	# Check that endog has two dimensions
+	if endog.ndim == 1:
+		endog = endog.reshape(len(endog),1)
+
+	# calculate residuals from cosinor model if not already provided
+	if resids is None:
+		resids = residual_cosinor(endog = endog, time_var = time_variable, period = period)
+
+	# Calculate true Mesor, Amplitude, Acrophase
+	MESOR, AMPLITUDE, ACROPHASE = glm_cosinor(endog = endog, 
+															time_var = time_variable,
+															period = period,
+															calc_MESOR = True,
+															output_fit_only = True)
+
+	if randomise_time:
+		if n_sampling is None:
+			n_sampling = n
+		if range_sampling is None:
+			range_sampling = [0,23.99]
+		if resample_eveningly:
+			time_variable = np.linspace(range_sampling[0],range_sampling[1],n_sampling)
+		else:
+			time_variable = np.sort(np.random.uniform(low=range_sampling[0], high=range_sampling[1], size=(n_sampling,)))
+	else:
+		n_sampling = n
+
+	# the mean and std of for the noise is calculated from the residuals
+	noise_mean = resids.mean()
+	noise_std = resids.std()
+	noise_npts = n_sampling
+	noise = np.random.normal(noise_mean, noise_std, noise_npts).reshape(noise_npts,1)
+
+	# calculate the predicted cosinor curve
+	predicted = project_cosionor_model(MESOR, AMPLITUDE, ACROPHASE, TIME_VAR = time_variable, PERIOD = period)
+	sim_endog = noise + predicted
+	sim_R2, sim_MESOR, _, sim_AMPLITUDE, sim_SE_AMPLITUDE, sim_ACROPHASE, sim_SE_ACROPHASE, sim_Fmodel, _, sim_tAMPLITUDE, _, _ = glm_cosinor(endog = sim_endog, 
+																time_var = time_variable,
+																period = period,
+																calc_MESOR = True,
+																output_fit_only = False)
+
+	ACROPHASE_24 = np.zeros_like(sim_ACROPHASE)
+	for j, per in enumerate(period):
+		acrotemp = np.abs(sim_ACROPHASE[j]/(2*np.pi)) * per
+		acrotemp[acrotemp>per] -= per
+		ACROPHASE_24[j] = acrotemp
+
+	p_values = f.sf(sim_Fmodel, DF_Between, DF_Within)
+	return(sim_R2.squeeze(), sim_Fmodel.squeeze(), sim_tAMPLITUDE.squeeze(), ACROPHASE_24.squeeze(), p_values.squeeze())
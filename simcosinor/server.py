@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+
+from __future__ import division
+import os
+import json
+import socket
+import asyncio
+import threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from simcosinor.functions import load_covariates, residual_cosinor, glm_cosinor, simulate_cosinor_batch, permute_cosinor, freedman_lane_residuals, circular_block_cosinor, f_neglog10_pvalues, periodogram, lomb_scargle_peaks, sliding_window_cosinor, simulated_data_from_model, simulated_data_from_json
+from simcosinor.store import ResultStore
+
+JOB_TYPES = ['simulation', 'permutation', 'periodogram', 'sliding_window']
+
+# CSV files loaded by this process keyed by path and modification time. Worker processes are long-lived, so the CSV files and the design caches of simcosinor.functions stay warm between jobs.
+_CSV_CACHE = {}
+_CSV_CACHE_SIZE = 16
+
+def load_csv(csvname):
+	"""
+	Reads a CSV file once per process (the cache is invalidated when the file changes).
+	"""
+	key = (os.path.abspath(csvname), os.path.getmtime(csvname))
+	if key not in _CSV_CACHE:
+		if len(_CSV_CACHE) >= _CSV_CACHE_SIZE:
+			_CSV_CACHE.clear()
+		_CSV_CACHE[key] = pd.read_csv(csvname, delimiter=',', index_col=None)
+	return _CSV_CACHE[key]
+
+
+def job_data(job):
+	"""
+	The data of a job: a CSV file ('csv', 'roi', 'time_variable', optional 'subject': [variable, value] and 'covariates': [name, {d|c}, ...]), or a simulated model ('model' with the schema of interactive_model_definition, or 'model_json').
+
+	Returns
+	---------
+	endog : array
+		Endogenous variable
+	time_variable : array
+		Time points
+	dmy_covariates : array
+		Dummy coded covariates or None
+	"""
+	if 'csv' in job:
+		pdCSV = load_csv(job['csv'])
+		if 'subject' in job:
+			pdCSV = pdCSV[pdCSV[job['subject'][0]].astype(str) == str(job['subject'][1])]
+		roi = job.get('roi', 'lh.L_6r')
+		time_name = job.get('time_variable', 'scan_time')
+	else:
+		if 'model' in job:
+			pdCSV, _ = simulated_data_from_model(job['model'])
+		else:
+			pdCSV, _ = simulated_data_from_json(job['model_json'])
+		roi = 'simulated_roi'
+		time_name = 'scan_time'
+	dmy_covariates = None
+	if job.get('covariates'):
+		dmy_covariates = load_covariates(pdCSV, variables = job['covariates'], demean_flag = True)[0]
+	return(np.array(pdCSV[roi], dtype = np.float64), np.array(pdCSV[time_name], dtype = np.float64), dmy_covariates)
+
+
+def _json_ready(obj):
+	# numpy arrays and scalars as JSON values (NaN as null)
+	if isinstance(obj, dict):
+		return {str(key): _json_ready(value) for key, value in obj.items()}
+	if isinstance(obj, (list, tuple)):
+		return [_json_ready(value) for value in obj]
+	if isinstance(obj, np.ndarray):
+		return _json_ready(obj.tolist())
+	if isinstance(obj, np.generic):
+		obj = obj.item()
+	if isinstance(obj, float) and not np.isfinite(obj):
+		return None
+	return obj
+
+
+def run_job(job):
+	"""
+	Runs a simulation, permutation, periodogram or sliding_window job (a dictionary; see job_data for the data keys) and returns a JSON ready dictionary of the results.
+
+	Job keys
+	----------
+	simulation : period, n_simulations, randomise_time, resample_eveningly, n_sampling, range_sampling, seed, dtype ('float32' or 'float64'), robust ('huber' or 'tukey'), extended (anti-logistic extended cosinor), [store]
+	permutation : period, n_perm, null_method ('permutation' or 'circular_block'), seed
+	periodogram : periodrange, step, method ('cosinor' or 'lomb_scargle'), n_peaks, [outname]
+	sliding_window : period, subset_size, extended, [outname]
+	"""
+	job_type = job.get('type')
+	assert job_type in JOB_TYPES, "Error: the job type must be one of %s" % ", ".join(JOB_TYPES)
+	if job.get('seed') is not None:
+		np.random.seed(int(job['seed']))
+	endog, time_variable, dmy_covariates = job_data(job)
+	period = [float(p) for p in job.get('period', [24.0])]
+	result = {'type': job_type}
+
+	if job_type == 'simulation':
+		sim_R2, sim_Fmodel, sim_tAMPLITUDE, sim_ACROPHASE_24, sim_neglog10p, sim_coef = simulate_cosinor_batch(endog = endog,
+																		time_variable = time_variable,
+																		period = period,
+																		n_simulations = int(job.get('n_simulations', 10000)),
+																		randomise_time = job.get('randomise_time', False),
+																		resample_eveningly = job.get('resample_eveningly', False),
+																		n_sampling = int(job.get('n_sampling', len(endog))),
+																		range_sampling = job.get('range_sampling', [0., 23.99]),
+																		dmy_covariates = dmy_covariates,
+																		dtype = np.dtype(job.get('dtype', 'float64')),
+																		robust = job.get('robust'),
+																		model = 'antilogistic' if job.get('extended') else 'cosinor')
+		result.update({'R2': [sim_R2.mean(), sim_R2.std()],
+							'ACROPHASE_24': [sim_ACROPHASE_24.mean(1), sim_ACROPHASE_24.std(1)],
+							'neglog10p': [sim_neglog10p.mean(), sim_neglog10p.std()]})
+		if job.get('store'):
+			store = ResultStore(job['store'], mode = 'w', attributes = {'period': period, 'job': job})
+			store.append_arrays(R2 = sim_R2,
+										Fmodel = sim_Fmodel,
+										tAMPLITUDE = sim_tAMPLITUDE.T,
+										ACROPHASE_24 = sim_ACROPHASE_24.T,
+										log10p = sim_neglog10p,
+										coefficients = sim_coef.T)
+			result['store'] = job['store']
+
+	elif job_type == 'permutation':
+		n_perm = int(job.get('n_perm', 10000))
+		endog = endog.reshape(len(endog),1)
+		if job.get('null_method', 'permutation') == 'circular_block':
+			Fmodel, _, Fperm, _, _ = circular_block_cosinor(endog, time_variable, period = period, n_surrogates = n_perm, dmy_covariates = dmy_covariates)
+		else:
+			if dmy_covariates is not None:
+				reduced_fitted, resids = freedman_lane_residuals(endog, dmy_covariates)
+			else:
+				reduced_fitted = None
+				resids = residual_cosinor(endog = endog, time_var = time_variable, period = period)
+			results, DF_Within = glm_cosinor(endog = endog, time_var = time_variable, dmy_covariates = dmy_covariates, period = period, return_DF_Within = True)
+			Fmodel = results[7]
+			Fperm = np.array([permute_cosinor(endog = resids, time_variable = time_variable, period = period, iterator = i, dmy_covariates = dmy_covariates, reduced_fitted = reduced_fitted) for i in range(n_perm)])
+		k = 1 + 2*len(period)
+		if job.get('null_method', 'permutation') == 'circular_block':
+			DF_Within = len(endog) - k - (0 if dmy_covariates is None else dmy_covariates.reshape(len(endog),-1).shape[1])
+		result.update({'Fmodel': float(np.squeeze(Fmodel)),
+							'neglog10p_parametric': float(np.squeeze(f_neglog10_pvalues(Fmodel, k - 1, DF_Within))),
+							'p_permuted': float((np.sum(Fperm.reshape(n_perm,-1)[:,0] >= np.squeeze(Fmodel)) + 1) / (n_perm + 1)),
+							'n_perm': n_perm})
+
+	elif job_type == 'periodogram':
+		method = job.get('method', 'cosinor')
+		periods, R2 = periodogram(endog, time_variable,
+									periodrange = job.get('periodrange', [3, 24]),
+									step = float(job.get('step', 1.0)),
+									save_plot = 'outname' in job,
+									outname = job.get('outname', 'periodogram_plot.png'),
+									dmy_covariates = dmy_covariates,
+									method = method,
+									n_peaks = int(job.get('n_peaks', 3)))
+		result.update({'periods': periods, 'R2': R2})
+		if method == 'lomb_scargle':
+			peak_periods, peak_power, false_alarm = lomb_scargle_peaks(periods, R2, time_variable, n_peaks = int(job.get('n_peaks', 3)))
+			result.update({'peak_periods': peak_periods[:,0], 'peak_R2': peak_power[:,0], 'false_alarm': false_alarm[:,0]})
+
+	elif job_type == 'sliding_window':
+		steps, R2, MESOR, AMPLITUDE, ACROPHASE_24, neglog10p = sliding_window_cosinor(endog, time_variable,
+																		subset_size = int(job.get('subset_size', 24)),
+																		period = period,
+																		save_plot = 'outname' in job,
+																		outname = job.get('outname', 'sliding_window_plot.png'),
+																		dmy_covariates = dmy_covariates,
+																		model = 'antilogistic' if job.get('extended') else 'cosinor')
+		result.update({'steps': steps, 'R2': R2, 'MESOR': MESOR, 'AMPLITUDE': AMPLITUDE, 'ACROPHASE_24': ACROPHASE_24, 'neglog10p': neglog10p})
+	return _json_ready(result)
+
+
+def _warm_worker():
+	# fit a small model so that the first job of each worker does not pay the warm-up cost
+	time_variable = np.linspace(0, 23, 24)
+	glm_cosinor(endog = np.cos(2*np.pi*time_variable/24.).reshape(24,1), time_var = time_variable, period = [24.0])
+
+
+def parse_address(address):
+	"""
+	'host:port' for TCP or the path of a Unix socket.
+	"""
+	if (':' in address) and not os.path.sep in address:
+		host, port = address.rsplit(':', 1)
+		return(host, int(port), None)
+	return(None, None, address)
+
+
+class CosinorJobServer:
+	"""
+	Long-running asyncio server for cosinor jobs. Clients send one JSON job per line (see run_job; each job should have an 'id'). Every job is acknowledged ({"id", "status": "queued"}), queued on a pool of worker processes that keep the library, CSV files and design caches warm, and its result is streamed back as a JSON line ({"id", "status": "done", "result"} or {"id", "status": "error", "error"}) as soon as it finishes. {"type": "ping"} is answered immediately, and {"type": "shutdown"} stops the server once the running jobs of all the clients are done.
+
+	Parameters
+	----------
+	n_workers : int
+		The number of worker processes
+	"""
+	def __init__(self, n_workers = 1):
+		self.n_workers = n_workers
+		self.pool = None
+		self.server = None
+		self._stopping = None
+		# running jobs, reply queues and open connections of all the clients
+		self._tasks = set()
+		self._queues = set()
+		self._writers = set()
+
+	async def _sender(self, writer, queue):
+		# the replies of a client are written by one task, so reading the next job never waits for the client to read its replies (a client that sends a large batch before reading would otherwise deadlock with the server)
+		while True:
+			message = await queue.get()
+			try:
+				if message is None:
+					return
+				writer.write((json.dumps(message) + '\n').encode('utf-8'))
+				await writer.drain()
+			except ConnectionError:
+				# the client disconnected; its remaining replies are dropped
+				pass
+			finally:
+				queue.task_done()
+
+	async def _run(self, job, queue):
+		loop = asyncio.get_running_loop()
+		try:
+			result = await loop.run_in_executor(self.pool, run_job, job)
+			message = {'id': job.get('id'), 'status': 'done', 'result': result}
+		except Exception as error:
+			message = {'id': job.get('id'), 'status': 'error', 'error': "%s: %s" % (type(error).__name__, error)}
+		queue.put_nowait(message)
+
+	async def handle_client(self, reader, writer):
+		queue = asyncio.Queue()
+		sender = asyncio.ensure_future(self._sender(writer, queue))
+		tasks = []
+		self._queues.add(queue)
+		self._writers.add(writer)
+		try:
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+				if not line.strip():
+					continue
+				try:
+					job = json.loads(line.decode('utf-8'))
+				except ValueError as error:
+					queue.put_nowait({'id': None, 'status': 'error', 'error': "invalid JSON: %s" % error})
+					continue
+				if not isinstance(job, dict):
+					queue.put_nowait({'id': None, 'status': 'error', 'error': "a job must be a JSON object"})
+					continue
+				if job.get('type') == 'ping':
+					queue.put_nowait({'id': job.get('id'), 'status': 'done', 'result': 'pong'})
+				elif job.get('type') == 'shutdown':
+					# wait for the running jobs of every client and for their results to be sent
+					while self._tasks:
+						await asyncio.gather(*self._tasks)
+					await asyncio.gather(*[client_queue.join() for client_queue in self._queues if client_queue is not queue])
+					queue.put_nowait({'id': job.get('id'), 'status': 'done', 'result': 'shutdown'})
+					await queue.join()
+					self._stopping.set()
+					break
+				else:
+					queue.put_nowait({'id': job.get('id'), 'status': 'queued'})
+					task = asyncio.ensure_future(self._run(job, queue))
+					self._tasks.add(task)
+					task.add_done_callback(self._tasks.discard)
+					tasks.append(task)
+			await asyncio.gather(*tasks)
+			queue.put_nowait(None)
+			await sender
+		except (asyncio.CancelledError, ConnectionError):
+			# the server is stopping or the client disconnected
+			pass
+		finally:
+			self._queues.discard(queue)
+			self._writers.discard(writer)
+			sender.cancel()
+			writer.close()
+
+	async def serve(self, address = '127.0.0.1:8765'):
+		"""
+		Serves on 'host:port' (TCP) or a Unix socket path until a shutdown job is received.
+		"""
+		host, port, path = parse_address(address)
+		self._stopping = asyncio.Event()
+		self.pool = ProcessPoolExecutor(max_workers = self.n_workers, initializer = _warm_worker)
+		if path is not None:
+			if os.path.exists(path):
+				os.remove(path)
+			self.server = await asyncio.start_unix_server(self.handle_client, path = path)
+		else:
+			self.server = await asyncio.start_server(self.handle_client, host = host, port = port)
+		print("simcosinor job server on %s (%d workers)" % (address, self.n_workers))
+		try:
+			await self._stopping.wait()
+		finally:
+			self.server.close()
+			# idle clients are disconnected
+			for writer in list(self._writers):
+				writer.close()
+			await self.server.wait_closed()
+			self.pool.shutdown()
+			if (path is not None) and os.path.exists(path):
+				os.remove(path)
+
+
+def serve(address = '127.0.0.1:8765', n_workers = 1):
+	"""
+	Runs the job server (see CosinorJobServer) until it receives a shutdown job.
+	"""
+	asyncio.run(CosinorJobServer(n_workers = n_workers).serve(address))
+
+
+def submit_jobs(jobs, address = '127.0.0.1:8765', timeout = None):
+	"""
+	Sends jobs to a running job server and yields their results as they finish.
+
+	Parameters
+	----------
+	jobs : list
+		Job dictionaries (see run_job). Jobs without an 'id' are numbered.
+	address : string
+		'host:port' or the path of a Unix socket
+	timeout : float
+		[optional] Socket timeout in seconds
+
+	Returns
+	---------
+	messages : generator
+		{"id", "status": "done", "result"} or {"id", "status": "error", "error"} in the order the jobs finish
+	"""
+	host, port, path = parse_address(address)
+	if path is not None:
+		connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		connection.connect(path)
+	else:
+		connection = socket.create_connection((host, port))
+	connection.settimeout(timeout)
+	jobs = [dict(job) for job in jobs]
+	for i, job in enumerate(jobs):
+		job.setdefault('id', i)
+	pending = set(job['id'] for job in jobs)
+	send_errors = []
+	def send():
+		# the jobs are sent by a thread while the replies are read, so that neither side blocks on a full socket buffer
+		try:
+			with connection.makefile('wb') as outstream:
+				for job in jobs:
+					outstream.write((json.dumps(job) + '\n').encode('utf-8'))
+		except (OSError, ValueError) as error:
+			send_errors.append(error)
+	sender = threading.Thread(target = send, daemon = True)
+	with connection, connection.makefile('rb') as stream:
+		sender.start()
+		try:
+			while pending:
+				line = stream.readline()
+				if not line:
+					break
+				message = json.loads(line.decode('utf-8'))
+				if message['status'] == 'queued':
+					continue
+				pending.discard(message['id'])
+				yield message
+		finally:
+			if sender.is_alive():
+				# the results are no longer read (e.g., the generator was closed), so the sending is stopped
+				try:
+					connection.shutdown(socket.SHUT_RDWR)
+				except OSError:
+					pass
+			sender.join()
+	assert not (pending and send_errors), "Error: the jobs could not be sent (%s)" % send_errors[0]
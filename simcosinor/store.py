@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+from __future__ import division
+import os
+import json
+import numpy as np
+from simcosinor.version import __version__
+
+class ResultStore:
+	"""
+	Appendable binary store of result arrays (e.g., per-simulation or per-ROI metrics). The store is a directory with one raw binary file per array ({name}.bin) and metadata.json, which holds the dtype, row shape and number of rows of each array, and the attributes of the analysis (periods, sampling settings, seed, version). Rows are appended along the first axis, and arrays are opened as read-only memory maps, so nothing is loaded into RAM until it is used.
+
+	Parameters
+	----------
+	path : string
+		Directory of the store.
+	mode : string
+		'r' read only, 'a' append (the store is created if it does not exist), 'w' create a new store (existing arrays are removed).
+	attributes : dict
+		[optional] Attributes of the analysis that are saved to the metadata (mode 'a' or 'w').
+
+	e.g.,
+	store = ResultStore('simulations.store', mode = 'w', attributes = {'period': [24.0], 'seed': 42})
+	store.append('R2', sim_R2)
+	store = ResultStore('simulations.store')
+	store['R2'][:100]
+	"""
+	def __init__(self, path, mode = 'r', attributes = None):
+		assert mode in ['r', 'a', 'w'], "Error: mode must be 'r', 'a' or 'w'"
+		self.path = path
+		self.mode = mode
+		self._metadata_path = os.path.join(path, 'metadata.json')
+		if mode == 'r':
+			assert os.path.exists(self._metadata_path), "Error: %s is not a result store" % path
+			self._read_metadata()
+		else:
+			if not os.path.exists(path):
+				os.makedirs(path)
+			if (mode == 'a') and os.path.exists(self._metadata_path):
+				self._read_metadata()
+			else:
+				if os.path.exists(self._metadata_path):
+					self._read_metadata()
+					for name in self.metadata['arrays']:
+						os.remove(self._array_path(name))
+				self.metadata = {'version': __version__, 'attributes': {}, 'arrays': {}}
+			if attributes is not None:
+				self.metadata['attributes'].update(_json_safe(attributes))
+			self._write_metadata()
+
+	def _read_metadata(self):
+		with open(self._metadata_path) as json_file:
+			self.metadata = json.load(json_file)
+
+	def _write_metadata(self):
+		# the metadata is replaced atomically so that an interrupted write leaves a readable store (the rows of an interrupted append are not in the metadata, and are overwritten by the next append)
+		temp_path = self._metadata_path + '.tmp'
+		with open(temp_path, 'w') as outfile:
+			json.dump(self.metadata, outfile, indent=3, sort_keys=True)
+		os.replace(temp_path, self._metadata_path)
+
+	def _array_path(self, name):
+		return os.path.join(self.path, "%s.bin" % name.replace(os.sep, '__'))
+
+	@property
+	def attributes(self):
+		return self.metadata['attributes']
+
+	def keys(self):
+		return list(self.metadata['arrays'].keys())
+
+	def __contains__(self, name):
+		return name in self.metadata['arrays']
+
+	def __len__(self):
+		return len(self.metadata['arrays'])
+
+	def set_attributes(self, **attributes):
+		"""
+		Adds attributes to the metadata.
+		"""
+		assert self.mode != 'r', "Error: the store is read only"
+		self.metadata['attributes'].update(_json_safe(attributes))
+		self._write_metadata()
+
+	def append(self, name, arr):
+		"""
+		Appends rows to an array. The array is created on the first append; later appends must have the same dtype and row shape.
+
+		Parameters
+		----------
+		name : string
+			Array name
+		arr : array
+			Rows to append (Nrows, ...). Scalars and 1D arrays are appended as rows of shape ().
+		"""
+		assert self.mode != 'r', "Error: the store is read only"
+		arr = np.atleast_1d(np.asarray(arr))
+		if name in self.metadata['arrays']:
+			info = self.metadata['arrays'][name]
+			arr = np.ascontiguousarray(arr, dtype = np.dtype(info['dtype']))
+			assert list(arr.shape[1:]) == info['row_shape'], "Error: the row shape of %s is %s" % (name, info['row_shape'])
+		else:
+			arr = np.ascontiguousarray(arr)
+			assert arr.dtype.kind != 'O', "Error: object arrays cannot be stored"
+			info = {'dtype': arr.dtype.newbyteorder('<').str, 'row_shape': list(arr.shape[1:]), 'length': 0}
+			arr = arr.astype(np.dtype(info['dtype']), copy = False)
+			self.metadata['arrays'][name] = info
+		# the rows are written after the rows in the metadata, which drops the orphan bytes of an interrupted append
+		array_path = self._array_path(name)
+		row_bytes = np.dtype(info['dtype']).itemsize * int(np.prod(info['row_shape']))
+		with open(array_path, 'r+b' if os.path.exists(array_path) else 'wb') as outfile:
+			outfile.seek(info['length'] * row_bytes)
+			outfile.truncate()
+			outfile.write(arr.tobytes())
+		info['length'] += arr.shape[0]
+		self._write_metadata()
+
+	def append_arrays(self, **arrays):
+		"""
+		Appends rows to several arrays e.g., store.append_arrays(R2 = sim_R2, Fmodel = sim_Fmodel)
+		"""
+		for name in arrays:
+			self.append(name, arrays[name])
+
+	def __getitem__(self, name):
+		"""
+		Returns the array as a read-only memory map (Nrows, ...).
+		"""
+		info = self.metadata['arrays'][name]
+		shape = tuple([info['length']] + info['row_shape'])
+		if info['length'] == 0:
+			return np.zeros(shape, dtype = np.dtype(info['dtype']))
+		return np.memmap(self._array_path(name), dtype = np.dtype(info['dtype']), mode = 'r', shape = shape)
+
+
+def _json_safe(attributes):
+	safe = {}
+	for key in attributes:
+		value = attributes[key]
+		if isinstance(value, np.ndarray):
+			value = value.tolist()
+		elif isinstance(value, np.generic):
+			value = value.item()
+		elif isinstance(value, (list, tuple)):
+			value = [v.item() if isinstance(v, np.generic) else v for v in value]
+		safe[key] = value
+	return safe
@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+
+from simcosinor.equivalence import run_equivalence, ENGINES, ALLOWANCES
+
+def test_run_equivalence():
+	report = run_equivalence(n_designs = 3, strict = True)
+	assert set(report['engine']) == set(ENGINES)
+	assert report['passed'].all()
+
+def test_allowances():
+	# every deliberate difference from the baseline is documented for a checked engine
+	assert set(ALLOWANCES) <= set(ENGINES)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pytest
+
+from simcosinor.functions import glm_cosinor, residual_cosinor, simulate_cosinor_batch, run_cosinor_simulation
+
+def _data(seed = 0, n = 48):
+	rng = np.random.default_rng(seed)
+	time_variable = np.linspace(0, 23.5, n)
+	endog = 5 + np.cos(2*np.pi*(time_variable - 15)/24.) + rng.normal(0, 0.5, n)
+	return (endog, time_variable)
+
+def test_glm_cosinor_missing_DF_Within():
+	endog, time_variable = _data()
+	endog = np.column_stack((endog, endog))
+	endog[3,1] = np.nan
+	results, DF_Within = glm_cosinor(endog, time_variable, period = [24.0], return_DF_Within = True)
+	assert np.all(DF_Within == [48 - 3, 47 - 3])
+	# the variable with a dropped scan is fitted without it
+	complete = glm_cosinor(np.delete(endog[:,1], 3)[:,np.newaxis], np.delete(time_variable, 3), period = [24.0])
+	assert np.allclose(results[0][1], complete[0][0])
+	assert np.allclose(results[7][1], complete[7][0])
+
+@pytest.mark.parametrize('robust', [None, 'huber'])
+def test_simulate_cosinor_batch_dropped_scan(robust):
+	endog, time_variable = _data()
+	endog[10] = np.nan
+	resids = residual_cosinor(endog, time_variable, period = [24.0], robust = robust)
+	assert np.isnan(resids[10]).all()
+	np.random.seed(1)
+	sim_R2 = simulate_cosinor_batch(endog, time_variable, period = [24.0], n_simulations = 500, robust = robust)[0]
+	assert not np.isnan(sim_R2).any()
+	# the noise of the simulations matches the residuals of the observed scans
+	assert 0.5 < np.mean(sim_R2) < 0.8
+
+def test_run_cosinor_simulation_dropped_scan():
+	endog, time_variable = _data()
+	endog[10] = np.nan
+	np.random.seed(1)
+	sim_R2 = run_cosinor_simulation(endog, time_variable, period = [24.0])[0]
+	assert np.isfinite(sim_R2)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pandas as pd
+
+from simcosinor.functions import dummy_code_cosine, cosinor_parameters, acrophase_to_hours, glm_cosinor
+from simcosinor.online import OnlineCosinor, tail_csv, stream_cosinor
+
+def _recording(n = 50, seed = 0):
+	rng = np.random.default_rng(seed)
+	time_variable = np.sort(rng.uniform(0, 72, n))
+	endog = np.column_stack((5 + 2*np.cos(2*np.pi*(time_variable - 15)/24.), 1 + 0.5*np.cos(2*np.pi*(time_variable - 3)/24.))) + rng.normal(0, 0.5, (n, 2))
+	return (time_variable, endog)
+
+def _write_rows(csvname, time_variable, endog, mode = 'w', newline = True):
+	lines = ["%r,%r,%r" % (float(t), float(y[0]), float(y[1])) for t, y in zip(time_variable, endog)]
+	with open(csvname, mode) as csvfile:
+		if mode == 'w':
+			csvfile.write('time,a,b\n')
+		csvfile.write('\n'.join(lines) + ('\n' if newline else ''))
+
+def test_tail_csv_long_line(tmp_path):
+	csvname = str(tmp_path / 'long.csv')
+	with open(csvname, 'w') as csvfile:
+		csvfile.write('time,a\n1,%s\n2,3\n3,4' % ('2' * 100))
+	blocks = list(tail_csv(csvname, follow = False, max_bytes = 16))
+	# a line longer than max_bytes is read whole, and the last row of the complete file is read without a newline
+	assert sum(len(rows) for rows, _ in blocks) == 3
+	assert blocks[-1][0]['a'].iloc[-1] == 4
+	assert blocks[-1][1] == len('time,a\n1,%s\n2,3\n3,4' % ('2' * 100))
+
+def test_online_cosinor_forgetting():
+	time_variable, endog = _recording()
+	forgetting = 0.95
+	model = OnlineCosinor(n_variables = 2, period = [24.0], forgetting = forgetting)
+	for start in range(0, len(time_variable), 7):
+		model.update(time_variable[start:start+7], endog[start:start+7])
+	R2, MESOR, AMPLITUDE, ACROPHASE_24, _, _ = model.estimates()
+	# batch weighted least squares: the newest sample has weight 1
+	weights = forgetting ** np.arange(len(time_variable) - 1, -1, -1)
+	exog_vars = dummy_code_cosine(time_variable, [24.0])
+	a = np.linalg.solve(np.dot(exog_vars.T * weights, exog_vars), np.dot(exog_vars.T * weights, endog))
+	SS_Residuals = np.dot(weights, (endog - np.dot(exog_vars, a))**2)
+	SS_Total = np.dot(weights, (endog - np.dot(weights, endog) / weights.sum())**2)
+	batch_MESOR, batch_AMPLITUDE, batch_ACROPHASE = cosinor_parameters(a, [24.0])
+	assert model.n_samples == len(time_variable)
+	assert np.isclose(model.n_effective, weights.sum())
+	assert np.allclose(R2, 1 - SS_Residuals / SS_Total)
+	assert np.allclose(MESOR, batch_MESOR)
+	assert np.allclose(AMPLITUDE, batch_AMPLITUDE)
+	assert np.allclose(ACROPHASE_24, acrophase_to_hours(batch_ACROPHASE, [24.0]))
+
+def test_online_cosinor_matches_glm_cosinor():
+	time_variable, endog = _recording()
+	model = OnlineCosinor(n_variables = 2, period = [24.0, 12.0])
+	for start in range(0, len(time_variable), 9):
+		model.update(time_variable[start:start+9], endog[start:start+9])
+	R2, MESOR, AMPLITUDE, _, Fmodel, _ = model.estimates()
+	results = glm_cosinor(endog, time_variable, period = [24.0, 12.0])
+	assert np.allclose(R2, results[0])
+	assert np.allclose(MESOR, results[1])
+	assert np.allclose(AMPLITUDE, results[3])
+	assert np.allclose(Fmodel, results[7])
+
+def test_stream_cosinor_resume(tmp_path):
+	csvname = str(tmp_path / 'recording.csv')
+	checkpoint = str(tmp_path / 'state.npz')
+	time_variable, endog = _recording()
+	_write_rows(csvname, time_variable[:30], endog[:30])
+	model = stream_cosinor(csvname, 'time', ['a', 'b'], checkpoint = checkpoint, follow = False)
+	assert model.n_samples == 30
+	# the recording continues, and its last row has no newline
+	_write_rows(csvname, time_variable[30:], endog[30:], mode = 'a', newline = False)
+	assert OnlineCosinor.load(checkpoint).n_samples == 30
+	model = stream_cosinor(csvname, 'time', ['a', 'b'], checkpoint = checkpoint, follow = False)
+	assert model.n_samples == 50
+	# a stream that is restarted at the end of the file adds no rows again
+	model = stream_cosinor(csvname, 'time', ['a', 'b'], checkpoint = checkpoint, follow = False)
+	assert model.n_samples == 50
+	batch = OnlineCosinor(n_variables = 2, period = [24.0], names = ['a', 'b'])
+	rows = pd.read_csv(csvname)
+	batch.update(np.array(rows['time']), np.array(rows[['a', 'b']]))
+	assert np.allclose(np.concatenate(model.estimates()[:4], axis = None), np.concatenate(batch.estimates()[:4], axis = None))
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+from simcosinor.functions import fdr_correction, multi_roi_permutation, vertexwise_cosinor
+from simcosinor.store import ResultStore
+
+def test_fdr_correction():
+	# Benjamini-Hochberg by hand: the sorted p-values 0.005, 0.01, 0.03, 0.04 times 4/rank, with the running minimum from the largest
+	p_adjusted, rejected = fdr_correction([0.01, 0.04, 0.03, 0.005, np.nan], q = 0.03)
+	assert np.allclose(p_adjusted[:4], [0.02, 0.04, 0.04, 0.02])
+	assert np.isnan(p_adjusted[4])
+	assert np.all(rejected == [True, False, False, True, False])
+
+def test_vertexwise_cosinor_permutation(tmp_path):
+	rng = np.random.default_rng(0)
+	time_variable = np.sort(rng.uniform(0, 48, 40))
+	endog = np.cos(2*np.pi*(time_variable[:,np.newaxis] - rng.uniform(0, 24, 7)) / 24.) * rng.choice([0., 0.5, 2.], 7) + rng.standard_normal((40, 7))
+	np.random.seed(1)
+	# chunks of two columns
+	vertexwise_cosinor(endog, time_variable, str(tmp_path / 'maps'), memory_budget = 2 * (8*8 + 3*100*8) * 40 / 2.**20, n_perm = 200)
+	store = ResultStore(str(tmp_path / 'maps'))
+	assert store.attributes['chunk_columns'] == 2
+	np.random.seed(1)
+	permutations = np.array([np.random.permutation(40) for i in range(200)])
+	Fmodel, p_uncorrected, p_fwer, p_fdr, max_Fnull = multi_roi_permutation(endog, time_variable, permutations = permutations)
+	assert np.allclose(store['Fmodel'], Fmodel)
+	assert np.allclose(store['p_uncorrected'], p_uncorrected)
+	assert np.allclose(store['p_fwer'], p_fwer)
+	assert np.allclose(store['p_fdr'], p_fdr)
+	assert np.allclose(store['max_Fnull'], np.sort(max_Fnull))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import tracemalloc
+import numpy as np
+import pytest
+
+from simcosinor.functions import glm_cosinor, simulate_cosinor_batch, cosinor_parameters, FLOAT32_TOLERANCE
+
+def _data(seed = 0, n = 48, n_rois = 6):
+	rng = np.random.default_rng(seed)
+	time_variable = np.sort(rng.uniform(0, 24, n))
+	AMPLITUDE = rng.uniform(0.2, 2, n_rois)
+	ACROPHASE_24 = rng.uniform(0, 24, n_rois)
+	endog = 5 + AMPLITUDE * np.cos(2*np.pi*(time_variable[:,np.newaxis] - ACROPHASE_24)/24.) + rng.normal(0, 1, (n, n_rois))
+	return (endog, time_variable)
+
+def _phase_error(ACROPHASE_24_32, ACROPHASE_24_64, period = 24.):
+	difference = 2*np.pi*(ACROPHASE_24_32 - ACROPHASE_24_64)/period
+	return np.abs(np.angle(np.exp(1j*difference)))
+
+def test_glm_cosinor_float32():
+	endog, time_variable = _data()
+	fits = {}
+	for dtype in [np.float32, np.float64]:
+		R2, _, _, AMPLITUDE, _, ACROPHASE, _, _, _, _, _, _ = glm_cosinor(endog, time_variable, period = [24.0], dtype = dtype)
+		fits[dtype] = (np.asarray(R2, dtype = np.float64), np.asarray(AMPLITUDE, dtype = np.float64), np.asarray(ACROPHASE, dtype = np.float64))
+	scale = endog.std(0)
+	assert np.max(np.abs(fits[np.float32][0] - fits[np.float64][0])) <= FLOAT32_TOLERANCE['R2']
+	assert np.max(np.abs(fits[np.float32][1] - fits[np.float64][1]) / scale) <= FLOAT32_TOLERANCE['AMPLITUDE']
+	assert np.max(np.abs(np.angle(np.exp(1j*(fits[np.float32][2] - fits[np.float64][2]))))) <= FLOAT32_TOLERANCE['ACROPHASE']
+
+@pytest.mark.parametrize('randomise_time', [False, True])
+def test_simulate_cosinor_batch_float32(randomise_time):
+	endog, time_variable = _data(n_rois = 1)
+	simulations = {}
+	for dtype in [np.float32, np.float64]:
+		# the same seed draws the same simulated noise in both precisions
+		np.random.seed(42)
+		simulations[dtype] = simulate_cosinor_batch(endog[:,0], time_variable, period = [24.0], n_simulations = 2000, randomise_time = randomise_time, n_sampling = 36, dtype = dtype)
+	R2_32, _, _, ACROPHASE_24_32, _, coef_32 = simulations[np.float32]
+	R2_64, _, _, ACROPHASE_24_64, _, coef_64 = simulations[np.float64]
+	assert coef_32.dtype == np.float32
+	assert np.max(np.abs(R2_32 - R2_64)) <= FLOAT32_TOLERANCE['R2']
+	AMPLITUDE_32 = cosinor_parameters(coef_32.astype(np.float64))[1]
+	AMPLITUDE_64 = cosinor_parameters(coef_64)[1]
+	assert np.max(np.abs(AMPLITUDE_32 - AMPLITUDE_64)) / endog.std() <= FLOAT32_TOLERANCE['AMPLITUDE']
+	defined = AMPLITUDE_64 > 0.01 * endog.std()
+	assert np.max(_phase_error(ACROPHASE_24_32, ACROPHASE_24_64)[defined]) <= FLOAT32_TOLERANCE['ACROPHASE']
+
+def test_simulate_cosinor_batch_float32_memory():
+	endog, time_variable = _data(n_rois = 1)
+	peaks = {}
+	for dtype in [np.float32, np.float64]:
+		np.random.seed(42)
+		tracemalloc.start()
+		simulate_cosinor_batch(endog[:,0], time_variable, period = [24.0], n_simulations = 50000, dtype = dtype)
+		peaks[dtype] = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+	assert peaks[np.float32] < 0.6 * peaks[np.float64]
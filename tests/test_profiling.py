@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+import tracemalloc
+import numpy as np
+
+from simcosinor.profiling import profile_run, profile_stage
+
+def test_profile_run_untraced():
+	with profile_run() as profiler:
+		# the timing of a run is not slowed down by tracemalloc unless it is requested
+		assert not tracemalloc.is_tracing()
+		with profile_stage('fit'):
+			np.ones((1000, 1000)).sum()
+	report = profiler.report()
+	assert [row['stage'] for row in report] == ['fit']
+	assert report[0]['calls'] == 1
+	assert report[0]['peak_memory'] is None
+	assert (report[0]['max_rss'] is None) or (report[0]['max_rss'] > 0)
+
+def test_profile_run_trace_memory():
+	with profile_run(trace_memory = True) as profiler:
+		with profile_stage('simulate'):
+			data = np.ones((1000, 1000))
+			del data
+	assert not tracemalloc.is_tracing()
+	assert profiler.report()[0]['peak_memory'] >= 8 * 1000 * 1000
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+
+import numpy as np
+from scipy.stats import f
+
+from simcosinor.functions import optimise_schedule, cosinor_power, glm_cosinor
+
+def test_optimise_schedule_power_requires_amplitude():
+	schedule, criterion_value, power = optimise_schedule(12, ACROPHASE24 = [15.], max_iterations = 20)
+	assert len(schedule) == 12
+	assert np.isfinite(criterion_value)
+	assert np.isnan(power)
+	schedule, criterion_value, power = optimise_schedule(12, AMPLITUDE = [0.5], ACROPHASE24 = [15.], max_iterations = 20)
+	assert np.isclose(power, cosinor_power(schedule, [0.5], [15.], 1.0)[0])
+
+def test_cosinor_power_monte_carlo():
+	# the analytic power against the rejection rate of 4000 simulated fits
+	time_variable = np.linspace(0, 23.99, 12)
+	power = cosinor_power(time_variable, [0.8], [15.], 1.0)[0]
+	rng = np.random.default_rng(0)
+	endog = 0.8 * np.cos(2*np.pi*(time_variable - 15.) / 24.)[:,np.newaxis] + rng.standard_normal((12, 4000))
+	rejection_rate = np.mean(glm_cosinor(endog, time_variable)[7] > f.isf(0.05, 2, 9))
+	assert np.isclose(power, 0.2964, atol = 1e-4)
+	assert abs(rejection_rate - power) < 3 * np.sqrt(power * (1 - power) / 4000)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import subprocess
+import pytest
+
+import simcosinor
+from simcosinor.server import submit_jobs
+
+CSVNAME = os.path.join(os.path.dirname(simcosinor.__file__), 'examples', 'examples_subjects_norm_modality_1.csv')
+
+@pytest.fixture
+def server(tmp_path):
+	address = str(tmp_path / 'simcosinor.sock')
+	env = dict(os.environ, PYTHONPATH = os.path.dirname(os.path.dirname(simcosinor.__file__)))
+	process = subprocess.Popen([sys.executable, '-c', 'from simcosinor.server import serve; serve(%r, n_workers = 2)' % address], env = env, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+	start = time.time()
+	while not os.path.exists(address):
+		assert process.poll() is None, process.communicate()[1].decode('utf-8')
+		assert time.time() - start < 30, "Error: the server did not start"
+		time.sleep(0.05)
+	yield address, process
+	if process.poll() is None:
+		process.kill()
+	process.communicate()
+
+def test_server_round_trip(server):
+	address, process = server
+	data = {'csv': CSVNAME, 'roi': 'lh.L_V1', 'subject': ['Subject', 'SUB1']}
+	jobs = [{'id': 'ping', 'type': 'ping'},
+		dict(data, id = 'simulation', type = 'simulation', n_simulations = 200, seed = 1),
+		dict(data, id = 'permutation', type = 'permutation', n_perm = 50, seed = 1),
+		dict(data, id = 'periodogram', type = 'periodogram', method = 'lomb_scargle'),
+		dict(data, id = 'sliding_window', type = 'sliding_window', subset_size = 12),
+		dict(data, id = 'error', type = 'unknown')]
+	messages = {message['id']: message for message in submit_jobs(jobs, address, timeout = 60)}
+	assert set(messages) == set(job['id'] for job in jobs)
+	assert messages['ping']['result'] == 'pong'
+	for job_id in ['simulation', 'permutation', 'periodogram', 'sliding_window']:
+		assert messages[job_id]['status'] == 'done', messages[job_id]
+		assert messages[job_id]['result']['type'] == job_id
+	assert 0 < messages['permutation']['result']['p_permuted'] <= 1
+	assert len(messages['periodogram']['result']['peak_periods']) == 3
+	assert messages['error']['status'] == 'error'
+	shutdown = list(submit_jobs([{'id': 'shutdown', 'type': 'shutdown'}], address, timeout = 60))
+	assert shutdown[0]['result'] == 'shutdown'
+	assert process.wait(timeout = 60) == 0
+	assert not os.path.exists(address)
+
+def test_server_large_submission(server):
+	# a batch that is larger than the socket buffers in both directions (the replies echo the long ids)
+	address, process = server
+	jobs = [{'id': '%05d%s' % (i, 'x' * 2000), 'type': 'ping'} for i in range(3000)]
+	messages = list(submit_jobs(jobs, address, timeout = 60))
+	assert len(messages) == 3000
+	assert all(message['result'] == 'pong' for message in messages)
+	list(submit_jobs([{'type': 'shutdown'}], address, timeout = 60))
+	assert process.wait(timeout = 60) == 0
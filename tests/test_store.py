@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+from simcosinor.store import ResultStore
+
+def test_result_store_round_trip(tmp_path):
+	path = str(tmp_path / 'simulations.store')
+	store = ResultStore(path, mode = 'w', attributes = {'period': [24.0], 'seed': np.int64(42)})
+	store.append('R2', np.array([0.1, 0.2], dtype = np.float32))
+	store.append_arrays(R2 = [0.3], coef = np.ones((3, 5)))
+	store = ResultStore(path, mode = 'a')
+	store.append('coef', np.zeros((1, 5)))
+	store = ResultStore(path)
+	assert store.attributes == {'period': [24.0], 'seed': 42}
+	assert store['R2'].dtype == np.float32
+	assert np.allclose(store['R2'], [0.1, 0.2, 0.3])
+	assert store['coef'].shape == (4, 5)
+	assert np.all(store['coef'][3] == 0)
+
+def test_result_store_interrupted_append(tmp_path):
+	path = str(tmp_path / 'simulations.store')
+	store = ResultStore(path, mode = 'w')
+	store.append('R2', np.arange(3.))
+	# rows written without the metadata update of an interrupted append
+	with open(store._array_path('R2'), 'ab') as outfile:
+		outfile.write(np.arange(2.).tobytes() + b'\x00')
+	store = ResultStore(path, mode = 'a')
+	store.append('R2', [10., 11.])
+	assert np.all(ResultStore(path)['R2'] == [0., 1., 2., 10., 11.])